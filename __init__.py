@@ -29,6 +29,21 @@ SECRET_KEY = app.config.get('SECRET_KEY')
 APIKEY = app.config.get('APIKEY')
 DATABASE_PATH = app.config.get('DATABASE_PATH')
 
+# jsonify and request.get_json through the app's JSON codec (orjson when installed)
+from .utils.jsoncodec import JsonProvider
+app.json = JsonProvider(app)
+
+from .utils.db import init_db
+init_db(app)
+
+# Server-Timing header and a timing log line for every request
+from .utils.timing import init_timing
+init_timing(app)
+
+# latency histograms and the *_stats() counters at /metrics
+from .utils.metrics import init_metrics
+init_metrics(app)
+
 from .api.cwl import cwl_bp
 from .api.clan import clan_bp
 from .api.player import player_bp
@@ -36,6 +51,17 @@ app.register_blueprint(cwl_bp)
 app.register_blueprint(clan_bp)
 app.register_blueprint(player_bp)
 
+from .cli import (archive_player_history_command, backfill_metrics_command, check_query_plans_command,
+                  compress_cocdata_command, encode_player_history_command, fetch_clan_members_command,
+                  refresh_scheduler_command)
+app.cli.add_command(archive_player_history_command)
+app.cli.add_command(backfill_metrics_command)
+app.cli.add_command(check_query_plans_command)
+app.cli.add_command(compress_cocdata_command)
+app.cli.add_command(encode_player_history_command)
+app.cli.add_command(fetch_clan_members_command)
+app.cli.add_command(refresh_scheduler_command)
+
 
 if __name__ == "__main__":
     app.run()
@@ -7,8 +7,24 @@ import traceback
 import urllib.request
 
 from . import clan_bp # Import the blueprint instance
-from ...utils.db import get_db, close_db # Import common function
-from ...utils.coc_api import fetch_coc_api_data
+from ...utils.db import get_db # Import common function
+from ...utils.async_views import async_view
+from ...utils.singleflight import single_flight, single_flight_async
+from ...utils.response_cache import cached_response, cache_depends
+from ...utils.conditional import conditional, clan_data_times, latest_data_time, start_of_today
+from ...utils.blobs import decode_blob, load_json
+from ...utils.jsoncodec import json_response, loads
+from ...utils.metrics import count_cache_decision
+from ...utils.refresh import (fetch, fetch_async, refresh_clan, refresh_clan_members, refresh_clan_members_async,
+                              refresh_current_war, store_clan_result, store_current_war)
+from ...utils.snapshots import latest_row_sql, load_fields, load_latest_snapshots
+from ...utils.history import iter_metric_history, metric_deltas, metric_values
+from ...utils.streaming import JsonArray, stream_json
+from ...utils.wars import WAR_DATA_TIME_SQL, war_sql
+
+# the member values get_clan_details and get_supertroops_list read from the player snapshots
+DETAIL_FIELDS = {'attackWins': '$.attackWins', 'townHallLevel': '$.townHallLevel', 'warPreference': '$.warPreference'}
+SUPERTROOP_FIELDS = {'name': '$.name', 'troops': '$.troops'}
 
 progressItem = {'warStars':1,
     'attackWins':1,
@@ -16,116 +32,94 @@ progressItem = {'warStars':1,
     'donationsReceived':1}
 
 @clan_bp.route('/get_clan_details/<clan_tag>', methods=['GET'])
+@conditional(clan_data_times)
 def get_clan_details(clan_tag):
     conn = None # Initialize conn to None
     try: 
         conn = get_db()
-        clan_data_row = conn.execute("SELECT cocdata FROM clan where tag = ? ORDER BY dataTime DESC", (clan_tag,)).fetchone()
+        clan_data_row = conn.execute(latest_row_sql('clan', 'cocdata'), (clan_tag,)).fetchone()
         if not clan_data_row:
             current_app.logger.warning(f"get_clan_detail: {clan_tag} no data")
             return jsonify({'error': f"No clan data found for tag: {clan_tag}"}), 404
-        clandata = json.loads(clan_data_row['cocdata'])
+        clandata = load_json(clan_data_row['cocdata'])
+        player_data_map = load_fields(conn, 'player', [member['tag'][1:] for member in clandata['memberList']], DETAIL_FIELDS)
         for member in clandata['memberList']:
-            # cocdata = read_player_data(clandata['memberList'][memberIndex]['tag'][1:])
-            sql = 'SELECT cocdata FROM player where tag = ? ORDER BY dataTime DESC'
-            data2 = conn.execute(sql, (member['tag'][1:],)).fetchone()
             member['attackWins'] = 9999
             member['townHallLevel'] = 9999
             member['warPreference'] = ''
-            if data2:
-                cocdata = data2['cocdata']
-                try:
-                    playerdata = json.loads(cocdata)
-                    member['attackWins'] = playerdata['attackWins']
-                    member['townHallLevel'] = playerdata['townHallLevel']
-                    member['warPreference'] = playerdata['warPreference']
-                except:
-                    current_app.logger.warning(f"get_clan_detail: member tag {member['tag']} data json decode error")
+            playerdata = player_data_map.get(member['tag'][1:])
+            if playerdata:
+                for name, value in playerdata.items():
+                    if value is None:
+                        current_app.logger.warning(f"get_clan_detail: member tag {member['tag']} data incomplete")
+                        break
+                    member[name] = value
             else:
                 current_app.logger.warning(f"get_clan_detail: member tag {member['tag']} no data")
         return jsonify(clandata)
     except Exception as e:
         current_app.logger.warning(f"An unexpected error occurred in get_clan_detail for {clan_tag}: {e}")
         return jsonify({"error": "An internal server error occurred."}), 500
-    finally:
-        close_db()
 
 @clan_bp.route('/supertroops/<clan_tag>', methods=['GET'])
+@conditional(clan_data_times)
+@cached_response
 def get_supertroops_list(clan_tag):
     conn = get_db()
-    sql = 'SELECT * FROM clan where tag = ?  ORDER BY dataTime DESC limit 1'
+    sql = latest_row_sql('clan', '*')
     data = conn.execute(sql, (clan_tag,)).fetchone()
     if not data:
         current_app.logger.warning(f"get_supertroops_list: {clan_tag} no data")
         return jsonify({'error': f"No clan data found for tag: {clan_tag}"}), 404
 
     try:
-        clan_data = json.loads(data['cocdata'])
+        clan_data = load_json(data['cocdata'])
     except Exception as e:
         current_app.logger.error(f"An unexpected error occurred in json loads for {clan_tag}: {e}\n{traceback.format_exc()}")
         return jsonify({"error": "An internal server error occurred."}), 500
 
     clan_data['activeSuperTroops'] = {}
+    player_tags = [member['tag'][1:] for member in clan_data['memberList']]
+    cache_depends(('clan', clan_tag), *(('player', tag) for tag in player_tags))
+    player_data_map = load_fields(conn, 'player', player_tags, SUPERTROOP_FIELDS)
     for member in clan_data['memberList']:
-        sql = 'SELECT * FROM player where tag = ? ORDER BY dataTime DESC limit 1'
-        data = conn.execute(sql, (member['tag'][1:],)).fetchone()
-        try:
-            player_data = json.loads(data['cocdata'])
-        except:
+        player_data = player_data_map.get(member['tag'][1:])
+        if not player_data:
             current_app.logger.info(f"get_supertroops_list: player {member['tag']} information missing or error")
             continue # Skip this malformed record and continue with others
-        troops_data = {}
         for troop in player_data['troops']:
             if troop['village'] == 'home' and 'superTroopIsActive' in troop:
                 if troop['name'] not in clan_data['activeSuperTroops']:
                     clan_data['activeSuperTroops'][troop['name']] = []
                 clan_data['activeSuperTroops'][troop['name']].append(player_data['name'])
-    close_db()
     return jsonify(clan_data)
 
     
 
 @clan_bp.route('/troops/<clan_tag>', methods=['GET'])
+@conditional(clan_data_times)
+@cached_response
 def get_clan_troops(clan_tag):
     conn = get_db()
-    sql = 'SELECT cocdata FROM clan where tag = ? ORDER BY dataTime DESC limit 1'
+    sql = latest_row_sql('clan', 'cocdata')
     data = conn.execute(sql, (clan_tag,)).fetchone()
     if not data:
         current_app.logger.warning(f"get_clan_troops: {clan_tag} no data")
         return jsonify({'error': f"No clan data found for tag: {clan_tag}"}), 404
 
     try:
-        clan_data = json.loads(data['cocdata'])
+        clan_data = load_json(data['cocdata'])
     except json.JSONDecodeError as e:
         current_app.logger.error(f"An unexpected error occurred in json loads for {clan_tag}: {e}\n{traceback.format_exc()}")
         return jsonify({"error": "An internal server error occurred."}), 500
 
     player_tags_to_fetch = [member['tag'][1:] for member in clan_data['memberList']]
+    cache_depends(('clan', clan_tag), *(('player', tag) for tag in player_tags_to_fetch))
     if not player_tags_to_fetch:
         current_app.logger.info(f"get_clan_troops: Clan {clan_tag} has no members.")
-        close_db()
         return jsonify(clan_data)
 
-    placeholders = ', '.join(['?'] * len(player_tags_to_fetch))
-    sql_players = f"""
-        SELECT p.cocdata, p.tag
-        FROM player p
-        JOIN (
-            SELECT tag, MAX(dataTime) as latest_dataTime
-            FROM player
-            WHERE tag IN ({placeholders})
-            GROUP BY tag
-        ) AS latest_data ON p.tag = latest_data.tag AND p.dataTime = latest_data.latest_dataTime;
-    """
-    all_players_data = conn.execute(sql_players, player_tags_to_fetch).fetchall()
-
-    player_data_map = {}
-    for row in all_players_data:
-        try:
-            player_data_map[row['tag']] = json.loads(row['cocdata'])
-        except json.JSONDecodeError as e:
-            current_app.logger.warning(f"Skipping malformed player data for tag {row['tag']}: {e}")
-            continue
+    player_data_map = load_latest_snapshots(conn, 'player', player_tags_to_fetch)
  
     for member in clan_data['memberList']:
         player_tag_cleaned = member['tag'][1:] # Get tag without '#'
@@ -145,34 +139,43 @@ def get_clan_troops(clan_tag):
             # Add any other top-level player info required by the template
         }
 
-    close_db()
     return jsonify(clan_data)
 
 
+def _with_clan_progress(members, member_history, is_achievement: bool):
+    # members one at a time for stream_json, member_history yields their series in the same order;
+    # progressItem series hold day-over-day changes, achievement series their absolute values
+    progress = metric_values if is_achievement else metric_deltas
+    for member, (_, series) in zip(members, member_history):
+        # a copy, so the encoded series is not kept alive by the member list
+        yield dict(member, clanprogress = progress(series))
+
+
 @clan_bp.route('/progress/<clan_tag>', defaults={'achievement': None}, methods=['GET'])
 @clan_bp.route('/progress/<clan_tag>/<achievement>', methods=['GET'])
+@conditional(lambda conn, clan_tag, achievement: (*clan_data_times(conn, clan_tag), start_of_today()))
 def get_clan_progress_data(clan_tag, achievement:None):
     conn = get_db()
-    sql = 'SELECT cocdata FROM clan where tag = ? ORDER BY dataTime DESC limit 1'
+    sql = latest_row_sql('clan', 'cocdata')
     data = conn.execute(sql, (clan_tag,)).fetchone()
     if not data:
         current_app.logger.warning(f"get_clan_progress_data: {clan_tag} no data")
         return jsonify({'error': f"No clan data found for tag: {clan_tag}"}), 404
 
     try:
-        clan_data = json.loads(data['cocdata'])
+        clan_data = load_json(data['cocdata'])
     except json.JSONDecodeError as e:
         current_app.logger.warning(f"error occurred in json loads for {clan_tag}: {e}\n{traceback.format_exc()}")
         return jsonify({"error": "An internal server error occurred."}), 500
 
-    sql = 'SELECT cocdata FROM player where tag = ? ORDER BY dataTime DESC limit 1'
+    sql = latest_row_sql('player', 'cocdata')
     data = conn.execute(sql, (clan_data['memberList'][0]['tag'][1:],)).fetchone()
     if not data:
         current_app.logger.warning(f"clanprogress : first member no data {clan_data['memberList'][0]['tag'][1:]}")
         return jsonify({'error': 'An internal server error occurred.'}), 500
 
     try:
-        player_data = json.loads(data['cocdata'])
+        player_data = load_json(data['cocdata'])
     except json.JSONDecodeError as e:
         current_app.logger.warning(f"error in json loads for member {clan_data['memberList'][0]['tag'][1:]}: {e}\n{traceback.format_exc()}")
         return jsonify({"error": "An internal server error occurred."}), 500
@@ -191,34 +194,74 @@ def get_clan_progress_data(clan_tag, achievement:None):
         clan_data['clanprogress']['history'].append(d.strftime("%Y-%m-%d"))
  
     history_range += 1
-    for member in clan_data['memberList']:
-        working = {}
-        member['clanprogress'] = {}
-
-        sql = 'SELECT cocdata, dataTime FROM player where tag = ? ORDER BY dataTime DESC limit ?'
-        data = conn.execute(sql, (member['tag'][1:], history_range, )).fetchall() 
-        for data_row in data:
-            if data_row != "":
-                try:
-                    member_data = json.loads(data_row['cocdata'])
-                except json.JSONDecodeError as e:
-                    current_app.logger.warning(f"Skipping malformed player data for tag {member['tag']}: {e}")
-                    continue
-                if achievement in progressItem:
-                    if achievement in working:
-                        member['clanprogress'][data_row['dataTime'][:10]] = working[achievement] - member_data[achievement]
-                    else:
-                        member['clanprogress'][data_row['dataTime'][:10]] = member_data[achievement]
-                    working[achievement] = member_data[achievement]
-                else:
-                    for member_achievement in member_data.get('achievements', []):
-                        if member_achievement['name'] == achievement:
-                            if achievement in working:
-                                member['clanprogress'][data_row['dataTime'][:10]] = working[achievement] - member_achievement['value']
-                            else:
-                                member['clanprogress'][data_row['dataTime'][:10]] = member_achievement['value']
-    close_db()
-    return jsonify(clan_data)
+    is_achievement = achievement not in progressItem
+    member_history = iter_metric_history(
+            conn,
+            [member['tag'][1:] for member in clan_data['memberList']],
+            achievement,
+            history_range,
+            is_achievement = is_achievement
+            )
+    clan_data['memberList'] = JsonArray(_with_clan_progress(clan_data['memberList'], member_history, is_achievement))
+    return stream_json(clan_data)
+
+def _stored_current_war(conn, clan_tag: str):
+    # latest stored currentwar response as (cocdata, 200), None if there is none
+    sql = latest_row_sql('warlog', 'cocdata')
+    db_data = conn.execute(sql, (clan_tag,)).fetchone()
+    if not db_data:
+        return None
+    return decode_blob(db_data['cocdata']), 200
+
+def _current_war_state(conn, clan_tag: str, get_now):
+    # (error response, clan_data, stored war_data, fetch_from_api), the error is None when the war can be served
+    sql = latest_row_sql('clan', 'cocdata')
+    clan_data_row = conn.execute(sql, (clan_tag,)).fetchone()
+    if not clan_data_row:
+        error_msg = f"no clan data of {clan_tag}"
+        current_app.logger.info(error_msg)
+        return (jsonify({'error': error_msg}), 404), None, None, False
+    clan_data = load_json(clan_data_row['cocdata'])
+    if 'isWarLogPublic' not in clan_data or not clan_data['isWarLogPublic']:
+        error_msg = f"clan {clan_tag} war log not public"
+        current_app.logger.info(error_msg)
+        return (jsonify({'error': error_msg}), 404), None, None, False
+
+    sql = latest_row_sql('warlog', 'cocdata, dataTime')
+    db_data = conn.execute(sql, (clan_tag,)).fetchone()
+    
+    war_data = None
+    if db_data:
+        war_data = load_json(db_data['cocdata'])
+        war_state = war_data.get('state', '')
+        if war_state == 'inWar':
+            time_range = 900
+        else:
+            time_range = 82800
+        if (datetime.now() - datetime.strptime(db_data['dataTime'], '%Y-%m-%d %H:%M:%S')).total_seconds() > time_range:
+            fetch_from_api = True
+        else:
+            fetch_from_api = False
+    else:
+        fetch_from_api = True
+
+    if get_now:
+        fetch_from_api = True
+    count_cache_decision('currentwar', hit = not fetch_from_api)
+    return None, clan_data, war_data, fetch_from_api
+
+def _fetched_war(clan_tag: str, api_response_data, status_code: int):
+    war_data = loads(api_response_data)
+    if status_code == 200:
+        if 'clan' in war_data:
+            war_data['clan']['tag'] = '#' + clan_tag
+    else:
+        if 'error' not in war_data:
+            war_data['error'] = f"unexpected error from fetch coc api data call, status {status_code}"
+   
+    if 'clan' in war_data:
+        war_data['clan']['tag'] = '#' + clan_tag
+    return war_data
 
 @clan_bp.route('/currentwar/<clan_tag>/<get_now>', methods=['GET'])
 @clan_bp.route('/currentwar/<clan_tag>', defaults={'get_now': None}, methods=['GET'])
@@ -226,146 +269,164 @@ def get_current_war_detail(clan_tag: str, get_now: None):
     # current_app.logger.info(f"involve currentwar {clan_tag} ")
     conn = get_db()
     status_code = 200
-    try:
-
-        sql = 'SELECT cocdata FROM clan where tag = ? ORDER BY dataTime DESC limit 1'
-        clan_data_row = conn.execute(sql, (clan_tag,)).fetchone()
-        if not clan_data_row:
-            error_msg = f"no clan data of {clan_tag}"
-            current_app.logger.info(error_msg)
-            return jsonify({'error': error_msg}), 404
-        clan_data = json.loads(clan_data_row['cocdata'])
-        if 'isWarLogPublic' not in clan_data or not clan_data['isWarLogPublic']:
-            error_msg = f"clan {clan_tag} war log not public"
-            current_app.logger.info(error_msg)
-            return jsonify({'error': error_msg}), 404
-
-        sql = 'SELECT cocdata, dataTime  FROM warlog where tag = ? ORDER BY dataTime DESC limit 1'
-        db_data = conn.execute(sql, (clan_tag,)).fetchone()
-    
-        if db_data:
-            cocdata = db_data['cocdata']
-            war_data = json.loads(bytes(db_data['cocdata']).decode('utf-8'))
-            war_state = war_data.get('state', '')
-            if war_state == 'inWar':
-                time_range = 900
-            else:
-                time_range = 82800
-            if (datetime.now() - datetime.strptime(db_data['dataTime'], '%Y-%m-%d %H:%M:%S')).total_seconds() > time_range:
-                fetch_from_api = True
-            else:
-                fetch_from_api = False
-        else:
-            fetch_from_api = True
+    error, clan_data, war_data, fetch_from_api = _current_war_state(conn, clan_tag, get_now)
+    if error:
+        return error
+
+    if fetch_from_api:
+        # concurrent callers share one upstream refresh, see utils/singleflight.py
+        (api_response_data, status_code), _ = single_flight(
+                conn,
+                endpoint = 'currentwar',
+                tag = clan_tag,
+                refresh = lambda: refresh_current_war(conn, clan_tag),
+                stale = lambda: _stored_current_war(conn, clan_tag),
+                serve_stale = not get_now
+                )
+        war_data = _fetched_war(clan_tag, api_response_data, status_code)
+
+    war_data['isWarLogPublic'] = clan_data['isWarLogPublic']
+    return jsonify(war_data), status_code
 
-        if get_now:
-            fetch_from_api = True
+@async_view(clan_bp, 'get_current_war_detail')
+async def get_current_war_detail_async(db, clan_tag: str, get_now: None = None):
+    status_code = 200
+    error, clan_data, war_data, fetch_from_api = await db.run(_current_war_state, clan_tag, get_now)
+    if error:
+        return error
+
+    if fetch_from_api:
+        async def refresh():
+            return await db.run(store_current_war, clan_tag, *await fetch_async('currentwar', clan_tag))
+
+        (api_response_data, status_code), _ = await single_flight_async(
+                db,
+                endpoint = 'currentwar',
+                tag = clan_tag,
+                refresh = refresh,
+                stale = lambda conn: _stored_current_war(conn, clan_tag),
+                serve_stale = not get_now
+                )
+        war_data = _fetched_war(clan_tag, api_response_data, status_code)
+
+    war_data['isWarLogPublic'] = clan_data['isWarLogPublic']
+    return jsonify(war_data), status_code
 
-        if fetch_from_api:
-            base_api_url = 'https://api.clashofclans.com/v1/clans/%23' + urllib.parse.quote(clan_tag) + '/currentwar'
-            api_response_data, status_code = fetch_coc_api_data(
-                    endpoint = base_api_url,
-                    data_type = 'currentwar',
-                    tag_value = clan_tag
-                    )
-            war_data = json.loads(api_response_data)
-            if status_code == 200:
-                if 'endTime' in war_data:
-                    endTime = clan_tag + war_data['endTime'][:8]
-                    endTime2 = datetime.strptime(war_data['endTime'][:15], '%Y%m%dT%H%M%S')
-                    if (datetime.now() > endTime2):
-                        sql = 'INSERT OR REPLACE INTO warlog (endtime, tag, cocdata, dataTime) VALUES (?, ?, ?, ?)'
-                        conn.execute(sql, (endTime, clan_tag, api_response_data, endTime2))
-                    else:
-                        sql = 'INSERT OR REPLACE INTO warlog (endtime, tag, cocdata) VALUES (?, ?, ?)' 
-                        conn.execute(sql, (endTime, clan_tag, api_response_data))
+def _stored_war_log(conn, clan_tag: str):
+    # stored war log, None when it is older than 12 hours or missing
+    sql = latest_row_sql('clanwarlog', 'cocdata, dataTime')
+    db_data = conn.execute(sql, (clan_tag, )).fetchone()
+    fetch_from_api = True
+    if db_data:
+        last_update_time = datetime.strptime(db_data['dataTime'], '%Y-%m-%d %H:%M:%S')
+        if (datetime.now() - last_update_time).total_seconds() <= 43200:
+            fetch_from_api = False
+    count_cache_decision('warlog', hit = not fetch_from_api)
+    return None if fetch_from_api else load_json(db_data['cocdata'])
+
+def _with_war_details(conn, clan_tag: str, clan_war_log):
+    # udpate each war detail from database clanwarlog
+    clan_war_log['print'] = []
+    clan_war_log['warlog'] = {}
+    count = 0
+    for clan_war in clan_war_log['items']:
+        if count < 10:
+            if 'opponent' in clan_war and 'name' in clan_war['opponent']:
+                clan_war_log['print'].append(clan_war)
+                sql = war_sql('cocdata')
+                db_data = conn.execute(sql, (clan_tag + clan_war['endTime'][:8], )).fetchone()
+                if db_data:
+                    clan_war_log['warlog'][clan_war['endTime'][:8]] = load_json(db_data['cocdata'])
                 else:
-                    conn.execute("INSERT OR REPLACE INTO warlog (endtime, tag, cocdata) VALUES (?, ?, ?)",
-                                 (war_data['state'], clan_tag, api_response_data))
-                conn.commit()
-                if 'clan' in war_data:
-                    war_data['clan']['tag'] = '#' + clan_tag
-            else:
-                if 'error' not in war_data:
-                    war_data['error'] = f"unexpected error from fetch coc api data call, status {status_code}"
-           
-            if 'clan' in war_data:
-                war_data['clan']['tag'] = '#' + clan_tag
-
-        war_data['isWarLogPublic'] = clan_data['isWarLogPublic']
-
-    finally:
-        close_db()
-
-    return jsonify(war_data), status_code
+                    clan_war_log['warlog'][clan_war['endTime'][:8]] =  {'state': 'noData'}
+                count += 1
+    return clan_war_log
 
 @clan_bp.route('/warlog/<clan_tag>', methods=['GET'])
 def get_clan_war_history(clan_tag: str):
     conn = get_db()
     status_code = 200
-    try:
-        sql = 'SELECT cocdata, dataTime FROM clanwarlog where tag = ? ORDER BY dataTime DESC limit 1'
-        db_data = conn.execute(sql, (clan_tag, )).fetchone()
-        if db_data:
-            last_update_time = datetime.strptime(db_data['dataTime'], '%Y-%m-%d %H:%M:%S')
-            if (datetime.now() - last_update_time).total_seconds() > 43200:
-                fetch_from_api = True
-            else:
-                fetch_from_api = False
-        else:
-            fetch_from_api = True
-        # fetch latest data from api    
-        if fetch_from_api:
-            base_api_url = 'https://api.clashofclans.com/v1/clans/%23' + urllib.parse.quote(clan_tag) + '/warlog'
-            api_response_data, status_code = fetch_coc_api_data(
-                    endpoint = base_api_url,
-                    data_type = 'clanwarlog',
-                    tag_value = clan_tag
-                    )
-            clan_war_log = json.loads(api_response_data)
-        else:
-            clan_war_log = json.loads(bytes(db_data['cocdata']).decode('utf-8'))
-        # udpate each war detail from database clanwarlog
-        clan_war_log['print'] = []
-        clan_war_log['warlog'] = {}
-        count = 0
-        for clan_war in clan_war_log['items']:
-            if count < 10:
-                if 'opponent' in clan_war and 'name' in clan_war['opponent']:
-                    clan_war_log['print'].append(clan_war)
-                    sql = 'SELECT cocdata FROM warlog where endTime = ? ORDER BY dataTime DESC limit 1'
-                    db_data = conn.execute(sql, (clan_tag + clan_war['endTime'][:8], )).fetchone()
-                    if db_data:
-                        clan_war_log['warlog'][clan_war['endTime'][:8]] = json.loads(db_data['cocdata'])
-                    else:
-                        clan_war_log['warlog'][clan_war['endTime'][:8]] =  {'state': 'noData'}
-                    count += 1
-    finally:
-        close_db()
-    return jsonify(clan_war_log), status_code
+    clan_war_log = _stored_war_log(conn, clan_tag)
+    # fetch latest data from api    
+    if clan_war_log is None:
+        api_response_data, status_code = fetch('clanwarlog', clan_tag)
+        clan_war_log = loads(api_response_data)
+    return jsonify(_with_war_details(conn, clan_tag, clan_war_log)), status_code
+
+@async_view(clan_bp, 'get_clan_war_history')
+async def get_clan_war_history_async(db, clan_tag: str):
+    status_code = 200
+    clan_war_log = await db.run(_stored_war_log, clan_tag)
+    if clan_war_log is None:
+        api_response_data, status_code = await fetch_async('clanwarlog', clan_tag)
+        clan_war_log = loads(api_response_data)
+    return jsonify(await db.run(_with_war_details, clan_tag, clan_war_log)), status_code
+
+def _wardetail_data_times(conn, clan_tag: str, war_date: str):
+    war_time = conn.execute(WAR_DATA_TIME_SQL, (clan_tag + war_date,)).fetchone()[0]
+    return war_time, latest_data_time(conn, 'clan', clan_tag)
 
 @clan_bp.route('/wardetail/<clan_tag>/<war_date>', methods=['GET'])
+@conditional(_wardetail_data_times)
 def get_wardetail(clan_tag: str, war_date: str):
     conn = get_db()
     war_data = {'state': 'noData'}
     status_code = 200
     try:
-        sql = 'SELECT cocdata FROM warlog where endTime = ? ORDER BY dataTime DESC'
+        sql = war_sql('cocdata')
         db_data = conn.execute(sql, (clan_tag + war_date, )).fetchone()
         if db_data:
-            war_data = json.loads(bytes(db_data['cocdata']).decode('utf-8'))
-        sql = 'SELECT cocdata FROM clan where tag = ? ORDER BY dataTime DESC limit 1'
+            war_data = load_json(db_data['cocdata'])
+        sql = latest_row_sql('clan', 'cocdata')
         db_data = conn.execute(sql, (clan_tag,)).fetchone()
-        clan_data = json.loads(bytes(db_data['cocdata']).decode('utf-8'))
+        clan_data = load_json(db_data['cocdata'])
         war_data['isWarLogPublic'] = clan_data['isWarLogPublic']
     except json.JSONDecodeError as e:
         current_app.logger.error(f"JSONDecodeError for war detail of {clan_tag} of {war_date} : {e}")
     except Exception as e:
         current_app.logger.exception(f"Unexpected error during get wardetail call {clan_tag} of {war_date}: {e}")
-    finally: 
-        close_db()
     return jsonify(war_data), status_code
 
+def _fresh_clan(conn, clan_tag: str, time_range: int):
+    # (fetch_from_api, stored cocdata); a clan never stored is not fetched here, its cocdata is None
+    sql = latest_row_sql('clan', 'cocdata, dataTime, lastSeen')
+    db_data = conn.execute(sql, (clan_tag, )).fetchone()
+    if not db_data:
+        return False, None
+    # an unchanged payload only moves lastSeen, it is as fresh as the last fetch
+    db_data_time = datetime.strptime(db_data['lastSeen'] or db_data['dataTime'], '%Y-%m-%d %H:%M:%S')
+    if (datetime.now() - db_data_time).total_seconds() > time_range:
+        return True, None
+    return False, decode_blob(db_data['cocdata'])
+
+def _clan_fetch_error(clan_tag: str, coc_data, status_code: int):
+    # the response for a failed fetch whose answer carries no error of its own, else None
+    if status_code != 200:
+        clan_data = loads(coc_data)
+        if 'error' in clan_data:
+            error_msg = f"unexpected error from coc clan api call of {clan_tag}, status {status_code}: "
+            error_msg += f"{clan_data['error']}"
+            current_app.logger.warning(error_msg)
+        else:
+            current_app.logger.warning(f"unexpected error from coc clan api call of {clan_tag}, status {status_code}")
+            return {'error': f"unexpected error from fetch coc api data call, status {status_code}"}, 500
+    return None
+
+def _clan_fetch_response(clan_tag: str, coc_data, status_code: int):
+    if coc_data is None:
+        current_app.logger.critical(f"player fetch unexpected error occurred {clan_tag}: no clan data stored")
+        return {'error': 'An unexpected internal server error occured.'}, 500
+    # the stored or fetched JSON goes out as it is, never parsed and encoded again
+    return json_response(coc_data, status_code)
+
+def _clan_fetch_failure(e, clan_tag: str):
+    if isinstance(e, json.JSONDecodeError):
+        current_app.logger.error(f"clan fetch JSON decoding error for {clan_tag}: {e}\n{traceback.format_exc()}")
+        return {'error': f"clan fetch returned malformed data for {clan_tag}"}, e.code
+    error_msg = f"player fetch unexpected error occurred {clan_tag}: {e}\n{traceback.format_exc()}"
+    current_app.logger.critical (error_msg)
+    return {'error': 'An unexpected internal server error occured.'}, 500
+
 @clan_bp.route('/fetch/<clan_tag>', defaults={'t_range': '82801'}, methods=['GET'])
 @clan_bp.route('/fetch/<clan_tag>/<t_range>', methods=['GET'])
 def cocclan(clan_tag: str, t_range: str = '82801'):
@@ -373,54 +434,57 @@ def cocclan(clan_tag: str, t_range: str = '82801'):
     conn = get_db()
     status_code = 200
     try:
-        sql = 'SELECT cocdata, dataTime FROM clan where tag = ? ORDER BY dataTime DESC limit 1'
-        db_data = conn.execute(sql, (clan_tag, )).fetchone()
-        if db_data:
-            db_data_time = datetime.strptime(db_data['dataTime'], '%Y-%m-%d %H:%M:%S')
-            if (datetime.now() - db_data_time).total_seconds() > time_range:
-                fetch_from_api = True
-            else:
-                fetch_from_api = False
-                coc_data = db_data['cocdata']
-        else:
-            fetch_from_api = False
+        fetch_from_api, coc_data = _fresh_clan(conn, clan_tag, time_range)
+        count_cache_decision('clan', hit = not fetch_from_api)
 
         if fetch_from_api:
-            base_api_url = 'https://api.clashofclans.com/v1/clans/%23' + urllib.parse.quote(clan_tag)
-            coc_data, status_code = fetch_coc_api_data(
-                    endpoint = base_api_url,
-                    data_type = 'clan',
-                    tag_value = clan_tag
-                    )
-            clan_data = json.loads(coc_data)
-            if status_code == 200:
-
-                sql = 'INSERT OR REPLACE INTO clan (tag, cocdata) VALUES (?, ?)'
-                conn.execute(sql, (clan_tag, coc_data))
-                conn.commit()
-
-            elif 'error' in clan_data:
-                error_msg = f"unexpected error from coc clan api call of {clan_tag}, status {status_code}: "
-                error_msg += f"{clan_data['error']}"
-                current_app.logger.warning(error_msg)
-            else:
-                current_app.logger.warning(f"unexpected error from coc clan api call of {clan_tag}, status {status_code}")
-                return {'error': f"unexpected error from fetch coc api data call, status {status_code}"}, 500
-
-        return coc_data, status_code
-
-    except json.JSONDecodeError as e:
-        current_app.logger.error(f"clan fetch JSON decoding error for {clan_tag}: {e}\n{traceback.format_exc()}")
-        return {'error': f"clan fetch returned malformed data for {clan_tag}"}, e.code
+            coc_data, status_code = refresh_clan(conn, clan_tag)
+            error = _clan_fetch_error(clan_tag, coc_data, status_code)
+            if error:
+                return error
+        return _clan_fetch_response(clan_tag, coc_data, status_code)
 
     except Exception as e:
-        error_msg = f"player fetch unexpected error occurred {clan_tag}: {e}\n{traceback.format_exc()}"
-        current_app.logger.critical (error_msg)
-        return {'error': 'An unexpected internal server error occured.'}, 500
-
-    finally:
-        close_db()
+        return _clan_fetch_failure(e, clan_tag)
 
+@async_view(clan_bp, 'cocclan')
+async def cocclan_async(db, clan_tag: str, t_range: str = '82801'):
+    time_range = int(t_range)
+    status_code = 200
+    try:
+        fetch_from_api, coc_data = await db.run(_fresh_clan, clan_tag, time_range)
+        count_cache_decision('clan', hit = not fetch_from_api)
 
+        if fetch_from_api:
+            coc_data, status_code = await fetch_async('clan', clan_tag)
+            await db.run(store_clan_result, clan_tag, coc_data, status_code)
+            error = _clan_fetch_error(clan_tag, coc_data, status_code)
+            if error:
+                return error
+        return _clan_fetch_response(clan_tag, coc_data, status_code)
 
+    except Exception as e:
+        return _clan_fetch_failure(e, clan_tag)
 
+@clan_bp.route('/fetch_members/<clan_tag>', defaults={'t_range': '82801'}, methods=['GET'])
+@clan_bp.route('/fetch_members/<clan_tag>/<t_range>', methods=['GET'])
+def fetch_clan_members(clan_tag: str, t_range: str = '82801'):
+    # every member older than t_range seconds in one parallel fetch and one transaction
+    conn = get_db()
+    try:
+        report, status_code = refresh_clan_members(conn, clan_tag, int(t_range))
+    except Exception as e:
+        conn.rollback()
+        current_app.logger.critical(f"clan members fetch unexpected error occurred {clan_tag}: {e}\n{traceback.format_exc()}")
+        return jsonify({'error': 'An unexpected internal server error occured.'}), 500
+    return jsonify(report), status_code
+
+@async_view(clan_bp, 'fetch_clan_members')
+async def fetch_clan_members_async(db, clan_tag: str, t_range: str = '82801'):
+    # all stale members in flight at once, bounded by COC_API_ASYNC_CONNECTIONS
+    try:
+        report, status_code = await refresh_clan_members_async(db, clan_tag, int(t_range))
+    except Exception as e:
+        current_app.logger.critical(f"clan members fetch unexpected error occurred {clan_tag}: {e}\n{traceback.format_exc()}")
+        return jsonify({'error': 'An unexpected internal server error occured.'}), 500
+    return jsonify(report), status_code
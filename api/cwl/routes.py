@@ -1,44 +1,70 @@
 # ./api/cwl/routes.py
 
+import asyncio
+import contextvars
+from concurrent.futures import ThreadPoolExecutor
 from flask import request, jsonify, current_app
 import copy
 from datetime import datetime
 import json
 import traceback
-import urllib.parse
 
 from . import cwl_bp # Import the blueprint instance
-from ...utils.coc_api import fetch_coc_api_data
-from ...utils.db import get_db, close_db # Import common function
+from ...utils.db import get_db # Import common function
+from ...utils.async_views import async_view
+from ...utils.singleflight import hold_leases, hold_leases_async, single_flight, single_flight_async
+from ...utils.response_cache import cached_response, cache_depends
+from ...utils.conditional import conditional, cwl_summary_data_times, latest_data_time
+from ...utils.blobs import decode_blob, load_json
+from ...utils.jsoncodec import dumps, json_response, loads
+from ...utils.metrics import count_cache_decision
+from ...utils.refresh import (fetch_async, fetch_war_tag, fetch_war_tag_async, refresh_cwl_group, store_cwl_group_result,
+                              store_war_tags)
+from ...utils.snapshots import latest_row_sql
+from ...utils.streaming import JsonObject, stream_json
+from ...utils.timing import collecting, current_timings
+from ...utils.wars import (CWL_LIST_SQL, CWL_SEASON_DATA_TIME_SQL, cwl_season_sql, cwl_war_sql, cwl_wars_sql,
+                          latest_cwl_sql)
 
 @cwl_bp.route('/get_cwl_list/<clan_tag>', methods=['GET'])
+@conditional(lambda conn, clan_tag: (latest_data_time(conn, 'clan', clan_tag), latest_data_time(conn, 'clanwarleague', clan_tag)))
+@cached_response
 def get_cwl_list(clan_tag):
     try:
         conn = get_db()
+        cache_depends(('clan', clan_tag), ('cwl', clan_tag))
         # Example: fetch player data (use parameterized queries!)
-        clan_data_row = conn.execute("SELECT cocdata FROM clan WHERE tag = ? ORDER BY dataTime DESC", (clan_tag,)).fetchone()
+        clan_data_row = conn.execute(latest_row_sql('clan', 'cocdata'), (clan_tag,)).fetchone()
         if not clan_data_row:
             current_app.logger.warning(f'get_cwl_list: {clan_tag} no data')
             return jsonify({'error': f'No clan data found for tag: {clan_tag}'}), 404
-        clandata = json.loads(clan_data_row['cocdata'])
+        clandata = load_json(clan_data_row['cocdata'])
         clandata['CWLlist'] = []
-        cwl_entries = conn.execute("SELECT cocdata FROM clanwarleague WHERE tag = ? ORDER BY dataTime DESC limit 6", (clan_tag,)).fetchall()
+        cwl_entries = conn.execute(CWL_LIST_SQL, (clan_tag,)).fetchall()
         for cwl_entry in cwl_entries:
             try:
-                cwl_cocdata = json.loads(cwl_entry['cocdata'])
+                cwl_cocdata = load_json(cwl_entry['cocdata'])
                 if 'season' in cwl_cocdata:
                     clandata['CWLlist'].append(cwl_cocdata['season'])
             except json.JSONDecodeError as e:
                 current_app.logger.warning(f"Error decoding CWL cocdata for tag {clan_tag}: {e}")
-        close_db()
         return jsonify(clandata)
     except Exception as e:
         current_app.logger.warning(f"An unexpected error occurred in CWLlist for {clan_tag}: {e}")
         return jsonify({"error": "An internal server error occurred."}), 500
 
 
+def _cwl_season_data_times(conn, clan_tag: str, req_season: str = None):
+    if req_season:
+        cwl_time = conn.execute(CWL_SEASON_DATA_TIME_SQL, (clan_tag + req_season,)).fetchone()[0]
+    else:
+        row = conn.execute(latest_cwl_sql('dataTime'), (clan_tag,)).fetchone()
+        cwl_time = row[0] if row else None
+    return cwl_time, latest_data_time(conn, 'clan', clan_tag)
+
 @cwl_bp.route('/get_cwl_season_data/<clan_tag>/<req_season>', methods=['GET'])
 @cwl_bp.route('/get_cwl_season_data/<clan_tag>', defaults={'req_season': None},  methods=['GET'])
+@conditional(_cwl_season_data_times)
 def db_clanwarleague(clan_tag, req_season: str = None):
     cwl_data, status_code = _get_cwl_data_from_db(clan_tag, req_season)
     return jsonify(cwl_data), status_code
@@ -50,15 +76,13 @@ def _get_cwl_data_from_db(clan_tag: str, req_season: str = None):
 
     try:
         if req_season:
-            sql = 'SELECT cocdata FROM clanwarleague where clanSeason = ? limit 1'
-            db_data = conn.execute(sql, (clan_tag + req_season,)).fetchone()
+            db_data = conn.execute(cwl_season_sql('cocdata'), (clan_tag + req_season,)).fetchone()
         else:
-            sql = 'SELECT cocdata FROM clanwarleague where tag = ? ORDER BY clanSeason DESC limit 1'
-            db_data = conn.execute(sql, (clan_tag,)).fetchone()
+            db_data = conn.execute(latest_cwl_sql('cocdata'), (clan_tag,)).fetchone()
 
         if db_data:
             try:
-                cwl_data = json.loads(bytes(db_data['cocdata']).decode('utf-8'))
+                cwl_data = load_json(db_data['cocdata'])
                 current_app.logger.info(f"CWL group data for clan {clan_tag} season {req_season or 'latest'} loaded from DB.")
             except json.JSONDecodeError as e:
                 error_msg = f"JSON decode error for cached CWL group data {clan_tag} season: {req_season or 'latest'} : {e}\n"
@@ -76,10 +100,10 @@ def _get_cwl_data_from_db(clan_tag: str, req_season: str = None):
 
         # clandata = read_clan_data(ClanTag)
         if cwl_data and 'state' in cwl_data:
-            sql = 'SELECT * FROM clan where tag = ? ORDER BY dataTime DESC limit 1'
+            sql = latest_row_sql('clan', '*')
             data = conn.execute(sql, (clan_tag,)).fetchone()
             if data:
-                cwl_data['name'] = json.loads(data['cocdata'])
+                cwl_data['name'] = load_json(data['cocdata'])
                 status_code = 200
             else:
                 current_app.logger.warning (f"get_cwl_season_data {clan_tag} no clan data")
@@ -87,97 +111,175 @@ def _get_cwl_data_from_db(clan_tag: str, req_season: str = None):
         error_msg = f"Critical error in _get_cwl_data_from_db for {clan_tag}: {e}\n{traceback.format_exc()}"
         current_app.logger.critical(error_msg)
         cwl_data = {'error': 'An internal server error occurred while retrieving CWL group data.'}
-    finally:        
-        close_db()
     return cwl_data, status_code
 
 
 @cwl_bp.route('/wartag/<war_tag>/<season>', methods=['GET'])
 def db_wartag(war_tag, season):
     war_data, status_code = _get_war_data_cached_or_api(war_tag, season)
-    return war_data, status_code
+    return json_response(war_data, status_code)
+
+@async_view(cwl_bp, 'db_wartag')
+async def db_wartag_async(db, war_tag, season):
+    raw = {}
+    war_tags, results, to_fetch = await db.run(_plan_war_data, [war_tag], season, raw)
+    if to_fetch:
+        async with hold_leases_async(db):
+            fetched = dict(zip(to_fetch, await asyncio.gather(*(_fetch_war_data_coalesced_async(db, tag, season) for tag in to_fetch))))
+            await db.run(_finish_war_data, war_tags, season, results, fetched, raw)
+    war_data, status_code = results[war_tag]
+    return json_response(raw.get(war_tag) or dumps(war_data), status_code)
 
 def _get_war_data_cached_or_api(war_tag: str, season: str):
-    # return_data = None or json dumps data, status_code = 200
-    conn = get_db()
-    return_data = None
-    status_code = 200
+    # return_data = json dumps data, status_code
+    raw = {}
+    war_data, status_code = _resolve_war_data([war_tag], season, raw)[war_tag]
+    return raw.get(war_tag) or dumps(war_data), status_code
+
+def _load_cached_wars(conn, war_tags, season: str):
+    # {war_tag: (decoded war_data, dataTime, JSON bytes)} for every war tag with a usable cache row
+    cached = {}
+    for db_record in conn.execute(cwl_wars_sql(len(war_tags)), [season + war_tag for war_tag in war_tags]):
+        war_tag = db_record['seasonWarTag'][len(season):]
+        try:
+            coc_data = decode_blob(db_record['cocdata'])
+            cached[war_tag] = (loads(coc_data), db_record['dataTime'], coc_data)
+        except json.JSONDecodeError as e:
+            error_msg = f"DB cached war_data JSON decode error for seasonWarTag {season + war_tag}: {e}\n"
+            error_msg += f"{traceback.format_exc()}"
+            current_app.logger.error(error_msg)
+        except Exception as e:
+            error_msg = f"Unexpected error processing DB cached war_data for seasonWarTag {season + war_tag}: {e}\n"
+            error_msg += f"{traceback.format_exc()}" 
+            current_app.logger.error(error_msg)
+    return cached
+
+def _war_data_error(e, war_tags, season: str, results: dict):
+    error_msg = f"Unexpected error in db_wartag for {', '.join(war_tags)} season {season}: {e}\n{traceback.format_exc()}"
+    current_app.logger.critical(error_msg)
+    error_data = {'error': 'An internal server error occurred while retrieving war data.'}
+    for war_tag in war_tags:
+        results.setdefault(war_tag, (error_data, 500))
+
+def _plan_war_data(conn, war_tags, season: str, raw: dict = None):
+    # (unique war tags, {war_tag: result served from cwlwarlog}, war tags to fetch)
+    war_tags = list(dict.fromkeys(war_tags))
+    results = {}
+    to_fetch = []
     try:
-        sql = 'SELECT cocdata, dataTime FROM cwlwarlog where seasonWarTag = ? '
-        db_record = conn.execute(sql, (season + war_tag,)).fetchone()
-
-        if db_record:
-            try:
-                return_data = db_record['cocdata']
-                return_data = json.loads(bytes(return_data).decode('utf-8'))
-                cache_hit = True
-            except json.JSONDecodeError as e:
-                error_msg = f"DB cached war_data JSON decode error for seasonWarTag {season + war_tag}: {e}\n"
-                error_msg += f"{traceback.format_exc()}"
-                current_app.logger.error(error_msg)
-                cache_hit = False
-            except Exception as e:
-                error_msg = f"Unexpected error processing DB cached war_data for seasonWarTag {season + war_tag}: {e}\n"
-                error_msg += f"{traceback.format_exc()}" 
-                current_app.logger.error(error_msg)
-                cache_hit = False
-        else:
-            cache_hit = False
+        cached = _load_cached_wars(conn, war_tags, season)
+        for war_tag in war_tags:
+            if war_tag not in cached:
+                current_app.logger.info(f"No cached data found for {war_tag} season {season}, fetching from CoC API.")
+                count_cache_decision('wartag', hit = False)
+                to_fetch.append(war_tag)
+                continue
 
-        if cache_hit:
-            data_time = datetime.strptime(db_record['dataTime'], '%Y-%m-%d %H:%M:%S') 
-            time_since_last_fetch = (datetime.now() - data_time).total_seconds()
-            war_state = return_data.get('state', None)
+            war_data, data_time, coc_data = cached[war_tag]
+            time_since_last_fetch = (datetime.now() - datetime.strptime(data_time, '%Y-%m-%d %H:%M:%S')).total_seconds()
+            war_state = war_data.get('state', None)
 
             if time_since_last_fetch > 300 and \
                 war_state not in ['warEnded', 'notInWar']:
                 current_app.logger.info(f"Cached data for {war_tag} season {season} is stale or not final; refreshing.")
-                return_data, status_code = _fetch_and_store_war_data(war_tag, season) # Fallback to fetching from CoC API
-                return_data = json.loads(return_data)
+                count_cache_decision('wartag', hit = False)
+                to_fetch.append(war_tag)
             else:
                 error_msg = f"Serving {war_tag} season {season} from cache (state: {war_state}, "
                 error_msg += f"age: {int(time_since_last_fetch)}s)."
                 current_app.logger.info(error_msg)
-                status_code = 200
-        else:
-            current_app.logger.info(f"No cached data found for {war_tag} season {season}, fetching from CoC API.")
-            return_data, satus_code = _fetch_and_store_war_data(war_tag, season) # Fallback to fetching from CoC API
-            return_data = json.loads(return_data)
+                count_cache_decision('wartag', hit = True)
+                results[war_tag] = (war_data, 200)
+                if raw is not None:
+                    raw[war_tag] = coc_data
+    except Exception as e:
+        _war_data_error(e, war_tags, season, results)
+        to_fetch = []
+    return war_tags, results, to_fetch
 
+def _finish_war_data(conn, war_tags, season: str, results: dict, fetched: dict, raw: dict = None):
+    # store `fetched` and add it to `results`
+    try:
+        store_war_tags(conn, season, fetched)
+        for war_tag, (api_response_data, status_code, _) in fetched.items():
+            results[war_tag] = (loads(api_response_data), status_code)
+            if raw is not None:
+                raw[war_tag] = api_response_data
     except Exception as e:
-        error_msg = f"Unexpected error in db_wartag for {war_tag} season {season}: {e}\n{traceback.format_exc()}"
-        current_app.logger.critical(error_msg)
-        return_data = {'error': 'An internal server error occurred while retrieving war data.'}
-        status_code = 500
+        _war_data_error(e, war_tags, season, results)
+    return results
+
+def _resolve_war_data(war_tags, season: str, raw: dict = None):
+    """
+    Return {war_tag: (war_data dict, status_code)} for `war_tags`. Fresh or final
+    wars are served from cwlwarlog, every other one is fetched from the CoC API
+    in parallel (at most CWL_FETCH_CONCURRENCY calls in flight) and the results
+    are written back in a single transaction. Their single-flight leases are
+    held until it committed, so another process waiting on one reads the
+    stored war. A `raw` dict receives the JSON bytes each war was parsed from,
+    for callers that send it on unchanged.
+    """
+    conn = get_db()
+    war_tags, results, to_fetch = _plan_war_data(conn, war_tags, season, raw)
+    if not to_fetch:
+        return results
+    with hold_leases(conn):
+        try:
+            fetched = _fetch_war_data_parallel(to_fetch, season)
+        except Exception as e:
+            _war_data_error(e, war_tags, season, results)
+            return results
+        return _finish_war_data(conn, war_tags, season, results, fetched, raw)
+
+def _stored_war_data(conn, war_tag: str, season: str):
+    # stored war as (cocdata, 200), None if there is none
+    db_record = conn.execute(cwl_war_sql('cocdata'), (season + war_tag,)).fetchone()
+    if not db_record:
+        return None
+    return decode_blob(db_record['cocdata']), 200
+
+def _fetch_war_data_coalesced(war_tag: str, season: str):
+    # (json dump data, status_code, refreshed), refreshed is False when another caller's fetch was shared
+    conn = get_db()
+    (api_response_data, status_code), refreshed = single_flight(
+            conn,
+            endpoint = 'wartag',
+            tag = season + war_tag,
+            refresh = lambda: fetch_war_tag(war_tag, season),
+            stale = lambda: _stored_war_data(conn, war_tag, season)
+            )
+    return api_response_data, status_code, refreshed
+
+async def _fetch_war_data_coalesced_async(db, war_tag: str, season: str):
+    (api_response_data, status_code), refreshed = await single_flight_async(
+            db,
+            endpoint = 'wartag',
+            tag = season + war_tag,
+            refresh = lambda: fetch_war_tag_async(war_tag, season),
+            stale = lambda conn: _stored_war_data(conn, war_tag, season)
+            )
+    return api_response_data, status_code, refreshed
 
-    finally:
-        close_db()
-    #error_msg = f"return_data {type(return_data)}"
-    #current_app.logger.info(error_msg)
-    return json.dumps(return_data), status_code
+def _fetch_war_data_parallel(war_tags, season: str):
+    # {war_tag: (json dump data, status_code, refreshed)}, one worker thread per API call up to the cap
+    if len(war_tags) <= 1:
+        return {war_tag: _fetch_war_data_coalesced(war_tag, season) for war_tag in war_tags}
+
+    app = current_app._get_current_object()
+    timings = current_timings()
+
+    def fetch(war_tag):
+        with app.app_context(), collecting(timings):
+            return _fetch_war_data_coalesced(war_tag, season)
+
+    max_workers = min(len(war_tags), max(1, int(app.config.get('CWL_FETCH_CONCURRENCY', 8))))
+    with ThreadPoolExecutor(max_workers = max_workers) as executor:
+        # each call in a copy of this context, the leases join the caller's hold_leases() block
+        futures = [executor.submit(contextvars.copy_context().run, fetch, war_tag) for war_tag in war_tags]
+        return {war_tag: future.result() for war_tag, future in zip(war_tags, futures)}
 
-def _fetch_and_store_war_data(war_tag: str, season: str):
-    # return json dump data, status_code
-    conn = get_db()
-    current_season = str(datetime.now())[:7]
-    base_api_url = 'https://api.clashofclans.com/v1/clanwarleagues/wars/%23' + urllib.parse.quote(war_tag)
-    if current_season == season:
-        api_response_data, status_code = fetch_coc_api_data(
-                endpoint = base_api_url,
-                data_type = 'WarTag',
-                tag_value = war_tag
-                )
-        if status_code == 200:
-            sql = 'INSERT OR REPLACE INTO cwlwarlog (seasonWartag, wartag, cocdata) VALUES (?, ?, ?)'
-            conn.execute(sql, (season + war_tag, war_tag, api_response_data))
-            conn.commit()
-            current_app.logger.info(f"wartag db successfully updated {war_tag} {season}")
-        return api_response_data, status_code
-    else:
-        return json.dumps({'error': f"Not current season {season} {war_tag}"}), 500
-         
- 
 @cwl_bp.route('/summary/<clan_tag>/<season>', methods=['GET'])
+@cached_response(probe = cwl_summary_data_times)
 def cwl_summary(clan_tag: str, season: str):
     cwl_data, cwl_status_code = _get_cwl_data_from_db(clan_tag, season)
     #data, status = db_clanwarleague(clan_tag, season)
@@ -208,18 +310,23 @@ def cwl_summary(clan_tag: str, season: str):
             'memberlist': memberlist
         }
 
-    # Populate attack data from individual war tags into clan_list
+    # Resolve every war tag up front so cache misses are fetched concurrently
+    war_tags = [wartag_full[1:] for round_detail in cwl_data.get('rounds', [])
+                for wartag_full in round_detail.get('warTags', []) if wartag_full != "#0"]
+    wars = _resolve_war_data(war_tags, cwl_data['season']) if war_tags else {}
+    cache_depends(('clan', clan_tag), ('cwl', clan_tag), *(('wartag', cwl_data['season'] + war_tag) for war_tag in war_tags))
+    if any(war_data.get('state') not in ['warEnded', 'notInWar'] for war_data, _ in wars.values()):
+        # wars still running are refreshed after 300s by _resolve_war_data
+        cache_depends(ttl = 300)
+
+    # Populate attack data from individual war tags into clan_list, in round order
     for round_detail in cwl_data.get('rounds', []):
         day = round_detail['day']
         for wartag_full in round_detail.get('warTags', []):
             if wartag_full == "#0": # Skip dummy war tags
                 continue
 
-            # Call the internal helper function to get war data
-            war_data, war_status_code = _get_war_data_cached_or_api(wartag_full[1:], cwl_data['season'])
-            # error_msg = f"{type(war_data)}"
-            # current_app.logger.info(error_msg)
-            war_data = json.loads(war_data)
+            war_data, war_status_code = wars[wartag_full[1:]]
 
             if war_status_code == 200 and war_data:
                 # Ensure the war_data has expected keys before accessing
@@ -254,6 +361,9 @@ def cwl_summary(clan_tag: str, season: str):
                 error_msg += f"Status {war_status_code}, Error: {war_data.get('error', 'N/A')}"
                 current_app.logger.warning(error_msg)
 
+    # the member copies hold what the summary needs from the wars
+    del wars
+
     # Work out each member's mapPosition sequence for sorting
     for clantag_in_list, c_data in clan_list.items():
 
@@ -305,54 +415,51 @@ def cwl_summary(clan_tag: str, season: str):
             member_summary['averagestar'] = "{:.2f}".format(total_star / attack_count)
             member_summary['averagepercentage'] = "{:.2f}".format(total_percentage / attack_count)
 
-    cwl_data['clanlist'] = clan_list
+    # every clan is encoded and sent on its own, in jsonify's key order
+    cwl_data['clanlist'] = JsonObject(sorted(clan_list.items()))
     cwl_data['clansummary'] = clansummary_data # Assign the correctly calculated summary
 
-    return jsonify(cwl_data), 200 # Always return jsonify and a status code
-
-@cwl_bp.route('/fetch/<clan_tag>', methods=['GET'])
-def read_from_coccwl(clan_tag: str):
-    conn = get_db()
-    try:
-        base_api_url = 'https://api.clashofclans.com/v1/clans/%23' + urllib.parse.quote(clan_tag) + '/currentwar/leaguegroup' 
-        api_response_data, status_code = fetch_coc_api_data(
-                endpoint = base_api_url,
-                data_type = 'cwl',
-                tag_value = clan_tag
-                )
-
-        cwl_data = json.loads(api_response_data)
-        if status_code == 200:
-            if 'season' in cwl_data:
-                season = cwl_data['season']
-                sql = 'INSERT OR REPLACE INTO clanwarleague (clanSeason, tag, cocdata, season) VALUES (?, ?, ?, ?)'
-                conn.execute(sql, (clan_tag + season, clan_tag, api_response_data, season)) 
-                conn.commit()
-            else:
-                error_msg = f"season missing in coc cwl api call of {clan_tag}"
-                current_app.logger.warning(error_msg)
-                cwl_data['error'] = error_msg
+    return stream_json(cwl_data)
 
-        elif 'error' in cwl_data:
-            error_msg = f"unexpected error from coc cwl api call of {clan_tag}, status {status_code}: "
-            error_msg += f"{cwl_data['error']}"
+def _cwl_group_response(clan_tag: str, api_response_data, status_code: int):
+    cwl_data = loads(api_response_data)
+    if status_code == 200:
+        if 'season' not in cwl_data:
+            error_msg = f"season missing in coc cwl api call of {clan_tag}"
             current_app.logger.warning(error_msg)
-        else:
-            current_app.logger.warning(f"unexpected error from coc cwl api call of {clan_tag}, status {status_code}")
-            cwl_data['error'] = f"unexpected error from fetch coc api data call, status {status_code}"
+            cwl_data['error'] = error_msg
 
-        return jsonify(cwl_data), status_code
+    elif 'error' in cwl_data:
+        error_msg = f"unexpected error from coc cwl api call of {clan_tag}, status {status_code}: "
+        error_msg += f"{cwl_data['error']}"
+        current_app.logger.warning(error_msg)
+    else:
+        current_app.logger.warning(f"unexpected error from coc cwl api call of {clan_tag}, status {status_code}")
+        cwl_data['error'] = f"unexpected error from fetch coc api data call, status {status_code}"
 
+    return jsonify(cwl_data), status_code
 
-    except json.JSONDecodeError as e:
+def _cwl_fetch_failure(e, clan_tag: str):
+    if isinstance(e, json.JSONDecodeError):
         current_app.logger.error(f"cwl fetch JSON decoding error for {clan_tag}: {e}\n{traceback.format_exc()}")
         return {'error': f"cwl fetch returned malformed data for {clan_tag}"}, e.code
+    error_msg = f"cwl fetch unexpected error occurred {clan_tag}: {e}\n{traceback.format_exc()}"
+    current_app.logger.critical (error_msg)
+    return {'error': 'An unexpected internal server error occured.'}, 500
 
+@cwl_bp.route('/fetch/<clan_tag>', methods=['GET'])
+def read_from_coccwl(clan_tag: str):
+    conn = get_db()
+    try:
+        return _cwl_group_response(clan_tag, *refresh_cwl_group(conn, clan_tag))
     except Exception as e:
-        error_msg = f"cwl fetch unexpected error occurred {clan_tag}: {e}\n{traceback.format_exc()}"
-        current_app.logger.critical (error_msg)
-        return {'error': 'An unexpected internal server error occured.'}, 500
-
-    finally:
-        close_db()
+        return _cwl_fetch_failure(e, clan_tag)
 
+@async_view(cwl_bp, 'read_from_coccwl')
+async def read_from_coccwl_async(db, clan_tag: str):
+    try:
+        api_response_data, status_code = await fetch_async('cwl', clan_tag)
+        await db.run(store_cwl_group_result, clan_tag, api_response_data, status_code)
+        return _cwl_group_response(clan_tag, api_response_data, status_code)
+    except Exception as e:
+        return _cwl_fetch_failure(e, clan_tag)
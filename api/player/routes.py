@@ -9,8 +9,19 @@ import traceback
 import urllib.request
 
 from . import player_bp # Import the blueprint instance
-from ...utils.db import get_db, close_db # Import common function
-from ...utils.coc_api import fetch_coc_api_data
+from ...utils.archive import player_rows
+from ...utils.db import get_db # Import common function
+from ...utils.history import daily_points, iter_upgrade_progress, load_snapshot_metrics
+from ...utils.ingest import ACHIEVEMENT_PREFIX
+from ...utils.async_views import async_view
+from ...utils.refresh import fetch_async, refresh_player, store_player_result
+from ...utils.response_cache import cached_response, cache_depends
+from ...utils.conditional import conditional, latest_seen, start_of_today
+from ...utils.blobs import decode_blob, load_json
+from ...utils.jsoncodec import json_response, loads
+from ...utils.metrics import count_cache_decision
+from ...utils.snapshots import SNAPSHOT_AT_SQL, latest_row_sql, load_player_snapshot
+from ...utils.streaming import JsonObject, stream_json
 
 progressItem = {'warStars':1,
     'attackWins':1,
@@ -18,8 +29,17 @@ progressItem = {'warStars':1,
     'donationsReceived':1}
 
 
+def _player_info_data_times(conn, player_tag: str, from_date: str):
+    if from_date:
+        return latest_seen(conn, 'player', player_tag, from_date + ' 23:59:59')
+    # the history dates count back from today
+    return *latest_seen(conn, 'player', player_tag), start_of_today()
+
+
 @player_bp.route('/get_player_info/<player_tag>', defaults={'from_date': None}, methods=['GET'])
 @player_bp.route('/get_player_info/<player_tag>/<string:from_date>', methods=['GET'])
+@conditional(_player_info_data_times)
+@cached_response
 def get_player_info(player_tag, from_date:None):
     conn = None # Initialize conn to None
     if from_date:
@@ -30,12 +50,20 @@ def get_player_info(player_tag, from_date:None):
  
     try: 
         conn = get_db()
-        sql = "SELECT cocdata, dataTime  FROM player where tag = ? and dataTime <= ?  ORDER BY dataTime DESC Limit ?"
-        data = conn.execute(sql, (player_tag, from_start_date, date_range,)).fetchall()
-        if not data:
+        if from_date:
+            cache_depends(('player', player_tag))
+        else:
+            # the history dates count back from today
+            tomorrow = datetime.combine(datetime.now().date() + timedelta(days=1), datetime.min.time())
+            cache_depends(('player', player_tag), ttl = (tomorrow - datetime.now()).total_seconds())
+        # a from_date past PLAYER_HOT_DAYS reads on into the archived history
+        rows = player_rows(conn, player_tag, 'dataTime, lastSeen', from_start_date, date_range)
+        points = daily_points(rows, from_start_date)[:date_range]
+        if not points:
             current_app.logger.warning(f"get_player_info: {player_tag} no data") 
             return jsonify({'error': f"no player data found for tag: {player_tag}"}),404
-        player_data = json.loads(data[0]['cocdata'])
+        # an older snapshot may be delta encoded, rebuild it from its keyframe
+        player_data = load_player_snapshot(conn, player_tag, points[0][1])
         player_data['DateRange'] = date_range
         player_data['playerprogress'] = {}
         player_data['playerprogress']['history'] = []
@@ -45,146 +73,104 @@ def get_player_info(player_tag, from_date:None):
             d = history_date - timedelta(days=x)
             player_data['playerprogress']['history'].append(d.strftime("%Y-%m-%d"))
 
-        # sql = 'SELECT cocdata, dataTime FROM player where tag = ? and dataTime < ? ORDER BY dataTime DESC Limit ?'
-        # data = conn.execute(sql, (player_tag, from_start_date, date_range,)).fetchall()
+        # counters and achievements come from the narrow player_metric rows written at ingest
         working = {}
-        for data_row in data: 
-            try:
-                player_data_row = json.loads(data_row['cocdata'])
-                data_time_row = data_row['dataTime'][:10]
-                player_data['playerprogress'][data_time_row] = {}
-                for item in progressItem:
-                    if item in working:
-                        player_data['playerprogress'][data_time_row][item] = working[item] - player_data_row[item]
-                    else:
-                        player_data['playerprogress'][data_time_row][item] = player_data_row[item]
-                    working[item] = player_data_row[item]
-                for achievement in player_data_row.get('achievements', []):
-                    if achievement['name'] in working:
-                        player_data['playerprogress'][data_time_row][achievement['name']] = working[achievement['name']] - achievement['value']
-                    else:
-                        player_data['playerprogress'][data_time_row][achievement['name']] = achievement['value']
-                    working[achievement['name']] = achievement['value']
-            except json.JSONDecodeError as e:
-                current_app.logger.warning(f"get_player_info: Failed to decode cocdata for player {player_tag} at {data_row['dataTime']}: {e}")
-                continue # Skip this malformed record and continue with others
+        snapshot_metrics = dict(load_snapshot_metrics(conn, player_tag, list({data_time for _, data_time in points})))
+        # days a fetch found the snapshot unchanged repeat its metrics
+        for point_time, data_time in points:
+            metrics = snapshot_metrics[data_time]
+            if not metrics:
+                current_app.logger.warning(f"get_player_info: no metrics for player {player_tag} at {point_time}")
+                continue # Skip this snapshot and continue with others
+            data_time_row = point_time[:10]
+            player_data['playerprogress'][data_time_row] = {}
+            for name, value in metrics.items():
+                if name in progressItem:
+                    item = name
+                elif name.startswith(ACHIEVEMENT_PREFIX):
+                    item = name[len(ACHIEVEMENT_PREFIX):]
+                else:
+                    continue
+                if item in working:
+                    player_data['playerprogress'][data_time_row][item] = working[item] - value
+                else:
+                    player_data['playerprogress'][data_time_row][item] = value
+                working[item] = value
         return jsonify(player_data)
     except Exception as e:
         current_app.logger.error(f"An unexpected error occurred in get_player_info for {player_tag}: {e}\n{traceback.format_exc()}")
         return jsonify({"error": "An internal server error occurred."}), 500
-    finally:
-        close_db()
-
-
 
 
 @player_bp.route('/get_player_progress_data/<player_tag>', methods=['GET'])
+@conditional(lambda conn, player_tag: latest_seen(conn, 'player', player_tag))
+@cached_response
 def get_player_progress_data(player_tag):
     date_range = 360
     conn = get_db()
+    cache_depends(('player', player_tag))
 
-    sql = "SELECT cocdata, dataTime FROM player where tag = ? ORDER BY dataTime DESC limit ?"
-    data = conn.execute(sql, (player_tag, date_range + 1,)).fetchall()
+    # the hot store holds PLAYER_HOT_DAYS, the rest of the year comes from the archive partitions
+    points = daily_points(player_rows(conn, player_tag, 'dataTime, lastSeen', limit = date_range + 1))[:date_range + 1]
+    # the snapshots behind the newest date_range + 1 daily points
+    data_times = list(dict.fromkeys(data_time for _, data_time in points))
 
-    if not data:
+    if not data_times:
         current_app.logger.info(f"get_player_progress_data: {player_tag} no data") 
         return jsonify({'error': f"no player data found for tag: {player_tag}"}), 404
 
     try:
-        player_data = json.loads(data[0]['cocdata'])
+        data = conn.execute(SNAPSHOT_AT_SQL.format('player'), (player_tag, data_times[0],)).fetchone()
+        player_data = load_json(data['cocdata'])
     except Exception as e:
         current_app.logger.error(f"An unexpected error occurred in json loads for {player_tag}: {e}\n{traceback.format_exc()}")
         return jsonify({"error": "An internal server error occurred."}), 500
 
     player_data['upgradeprogress_list'] = []
 
-    parsed_data = []
-    for row in reversed(data):
-        try:
-            parsed_data.append({
-                'cocdata': json.loads(row['cocdata']),
-                'dataTime': row['dataTime'][:10]
-            })
-        except json.JSONDecodeError as e:
-            current_app.logger.warning(f"Skipping malformed data for {player_tag} at {row['dataTime']}: {e}")
-            continue
-
-    if len(parsed_data) < 2:
+    if len(data_times) < 2:
         current_app.logger.info(f"get_player_progress_data: Not enough historical data for {player_tag} to track progress.")
         return jsonify(player_data)
 
-    previous_state = {
-        'home': {'townHallLevel': parsed_data[0]['cocdata'].get('townHallLevel', 0)},
-        'builderBase': {'builderHallLevel': parsed_data[0]['cocdata'].get('builderHallLevel', 0)}
-    }
-    if 'townHallWeaponLevel' in parsed_data[0]['cocdata']:
-        previous_state['home']['townHallWeaponLevel'] = parsed_data[0]['cocdata']['townHallWeaponLevel']
-
-    for item_type in ['spells', 'troops', 'heroes']:
-        for item in parsed_data[0]['cocdata'].get(item_type, []):
-            if item.get('name') and item['name'][:5] != 'Super':
-                previous_state[item.get('village', 'home')][item['name']] = item.get('level', 0)
-
-    for i in range(1, len(parsed_data)):
-        current_row = parsed_data[i]
-        current_data = current_row['cocdata']
-        current_date_str = current_row['dataTime']
-
-        upgrade_found = False
-        daily_upgrades = {'date': current_date_str, 'home': {}, 'builderBase': {}}
-
-        current_th_level = current_data.get('townHallLevel', 0)
-        if current_th_level != previous_state['home']['townHallLevel']:
-            daily_upgrades['home']['townHallLevel'] = current_th_level
-            upgrade_found = True
-        previous_state['home']['townHallLevel'] = current_th_level
-
-        current_bh_level = current_data.get('builderHallLevel', 0)
-        if current_bh_level != previous_state['builderBase']['builderHallLevel']:
-            daily_upgrades['builderBase']['builderHallLevel'] = current_bh_level
-            upgrade_found = True
-        previous_state['builderBase']['builderHallLevel'] = current_bh_level
-
-        current_thw_level = current_data.get('townHallWeaponLevel')
-        if current_thw_level is not None:
-            if 'townHallWeaponLevel' in previous_state['home']:
-                if current_thw_level != previous_state['home']['townHallWeaponLevel']:
-                    daily_upgrades['home']['townHallWeaponLevel'] = current_thw_level
-                    upgrade_found = True
-            else:
-                daily_upgrades['home']['townHallWeaponLevel'] = current_thw_level
-                upgrade_found = True
-            previous_state['home']['townHallWeaponLevel'] = current_thw_level
-        
-        for item_type in ['spells', 'troops', 'heroes']:
-            for current_item in current_data.get(item_type, []):
-                item_name = current_item.get('name')
-                item_village = current_item.get('village', 'home')
-                item_level = current_item.get('level', 0)
-
-                if item_name and item_name[:5] != 'Super':
-                    prev_level = previous_state[item_village].get(item_name, 0)
-
-                    if item_level != prev_level:
-                        daily_upgrades[item_village][item_name] = item_level
-                        upgrade_found = True
-                    previous_state[item_village][item_name] = item_level
-
-        if upgrade_found:
-            final_entry = {'date': daily_upgrades['date']}
-            if daily_upgrades['home']:
-                final_entry['home'] = daily_upgrades['home']
-            if daily_upgrades['builderBase']:
-                final_entry['builderBase'] = daily_upgrades['builderBase']
-            player_data['upgradeprogress_list'].append(final_entry)
-
-    player_data['upgradeprogress_list'].sort(key=lambda x: x['date'], reverse=True)
-    player_data['upgradeprogress'] = { entry['date']: {k:v for k,v in entry.items() if k != 'date'} 
-                                      for entry in player_data['upgradeprogress_list']}
+    # upgrade events are diffed once at ingest, the oldest snapshot in range is the baseline;
+    # they are streamed day by day from the cursor, the dates sort the same as jsonify's keys
     del player_data['upgradeprogress_list']
+    player_data['upgradeprogress'] = JsonObject(iter_upgrade_progress(conn, player_tag, data_times[-1], data_times[0]))
+    return stream_json(player_data)
+
+
+def _fresh_player(conn, player_tag: str, time_range: int):
+    # stored cocdata of a player fetched within time_range seconds, None if it needs a fetch
+    sql = latest_row_sql('player', 'cocdata, dataTime, lastSeen')
+    db_data = conn.execute(sql, (player_tag, )).fetchone()
+    if db_data:
+        # an unchanged payload only moves lastSeen, it is as fresh as the last fetch
+        db_data_time = datetime.strptime(db_data['lastSeen'] or db_data['dataTime'], '%Y-%m-%d %H:%M:%S')
+        if (datetime.now() - db_data_time).total_seconds() <= time_range:
+            return decode_blob(db_data['cocdata'])
+    return None
+
+
+def _fetch_error(coc_data, status_code: int):
+    # the response for a failed fetch whose answer carries no error of its own, else None
+    if status_code != 200:
+        player_data = loads(coc_data)
+        if 'error' in player_data:
+            error_msg = f"unexpected error from coc api call, status {status_code}: {player_data['error']}"
+            current_app.logger.warning(error_msg)
+        else:
+            current_app.logger.warning(f"unexpected error from coc api call, status {status_code}")
+            return {'error': f"unexpected error from fetch coc api data call, status {status_code}"}, 500
+    return None
+
 
-    close_db()
-    return jsonify(player_data)
+def _fetch_failure(e, player_tag: str):
+    if isinstance(e, json.JSONDecodeError):
+        current_app.logger.error(f"player fetch JSON decoding error for {player_tag}: {e}\n{traceback.format_exc()}")
+        return {'error': f"player fetch returned malformed data for {player_tag}"}, e.code
+    error_msg = f"player fetch unexpected error occurred {player_tag}: {e}\n{traceback.format_exc()}"
+    current_app.logger.critical (error_msg)
+    return {'error': 'An unexpected internal server error occured.'}, 500
 
 
 @player_bp.route('/fetch/<player_tag>', defaults={'t_range': '82800'}, methods=['GET'])
@@ -194,51 +180,35 @@ def cocplayer(player_tag: str, t_range: str = '82800'):
     conn = get_db()
     status_code = 200
     try:
-        sql = 'SELECT cocdata, dataTime FROM player where tag = ? ORDER BY dataTime DESC limit 1'
-        db_data = conn.execute(sql, (player_tag, )).fetchone()
-        if db_data:
-            db_data_time = datetime.strptime(db_data['dataTime'], '%Y-%m-%d %H:%M:%S')
-            if (datetime.now() - db_data_time).total_seconds() > time_range:
-                fetch_from_api = True
-            else:
-                fetch_from_api = False
-                coc_data = db_data['cocdata']
-        else:
-            fetch_from_api = True
-        if fetch_from_api:
-            base_api_url = 'https://api.clashofclans.com/v1/players/%23' + urllib.parse.quote(player_tag)
-            coc_data, status_code = fetch_coc_api_data(
-                    endpoint = base_api_url,
-                    data_type = 'player',
-                    tag_value = player_tag
-                    )
-            player_data = json.loads(coc_data)
-            if status_code == 200:
-
-                sql = 'INSERT OR REPLACE INTO player (tag, cocdata) VALUES (?, ?)'
-                conn.execute(sql, (player_tag, coc_data))
-                conn.commit()
-
-            elif 'error' in player_data:
-                error_msg = f"unexpected error from coc api call, status {status_code}: {player_data['error']}"
-                current_app.logger.warning(error_msg)
-            else:
-                current_app.logger.warning(f"unexpected error from coc api call, status {status_code}")
-                return {'error': f"unexpected error from fetch coc api data call, status {status_code}"}, 500
-
-        return coc_data, status_code
-
-    except json.JSONDecodeError as e:
-        current_app.logger.error(f"player fetch JSON decoding error for {player_tag}: {e}\n{traceback.format_exc()}")
-        return {'error': f"player fetch returned malformed data for {player_tag}"}, e.code
+        coc_data = _fresh_player(conn, player_tag, time_range)
+        count_cache_decision('player', hit = coc_data is not None)
+        if coc_data is None:
+            coc_data, status_code = refresh_player(conn, player_tag)
+            error = _fetch_error(coc_data, status_code)
+            if error:
+                return error
 
-    except Exception as e:
-        error_msg = f"player fetch unexpected error occurred {player_tag}: {e}\n{traceback.format_exc()}"
-        current_app.logger.critical (error_msg)
-        return {'error': 'An unexpected internal server error occured.'}, 500
+        # the stored or fetched JSON goes out as it is, never parsed and encoded again
+        return json_response(coc_data, status_code)
 
-    finally:
-        close_db()
+    except Exception as e:
+        return _fetch_failure(e, player_tag)
 
 
+@async_view(player_bp, 'cocplayer')
+async def cocplayer_async(db, player_tag: str, t_range: str = '82800'):
+    time_range = int(t_range)
+    status_code = 200
+    try:
+        coc_data = await db.run(_fresh_player, player_tag, time_range)
+        count_cache_decision('player', hit = coc_data is not None)
+        if coc_data is None:
+            coc_data, status_code = await fetch_async('player', player_tag)
+            await db.run(store_player_result, player_tag, coc_data, status_code)
+            error = _fetch_error(coc_data, status_code)
+            if error:
+                return error
+        return json_response(coc_data, status_code)
 
+    except Exception as e:
+        return _fetch_failure(e, player_tag)
@@ -0,0 +1,198 @@
+# app/asgi.py
+# ASGI entry point, the same app and blueprints as under mod_wsgi:
+#   uvicorn cocapi20250719.asgi:application --workers 4
+# Endpoints with a coroutine handler (utils/async_views.py: the /fetch routes,
+# currentwar, warlog, fetch_members, wartag) run on the event loop: their CoC
+# API calls are non-blocking (utils/coc_api.py fetch_coc_api_data_async) and
+# their SQLite work goes to a small thread pool (utils/db.py SQLiteExecutor),
+# so one worker keeps hundreds of upstream calls in flight. Every other route
+# runs the WSGI app whole on one of ASGI_WSGI_THREADS threads, as under
+# mod_wsgi, its body chunks passed to the server as they are produced.
+import asyncio
+import contextvars
+import io
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from werkzeug.exceptions import HTTPException
+
+from . import app
+from .utils.async_views import ASYNC_VIEWS
+from .utils.db import SQLiteExecutor
+
+
+def _environ(scope, body: bytes):
+    # WSGI environ of an ASGI http scope
+    server = scope.get('server') or ('localhost', 80)
+    client = scope.get('client') or ('', 0)
+    root_path = scope.get('root_path', '')
+    path = scope['path']
+    if root_path and path.startswith(root_path):
+        path = path[len(root_path):]
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': root_path.encode('utf-8').decode('latin-1'),
+        'PATH_INFO': path.encode('utf-8').decode('latin-1'),
+        'QUERY_STRING': scope.get('query_string', b'').decode('latin-1'),
+        'SERVER_NAME': server[0],
+        'SERVER_PORT': str(server[1]),
+        'SERVER_PROTOCOL': f"HTTP/{scope.get('http_version', '1.1')}",
+        'REMOTE_ADDR': client[0],
+        'CONTENT_LENGTH': str(len(body)),
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': io.BytesIO(body),
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': True,
+        'wsgi.run_once': False,
+    }
+    for name, value in scope.get('headers', []):
+        name, value = name.decode('latin-1'), value.decode('latin-1')
+        if name == 'content-length':
+            key = 'CONTENT_LENGTH'
+        elif name == 'content-type':
+            key = 'CONTENT_TYPE'
+        else:
+            key = 'HTTP_' + name.upper().replace('-', '_')
+        if key.startswith('HTTP_') and key in environ:
+            environ[key] += ',' + value
+        else:
+            environ[key] = value
+    return environ
+
+
+def _headers(headers):
+    return [(name.lower().encode('latin-1'), value.encode('latin-1')) for name, value in headers]
+
+
+class ASGIApp:
+    def __init__(self, flask_app):
+        self.app = flask_app
+        self.db = None
+        self.wsgi_threads = None
+
+    def start(self):
+        """Start the thread pools, done on lifespan startup or the first request."""
+        if self.db is None:
+            config = self.app.config
+            self.db = SQLiteExecutor(self.app, int(config.get('ASGI_DB_THREADS', 8)))
+            self.wsgi_threads = ThreadPoolExecutor(max_workers = int(config.get('ASGI_WSGI_THREADS', 16)),
+                                                   thread_name_prefix = 'wsgi')
+
+    def shutdown(self):
+        if self.db is not None:
+            self.db.shutdown()
+            self.wsgi_threads.shutdown(wait = True)
+            self.db = self.wsgi_threads = None
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            return await self._lifespan(receive, send)
+        if scope['type'] != 'http':
+            return
+        self.start()
+        body = []
+        while True:
+            message = await receive()
+            if message['type'] == 'http.disconnect':
+                return
+            body.append(message.get('body', b''))
+            if not message.get('more_body', False):
+                break
+        environ = _environ(scope, b''.join(body))
+        try:
+            endpoint, view_args = self.app.url_map.bind_to_environ(environ).match()
+        except HTTPException:
+            # 404, 405 and redirects are answered by the WSGI app
+            endpoint, view_args = None, None
+        handler = ASYNC_VIEWS.get(endpoint)
+        if handler is None:
+            await self._call_wsgi(environ, send)
+        else:
+            await self._call_async(handler, view_args, environ, send)
+
+    async def _lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                self.start()
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                await asyncio.to_thread(self.shutdown)
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    async def _call_async(self, handler, view_args, environ, send):
+        # Flask.wsgi_app / full_dispatch_request with an awaited view: the same
+        # before_request, after_request and teardown hooks, in this task's context.
+        # They only touch context variables and memory on the loop: the handler's
+        # SQLite work goes through self.db and utils/metrics.py flushes on a
+        # thread of its own
+        ctx = self.app.request_context(environ)
+        error = None
+        ctx.push()
+        try:
+            try:
+                try:
+                    rv = self.app.preprocess_request()
+                    if rv is None:
+                        rv = await handler(self.db, **view_args)
+                except Exception as e:
+                    rv = self.app.handle_user_exception(e)
+                response = self.app.finalize_request(rv)
+            except Exception as e:
+                error = e
+                response = self.app.handle_exception(e)
+            try:
+                await send({'type': 'http.response.start', 'status': response.status_code,
+                            'headers': _headers(response.get_wsgi_headers(environ).items())})
+                if response.is_streamed:
+                    # a body generator may read SQLite, its chunks are made on a pool thread; one
+                    # context for all of them keeps what stream_with_context pushes until it pops it
+                    loop = asyncio.get_running_loop()
+                    chunks, context = response.iter_encoded(), contextvars.copy_context()
+                    while (chunk := await loop.run_in_executor(self.wsgi_threads, context.run, next, chunks, None)) is not None:
+                        await send({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+                    await send({'type': 'http.response.body', 'body': b''})
+                else:
+                    await send({'type': 'http.response.body', 'body': response.get_data()})
+            finally:
+                # also when the client went away, the close callbacks end what the view started
+                response.close()
+        finally:
+            ctx.pop(error)
+
+    async def _call_wsgi(self, environ, send):
+        loop = asyncio.get_running_loop()
+
+        def send_message(message):
+            asyncio.run_coroutine_threadsafe(send(message), loop).result()
+
+        def run():
+            started = []
+
+            def start_response(status, headers, exc_info=None):
+                started[:] = [int(status.split(' ', 1)[0]), _headers(headers)]
+                return lambda data: None
+
+            def send_start():
+                if len(started) == 2:
+                    send_message({'type': 'http.response.start', 'status': started[0], 'headers': started[1]})
+                    started.append(True)
+
+            result = self.app(environ, start_response)
+            try:
+                for chunk in result:
+                    send_start()
+                    if chunk:
+                        send_message({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+                send_start()
+                send_message({'type': 'http.response.body', 'body': b''})
+            finally:
+                if hasattr(result, 'close'):
+                    result.close()
+
+        await loop.run_in_executor(self.wsgi_threads, run)
+
+
+application = ASGIApp(app)
@@ -0,0 +1,7 @@
+# app/benchmarks/__init__.py
+# Offline benchmarks, run from the directory above the package, e.g.
+#   DATABASE_PATH=/tmp python -m cocapi20250719.benchmarks.clan_members
+# routes.py measures every API route on a dataset from generator.py and saves
+# the results as JSON for comparison across commits.
+# asgi_load.py compares the fetch-heavy routes under load in WSGI threads and asgi.py.
+# player_archive.py times the player routes as the history grows, before and after archiving.
@@ -0,0 +1,218 @@
+# app/benchmarks/asgi_load.py
+# The fetch-heavy routes under load, served the WSGI way (a pool of threads
+# running the Flask app, as mod_wsgi does) and through asgi.py, against a local
+# HTTP server standing in for the CoC API with a fixed latency. The upstream
+# calls go over real sockets in both modes; the server counts how many were in
+# flight at once. Per mode and route: requests a second, p50 / p99 latency and
+# the peak of concurrent upstream calls.
+#   DATABASE_PATH=/tmp python -m cocapi20250719.benchmarks.asgi_load --upstream-ms 100
+import asyncio
+import logging
+import os
+import shutil
+import statistics
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import click
+
+from .. import app
+from ..asgi import ASGIApp
+from .common import print_results, temp_db_path
+from .generator import Dataset
+
+ROUTES = [
+    ('player fetch upstream', lambda d, i: f"/api/player/fetch/{d.player_tags[i % len(d.player_tags)]}/0"),
+    ('clan currentwar upstream', lambda d, i: f"/api/clan/currentwar/{d.clan_tags[i % len(d.clan_tags)]}/now"),
+    ('clan fetch_members upstream', lambda d, i: f"/api/clan/fetch_members/{d.clan_tags[i % len(d.clan_tags)]}/0"),
+]
+
+
+class UpstreamServer:
+    """HTTP/1.1 keep-alive server answering CoC API paths from a Dataset after `latency` seconds, on a thread of its own."""
+
+    def __init__(self, dataset, latency: float):
+        self.dataset = dataset
+        self.latency = latency
+        self.in_flight = 0
+        self.peak = 0
+        self.calls = 0
+        self.connections = {}
+        self.loop = asyncio.new_event_loop()
+        started = threading.Event()
+        self.thread = threading.Thread(target=self._run, args=(started,), daemon=True)
+        self.thread.start()
+        started.wait()
+
+    def _run(self, started):
+        asyncio.set_event_loop(self.loop)
+        self.server = self.loop.run_until_complete(asyncio.start_server(self._serve, '127.0.0.1', 0, backlog=1024))
+        self.port = self.server.sockets[0].getsockname()[1]
+        started.set()
+        self.loop.run_forever()
+
+    async def _serve(self, reader, writer):
+        self.connections[asyncio.current_task()] = writer
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                while (await reader.readline()) not in (b'\r\n', b'\n', b''):
+                    pass
+                self.calls += 1
+                self.in_flight += 1
+                self.peak = max(self.peak, self.in_flight)
+                try:
+                    await asyncio.sleep(self.latency)
+                finally:
+                    self.in_flight -= 1
+                path = request_line.split()[1].decode('latin-1')
+                body, status = self.dataset.api_response(f"http://upstream{path}")
+                writer.write(f"HTTP/1.1 {status} OK\r\nContent-Type: application/json\r\n"
+                             f"Content-Length: {len(body)}\r\n\r\n".encode('latin-1') + body)
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+            del self.connections[asyncio.current_task()]
+
+    def reset(self):
+        self.peak = self.in_flight
+        self.calls = 0
+
+    async def _shutdown(self):
+        # closing the sockets ends the keep-alive loops of _serve() at their next read
+        self.server.close()
+        connections = dict(self.connections)
+        for writer in connections.values():
+            writer.transport.abort()
+        await asyncio.gather(*connections, return_exceptions=True)
+
+    def close(self):
+        asyncio.run_coroutine_threadsafe(self._shutdown(), self.loop).result()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+        self.loop.close()
+
+
+def _summary(latencies, elapsed: float, statuses: dict, upstream):
+    latencies = sorted(latencies)
+    return {
+        'requests': len(latencies), 'req_per_s': round(len(latencies) / elapsed, 1),
+        'p50_ms': round(statistics.median(latencies), 1),
+        'p99_ms': round(latencies[min(len(latencies) - 1, int(0.99 * len(latencies)))], 1),
+        'upstream_calls': upstream.calls, 'peak_upstream_in_flight': upstream.peak, 'status': statuses,
+    }
+
+
+def run_wsgi(dataset, url, requests: int, threads: int, upstream):
+    def one(i):
+        start = time.perf_counter()
+        response = app.test_client().get(url(dataset, i))
+        response.get_data()
+        response.close()
+        return (time.perf_counter() - start) * 1000, response.status_code
+
+    upstream.reset()
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers = threads) as executor:
+        results = list(executor.map(one, range(requests)))
+    elapsed = time.perf_counter() - start
+    statuses = {}
+    for _, status_code in results:
+        statuses[str(status_code)] = statuses.get(str(status_code), 0) + 1
+    return _summary([ms for ms, _ in results], elapsed, statuses, upstream)
+
+
+async def _asgi_get(application, path: str):
+    # one request through the ASGI callable, as a server would make it; returns the status
+    scope = {'type': 'http', 'asgi': {'version': '3.0'}, 'http_version': '1.1', 'method': 'GET', 'scheme': 'http',
+             'path': path, 'raw_path': path.encode(), 'query_string': b'', 'root_path': '',
+             'headers': [(b'host', b'localhost')], 'client': ('127.0.0.1', 50000), 'server': ('localhost', 80)}
+    messages = [{'type': 'http.request', 'body': b'', 'more_body': False}]
+    status = []
+
+    async def receive():
+        return messages.pop() if messages else {'type': 'http.disconnect'}
+
+    async def send(message):
+        if message['type'] == 'http.response.start':
+            status.append(message['status'])
+
+    await application(scope, receive, send)
+    return status[0]
+
+
+async def _run_asgi(application, dataset, url, requests: int, concurrency: int):
+    limit = asyncio.Semaphore(concurrency)
+
+    async def one(i):
+        async with limit:
+            start = time.perf_counter()
+            status_code = await _asgi_get(application, url(dataset, i))
+            return (time.perf_counter() - start) * 1000, status_code
+
+    return await asyncio.gather(*(one(i) for i in range(requests)))
+
+
+def run_asgi(dataset, url, requests: int, concurrency: int, upstream):
+    application = ASGIApp(app)
+    application.start()
+    upstream.reset()
+    try:
+        start = time.perf_counter()
+        results = asyncio.run(_run_asgi(application, dataset, url, requests, concurrency))
+        elapsed = time.perf_counter() - start
+    finally:
+        application.shutdown()
+    statuses = {}
+    for _, status_code in results:
+        statuses[str(status_code)] = statuses.get(str(status_code), 0) + 1
+    return _summary([ms for ms, _ in results], elapsed, statuses, upstream)
+
+
+@click.command()
+@click.option('--clans', default=4, show_default=True)
+@click.option('--members', default=50, show_default=True)
+@click.option('--days', default=7, show_default=True, help='Daily player snapshots per member.')
+@click.option('--requests', default=400, show_default=True, help='Requests per route and mode.')
+@click.option('--threads', default=16, show_default=True, help='Threads of the WSGI mode, like mod_wsgi threads=16.')
+@click.option('--concurrency', default=200, show_default=True, help='Requests the ASGI mode has open at once.')
+@click.option('--upstream-ms', default=100.0, show_default=True, help='Latency of every CoC API call.')
+@click.option('--route', 'only', multiple=True, help='Only the routes whose name contains this, repeatable.')
+def main(clans, members, days, requests, threads, concurrency, upstream_ms, only):
+    """Requests a second of the fetch-heavy routes, WSGI threads against asgi.py."""
+    routes = [(name, url) for name, url in ROUTES if not only or any(part in name for part in only)]
+    dataset = Dataset(clans=clans, members=members, days=days)
+    db_path = temp_db_path()
+    dataset.write(db_path)
+    upstream = UpstreamServer(dataset, upstream_ms / 1000)
+    names = ('DATABASE_PATH', 'RESPONSE_CACHE_MAX_BYTES', 'COC_API_URL', 'APIKEY', 'APIKEYS', 'COC_API_KEY_RATE',
+             'COC_API_KEY_BURST', 'ASGI_WSGI_THREADS')
+    saved = {name: app.config.get(name) for name in names}
+    log_level = app.logger.level
+    # the key buckets are not what is measured here
+    app.config.update(DATABASE_PATH = db_path, RESPONSE_CACHE_MAX_BYTES = 0, COC_API_URL = f"http://127.0.0.1:{upstream.port}/v1",
+                      APIKEY = 'bench', APIKEYS = [], COC_API_KEY_RATE = 1e6, COC_API_KEY_BURST = 1e6, ASGI_WSGI_THREADS = threads)
+    app.logger.setLevel(logging.WARNING)
+    results = {}
+    try:
+        for name, url in routes:
+            # fetch_members fans out one call per member, fewer requests keep the runs comparable
+            count = requests if 'fetch_members' not in name else max(1, requests // members)
+            results[f"{name} wsgi x{threads}"] = run_wsgi(dataset, url, count, threads, upstream)
+            results[f"{name} asgi x{concurrency}"] = run_asgi(dataset, url, count, concurrency, upstream)
+    finally:
+        app.config.update(saved)
+        app.logger.setLevel(log_level)
+        upstream.close()
+        shutil.rmtree(os.path.dirname(db_path), ignore_errors=True)
+
+    print_results(f"{clans} clans x {members} members, CoC API latency {upstream_ms} ms", results)
+
+
+if __name__ == '__main__':
+    main()
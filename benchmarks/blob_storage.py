@@ -0,0 +1,62 @@
+# app/benchmarks/blob_storage.py
+# Database size against read latency for every cocdata format: raw JSON, zlib,
+# zlib with a preset dictionary and, when zstandard is installed, zstd with and
+# without a trained dictionary.
+#   DATABASE_PATH=/tmp python -m cocapi20250719.benchmarks.blob_storage
+import os
+import shutil
+import sqlite3
+
+from .. import app
+from ..utils.blobs import load_json, recompress_table, train_dictionary, zstandard
+from ..utils.snapshots import load_latest_snapshots
+from .common import build_clan_db, temp_db_path, time_calls, print_results
+
+CLAN_TAG = 'BENCHCLAN'
+
+
+def _player_history(conn, tag):
+    return [load_json(row['cocdata']) for row in
+            conn.execute('SELECT cocdata FROM player WHERE tag = ? ORDER BY dataTime DESC LIMIT 90', (tag,))]
+
+
+def main(members=50, days=365):
+    base_path = temp_db_path()
+    tags = build_clan_db(base_path, members=members, days=days, clan_tag=CLAN_TAG)
+
+    variants = [('raw json', 'none', None), ('zlib', 'zlib', None), ('zlib + dictionary', 'zlib', 'zlib')]
+    if zstandard is not None:
+        variants += [('zstd', 'zstd', None), ('zstd + dictionary', 'zstd', 'zstd')]
+    else:
+        print('zstandard is not installed, zstd variants skipped')
+
+    # dictionaries live in the base copy so every variant sees the same ids
+    conn = sqlite3.connect(base_path)
+    dictionaries = {codec: train_dictionary(conn, 'player', codec) for _, _, codec in variants if codec}
+    conn.close()
+
+    results = {}
+    with app.app_context():
+        for name, codec, dictionary in variants:
+            db_path = os.path.join(os.path.dirname(base_path), codec + (dictionary or '') + '.db')
+            shutil.copy(base_path, db_path)
+            conn = sqlite3.connect(db_path)
+            conn.row_factory = sqlite3.Row
+            for table in ('player', 'clan'):
+                recompress_table(conn, table, codec, dictionary_id=dictionaries.get(dictionary))
+            conn.execute('VACUUM')
+
+            stats = {'db_mb': round(os.path.getsize(db_path) / 1024 / 1024, 2)}
+            latest = time_calls(lambda: load_latest_snapshots(conn, 'player', tags))
+            history = time_calls(lambda: _player_history(conn, tags[0]))
+            stats['latest_members_ms'] = latest['median_ms']
+            stats['player_90_days_ms'] = history['median_ms']
+            results[name] = stats
+            conn.close()
+
+    print_results(f"{members} members x {days} daily snapshots", results)
+    shutil.rmtree(os.path.dirname(base_path), ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,48 @@
+# app/benchmarks/clan_members.py
+# Per-request latency of the clan member endpoints on a 50-member clan with a
+# year of daily player snapshots, compared with the old one-query-per-member loop.
+#   DATABASE_PATH=/tmp python -m cocapi20250719.benchmarks.clan_members
+import json
+import os
+import shutil
+import sqlite3
+
+from .. import app
+from ..utils.snapshots import load_latest_snapshots
+from .common import build_clan_db, temp_db_path, time_calls, print_results
+
+CLAN_TAG = 'BENCHCLAN'
+
+
+def _per_member_loop(conn, tags):
+    player_data_map = {}
+    for tag in tags:
+        sql = 'SELECT cocdata FROM player where tag = ? ORDER BY dataTime DESC'
+        row = conn.execute(sql, (tag,)).fetchone()
+        if row:
+            player_data_map[tag] = json.loads(row['cocdata'])
+    return player_data_map
+
+
+def main(members=50, days=365):
+    db_path = temp_db_path()
+    tags = build_clan_db(db_path, members=members, days=days, clan_tag=CLAN_TAG)
+    app.config['DATABASE_PATH'] = db_path
+
+    conn = sqlite3.connect(db_path)
+    conn.row_factory = sqlite3.Row
+    results = {}
+    with app.app_context():
+        results['per-member loop (before)'] = time_calls(lambda: _per_member_loop(conn, tags))
+        results['load_latest_snapshots'] = time_calls(lambda: load_latest_snapshots(conn, 'player', tags))
+    conn.close()
+
+    client = app.test_client()
+    results['GET get_clan_details'] = time_calls(lambda: client.get(f'/api/clan/get_clan_details/{CLAN_TAG}'))
+    results['GET supertroops'] = time_calls(lambda: client.get(f'/api/clan/supertroops/{CLAN_TAG}'))
+    print_results(f"{members} members x {days} daily snapshots", results)
+    shutil.rmtree(os.path.dirname(db_path), ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,104 @@
+# app/benchmarks/coc_client.py
+# Sequential CoC API calls against a local stub server, counting TCP connections
+# (handshakes) and body bytes for a new urllib request per call versus the pooled
+# keep-alive gzip client in utils/coc_api.py.
+#   DATABASE_PATH=/tmp python -m cocapi20250719.benchmarks.coc_client
+import gzip
+import json
+import random
+import threading
+import time
+import urllib.request
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from .. import app
+from ..utils.coc_api import fetch_coc_api_data
+from .common import player_snapshot
+
+
+class StubCocApi(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, payload: bytes):
+        super().__init__(('127.0.0.1', 0), StubHandler)
+        self.payload = payload
+        self.gzip_payload = gzip.compress(payload)
+        self.connections = 0
+        self.bytes_sent = 0
+        self.lock = threading.Lock()
+
+    @property
+    def base_url(self):
+        return f'http://127.0.0.1:{self.server_address[1]}'
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+
+    def setup(self):
+        super().setup()
+        with self.server.lock:
+            self.server.connections += 1
+
+    def do_GET(self):
+        if 'gzip' in self.headers.get('Accept-Encoding', ''):
+            body = self.server.gzip_payload
+            self.send_response(200)
+            self.send_header('Content-Encoding', 'gzip')
+        else:
+            body = self.server.payload
+            self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+        with self.server.lock:
+            self.server.bytes_sent += len(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def _urllib_fetch(endpoint):
+    req = urllib.request.Request(endpoint)
+    req.add_header('Accept', 'application/json')
+    req.add_header('Authorization', 'Bearer stub')
+    with urllib.request.urlopen(req) as r:
+        data = r.read()
+    json.loads(data)
+    return data, r.getcode()
+
+
+def _measure(server, fetch, calls):
+    server.connections = server.bytes_sent = 0
+    start = time.perf_counter()
+    for i in range(calls):
+        data, status = fetch(f'{server.base_url}/v1/clanwarleagues/wars/%23WAR{i}')
+        assert status == 200, status
+    elapsed = time.perf_counter() - start
+    return {'connections': server.connections, 'bytes_sent': server.bytes_sent,
+            'total_ms': round(elapsed * 1000, 1), 'per_call_ms': round(elapsed * 1000 / calls, 2)}
+
+
+def main(calls=28):
+    payload = json.dumps(player_snapshot('STUB', 100, random.Random(1))).encode('utf-8')
+    server = StubCocApi(payload)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    app.config['APIKEY'] = app.config.get('APIKEY') or 'stub'
+    # measure connections, not the key rate limit of utils/ratelimit.py
+    app.config['COC_API_KEY_RATE'] = 10000
+    try:
+        results = {'urllib per call (before)': _measure(server, _urllib_fetch, calls)}
+        with app.app_context():
+            results['pooled keep-alive + gzip'] = _measure(
+                    server, lambda url: fetch_coc_api_data(endpoint=url, data_type='bench', tag_value='stub'), calls)
+    finally:
+        server.shutdown()
+    print(f"{calls} sequential calls, {len(payload)} byte payload")
+    for name, result in results.items():
+        print(f"  {name:<28} " + '  '.join(f"{k}={v}" for k, v in result.items()))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,108 @@
+# app/benchmarks/common.py
+import json
+import os
+import random
+import sqlite3
+import statistics
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+from ..utils.ingest import store_clan_members
+from ..utils.schema import migrate
+
+TROOPS = ['Barbarian', 'Archer', 'Giant', 'Goblin', 'Wall Breaker', 'Balloon', 'Wizard', 'Healer',
+          'Dragon', 'P.E.K.K.A', 'Minion', 'Hog Rider', 'Valkyrie', 'Golem', 'Witch', 'Lava Hound',
+          'Bowler', 'Baby Dragon', 'Miner', 'Super Barbarian', 'Super Archer', 'Super Wall Breaker',
+          'Super Giant', 'Electro Dragon', 'Yeti', 'Dragon Rider', 'Ice Golem', 'Headhunter']
+BUILDER_TROOPS = ['Raged Barbarian', 'Sneaky Archer', 'Boxer Giant', 'Beta Minion', 'Bomber', 'Baby Dragon',
+                  'Cannon Cart', 'Night Witch', 'Drop Ship', 'Power P.E.K.K.A', 'Hog Glider']
+SPELLS = ['Lightning Spell', 'Healing Spell', 'Rage Spell', 'Jump Spell', 'Freeze Spell', 'Clone Spell',
+          'Poison Spell', 'Earthquake Spell', 'Haste Spell', 'Skeleton Spell', 'Bat Spell', 'Invisibility Spell']
+HEROES = ['Barbarian King', 'Archer Queen', 'Grand Warden', 'Royal Champion']
+ACHIEVEMENTS = ['Bigger Coffers', 'Get those Goblins!', 'Bigger & Better', 'Nice and Tidy', 'Discover New Troops',
+                'Gold Grab', 'Elixir Escapade', 'Sweet Victory!', 'Empire Builder', 'Wall Buster', 'Humiliator',
+                'Union Buster', 'Conqueror', 'Unbreakable', 'Friend in Need', 'Mortar Mauler', 'Heroic Heist',
+                'League All-Star', 'X-Bow Exterminator', 'Firefighter', 'War Hero', 'Clan War Wealth',
+                'Anti-Artillery', 'Sharing is caring', 'Keep Your Account Safe!', 'Master Engineering',
+                'Next Generation Model', 'Un-Build It', 'Champion Builder', 'High Gear', 'Hidden Treasures',
+                'Games Champion', 'Dragon Slayer', 'War League Legend', 'Well Seasoned', 'Shattered and Scattered',
+                'Not So Easy This Time', 'Bust This!', 'Superb Work', 'Siege Sharer', 'Aggressive Capitalism',
+                'Most Valuable Clanmate', 'Counterspell', 'Monolith Masher', 'Ungrateful Child']
+
+
+def _unit(name, level, village, max_level):
+    return {'name': name, 'level': level, 'maxLevel': max_level, 'village': village}
+
+
+def player_snapshot(tag, day, rnd):
+    """A player payload shaped like the CoC API response for `tag` on day `day`."""
+    troops = [_unit(name, 1 + (day + i) // 40, 'home', 12) for i, name in enumerate(TROOPS)]
+    for troop in troops:
+        if troop['name'].startswith('Super') and rnd.random() < 0.2:
+            troop['superTroopIsActive'] = True
+    troops += [_unit(name, 1 + (day + i) // 60, 'builderBase', 20) for i, name in enumerate(BUILDER_TROOPS)]
+    return {
+        'tag': '#' + tag, 'name': 'name ' + tag, 'townHallLevel': 12 + day // 120, 'townHallWeaponLevel': 1 + day // 90,
+        'expLevel': 150 + day // 10, 'trophies': 3000 + rnd.randint(0, 500), 'bestTrophies': 3600,
+        'warStars': 800 + day, 'attackWins': 20 + day % 30 * 3, 'defenseWins': day % 7,
+        'builderHallLevel': 8 + day // 200, 'role': 'member', 'warPreference': 'in',
+        'donations': day % 30 * 40, 'donationsReceived': day % 30 * 35,
+        'troops': troops,
+        'spells': [_unit(name, 1 + (day + i) // 50, 'home', 10) for i, name in enumerate(SPELLS)],
+        'heroes': [_unit(name, 40 + day // 20, 'home', 90) for name in HEROES],
+        'heroEquipment': [_unit(name + ' Gear', 5 + day // 30, 'home', 18) for name in HEROES],
+        'achievements': [{'name': name, 'stars': 2, 'value': 1000 * i + day * (i % 5 + 1), 'target': 100000,
+                          'info': 'Achievement description text for ' + name, 'village': 'home'}
+                         for i, name in enumerate(ACHIEVEMENTS)],
+    }
+
+
+def build_clan_db(path, members=50, days=365, clan_tag='BENCHCLAN', seed=1):
+    """Create a SQLite DB holding one clan and `days` daily snapshots per member."""
+    rnd = random.Random(seed)
+    conn = sqlite3.connect(path)
+    migrate(conn)
+    now = datetime.now().replace(microsecond=0)
+    tags = ['BM%03d' % i for i in range(members)]
+    for tag in tags:
+        rows = []
+        for day in range(days):
+            data_time = (now - timedelta(days=days - 1 - day, hours=1)).strftime('%Y-%m-%d %H:%M:%S')
+            rows.append((tag, data_time, json.dumps(player_snapshot(tag, day, rnd)).encode('utf-8')))
+        conn.executemany('INSERT INTO player (tag, dataTime, cocdata) VALUES (?, ?, ?)', rows)
+    clan = {'tag': '#' + clan_tag, 'name': 'bench clan', 'isWarLogPublic': True,
+            'memberList': [{'tag': '#' + tag, 'name': 'name ' + tag, 'role': 'member'} for tag in tags]}
+    conn.execute('INSERT INTO clan (tag, dataTime, cocdata) VALUES (?, ?, ?)',
+                 (clan_tag, now.strftime('%Y-%m-%d %H:%M:%S'), json.dumps(clan).encode('utf-8')))
+    store_clan_members(conn, clan_tag, clan)
+    conn.commit()
+    conn.close()
+    return tags
+
+
+def temp_db_path(name='bench.db'):
+    return os.path.join(tempfile.mkdtemp(prefix='cocapi-bench-'), name)
+
+
+def time_calls(func, repeat=20, warmup=2):
+    """Run `func` and return per-call latency stats in milliseconds."""
+    for _ in range(warmup):
+        func()
+    samples = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        samples.append((time.perf_counter() - start) * 1000)
+    samples.sort()
+    return {
+        'median_ms': round(statistics.median(samples), 3),
+        'p95_ms': round(samples[min(len(samples) - 1, int(len(samples) * 0.95))], 3),
+        'min_ms': round(samples[0], 3),
+    }
+
+
+def print_results(title, results):
+    print(title)
+    for name, stats in results.items():
+        print(f"  {name:<40} " + '  '.join(f"{k}={v}" for k, v in stats.items()))
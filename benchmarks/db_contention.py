@@ -0,0 +1,110 @@
+# app/benchmarks/db_contention.py
+# Concurrent readers and writers against a clan DB, comparing a new rollback
+# journal connection per operation with the pooled WAL connections of utils/db.py.
+#   DATABASE_PATH=/tmp python -m cocapi20250719.benchmarks.db_contention
+import json
+import os
+import random
+import shutil
+import sqlite3
+import statistics
+import threading
+import time
+
+from .. import app
+from ..utils.db import connect
+from .common import build_clan_db, temp_db_path, player_snapshot
+
+READ_SQL = """
+    WITH wanted(tag) AS (VALUES {values})
+    SELECT s.cocdata, s.tag FROM wanted w
+    JOIN player s ON s.tag = w.tag AND s.dataTime = (SELECT MAX(dataTime) FROM player WHERE tag = w.tag)
+"""
+
+
+def _per_operation_connection(db_path):
+    conn = sqlite3.connect(db_path)
+    conn.row_factory = sqlite3.Row
+    return conn
+
+
+def _run(db_path, tags, open_conn, close_after_op, readers, writers, duration, label):
+    stop = threading.Event()
+    stats = {'read': [], 'write': [], 'locked': 0}
+    lock = threading.Lock()
+    read_sql = READ_SQL.format(values=', '.join(['(?)'] * len(tags)))
+    payload = json.dumps(player_snapshot('BMWRITE', 1, random.Random(1))).encode('utf-8')
+
+    def worker(kind, index):
+        conn = None
+        sequence = 0
+        while not stop.is_set():
+            if conn is None:
+                conn = open_conn(db_path)
+            start = time.perf_counter()
+            try:
+                if kind == 'read':
+                    for row in conn.execute(read_sql, tags):
+                        json.loads(row['cocdata'])
+                else:
+                    sequence += 1
+                    conn.execute('INSERT INTO player (tag, dataTime, cocdata) VALUES (?, ?, ?)',
+                                 (f'BMW{label}{index:02d}', f'2000-01-01 00:00:{sequence:09d}', payload))
+                    conn.commit()
+                elapsed = (time.perf_counter() - start) * 1000
+                with lock:
+                    stats[kind].append(elapsed)
+            except sqlite3.OperationalError:
+                with lock:
+                    stats['locked'] += 1
+                if conn.in_transaction:
+                    conn.rollback()
+            if close_after_op:
+                conn.close()
+                conn = None
+        if conn is not None:
+            conn.close()
+
+    threads = [threading.Thread(target=worker, args=('read', i)) for i in range(readers)]
+    threads += [threading.Thread(target=worker, args=('write', i)) for i in range(writers)]
+    for thread in threads:
+        thread.start()
+    time.sleep(duration)
+    stop.set()
+    for thread in threads:
+        thread.join()
+
+    result = {'locked_errors': stats['locked']}
+    for kind in ('read', 'write'):
+        samples = sorted(stats[kind])
+        result[f'{kind}_ops_per_s'] = round(len(samples) / duration, 1)
+        if samples:
+            result[f'{kind}_p50_ms'] = round(statistics.median(samples), 2)
+            result[f'{kind}_p95_ms'] = round(samples[int(len(samples) * 0.95)], 2)
+    return result
+
+
+def main(members=50, days=60, readers=8, writers=2, duration=5.0):
+    db_path = temp_db_path()
+    tags = build_clan_db(db_path, members=members, days=days)
+
+    conn = sqlite3.connect(db_path)
+    conn.execute('PRAGMA journal_mode = DELETE')
+    conn.close()
+    before = _run(db_path, tags, _per_operation_connection, True, readers, writers, duration, 'A')
+
+    local = threading.local()
+    def pooled(path):
+        if not hasattr(local, 'conn'):
+            local.conn = connect(path, app.config)
+        return local.conn
+    after = _run(db_path, tags, pooled, False, readers, writers, duration, 'B')
+
+    print(f"{readers} readers / {writers} writers for {duration}s, {members} members x {days} days")
+    for title, result in (('connect per op, rollback journal', before), ('pooled WAL connections', after)):
+        print(f"  {title:<34} " + '  '.join(f"{k}={v}" for k, v in result.items()))
+    shutil.rmtree(os.path.dirname(db_path), ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
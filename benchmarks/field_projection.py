@@ -0,0 +1,60 @@
+# app/benchmarks/field_projection.py
+# The member values of get_clan_details and get_supertroops_list for a 50 member
+# clan, read by parsing every latest player snapshot in Python against
+# projecting them in SQLite with load_fields(), for raw and zlib cocdata.
+#   DATABASE_PATH=/tmp python -m cocapi20250719.benchmarks.field_projection
+import os
+import shutil
+
+from .. import app
+from ..api.clan.routes import DETAIL_FIELDS, SUPERTROOP_FIELDS
+from ..utils.blobs import recompress_table
+from ..utils.db import connect
+from ..utils.snapshots import load_fields, load_latest_snapshots
+from .common import build_clan_db, print_results, temp_db_path, time_calls
+
+CLAN_TAG = 'BENCHCLAN'
+
+
+def _details_full(conn, tags):
+    return {tag: {name: data.get(name) for name in DETAIL_FIELDS}
+            for tag, data in load_latest_snapshots(conn, 'player', tags).items()}
+
+
+def _supertroops_full(conn, tags):
+    return {tag: [troop['name'] for troop in data['troops'] if troop['village'] == 'home' and 'superTroopIsActive' in troop]
+            for tag, data in load_latest_snapshots(conn, 'player', tags).items()}
+
+
+def _supertroops_projected(conn, tags):
+    return {tag: [troop['name'] for troop in data['troops'] if troop['village'] == 'home' and 'superTroopIsActive' in troop]
+            for tag, data in load_fields(conn, 'player', tags, SUPERTROOP_FIELDS).items()}
+
+
+def main(members=50, days=30):
+    db_path = temp_db_path()
+    tags = build_clan_db(db_path, members=members, days=days, clan_tag=CLAN_TAG)
+    results = {}
+    with app.app_context():
+        conn = connect(db_path)
+        for codec in ('none', 'zlib'):
+            recompress_table(conn, 'player', codec)
+            # both paths have to agree before their timings mean anything
+            assert _supertroops_full(conn, tags) == _supertroops_projected(conn, tags)
+            assert _details_full(conn, tags) == load_fields(conn, 'player', tags, DETAIL_FIELDS)
+            results[f"clan details, {codec}"] = {
+                'full_decode_ms': time_calls(lambda: _details_full(conn, tags))['median_ms'],
+                'projected_ms': time_calls(lambda: load_fields(conn, 'player', tags, DETAIL_FIELDS))['median_ms'],
+            }
+            results[f"supertroops, {codec}"] = {
+                'full_decode_ms': time_calls(lambda: _supertroops_full(conn, tags))['median_ms'],
+                'projected_ms': time_calls(lambda: _supertroops_projected(conn, tags))['median_ms'],
+            }
+        conn.close()
+
+    print_results(f"latest snapshot of {members} members", results)
+    shutil.rmtree(os.path.dirname(db_path), ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,317 @@
+# app/benchmarks/generator.py
+# A synthetic CoC dataset of realistic shape, for benchmarks/routes.py and for
+# anyone who needs a populated database offline: N clans of 50 members with D
+# daily player snapshots each (troops, spells, heroes and achievements that level
+# up over time), stored the way the app stores them and backfilled into the
+# metric, unit level and upgrade tables; per clan a current war, a finished war
+# every other day (warlog), the CoC war log (clanwarlog), the CWL league group
+# of this season and the two before (clanwarleague) and the 7 rounds of wars of
+# this season (cwlwarlog). Dataset.api_response() answers the CoC API URLs the
+# app calls with payloads of the same shape, and is what the harness stubs
+# fetch_coc_api_data with. Everything derives from the seed, the same arguments
+# give the same database.
+#   DATABASE_PATH=/tmp python -m cocapi20250719.benchmarks.generator /tmp/bench.db --clans 4 --days 90
+import os
+import random
+import sqlite3
+import urllib.parse
+from datetime import datetime, timedelta
+
+import click
+
+from .. import app
+from ..utils.blobs import encode_cocdata
+from ..utils.ingest import (backfill_player_metrics, content_hash, rebuild_player_history,
+                            store_clan_members)
+from ..utils.jsoncodec import dumps
+from ..utils.schema import migrate
+from .common import player_snapshot
+
+ROLES = ['leader'] + ['coLeader'] * 3 + ['admin'] * 10 + ['member'] * 36
+LEAGUES = ['Master League I', 'Champion League III', 'Champion League II', 'Champion League I', 'Titan League III']
+CWL_CLANS = 8 # clans in a league group, 7 rounds of 4 wars
+CWL_ROSTER = 20 # players a clan brings to the league group
+CWL_TEAM = 15 # players of a clan in each league war
+WAR_TEAM = 15 # players of a clan in a regular war
+
+
+def _time(value: datetime):
+    # the app's dataTime format
+    return value.strftime('%Y-%m-%d %H:%M:%S')
+
+
+def _api_time(value: datetime):
+    # the CoC API's timestamp format
+    return value.strftime('%Y%m%dT%H%M%S.000Z')
+
+
+def _month(value: datetime, back: int):
+    year, month = divmod(value.year * 12 + value.month - 1 - back, 12)
+    return f"{year:04d}-{month + 1:02d}"
+
+
+class Dataset:
+    """The tags, seasons and payloads of one generated dataset; write() stores it."""
+
+    def __init__(self, clans=4, members=50, days=90, seed=1, now=None):
+        self.members, self.days, self.seed = members, days, seed
+        self.now = (now or datetime.now()).replace(microsecond=0)
+        self.season = _month(self.now, 0)
+        self.seasons = [_month(self.now, back) for back in range(3)]
+        self.clan_tags = ['BC%02d' % c for c in range(clans)]
+        self.member_tags = {clan_tag: ['BP%02d%02d' % (c, m) for m in range(members)]
+                            for c, clan_tag in enumerate(self.clan_tags)}
+        self.player_tags = [tag for tags in self.member_tags.values() for tag in tags]
+        # players start at different points of the progression so levels and counters differ
+        self._offset = {tag: random.Random(f"{seed}:{tag}").randint(0, 400) for tag in self.player_tags}
+        # finished regular wars, every other day, newest first: clan tag -> [end time, ...]
+        self.war_ends = {clan_tag: [self.now - timedelta(days=2 * k + 1, hours=c) for k in range(max(1, days // 2))]
+                         for c, clan_tag in enumerate(self.clan_tags)}
+        # league groups of this season: clan tag -> [clan tags of the group], and war tag -> (clan tag, clan tag, round)
+        self.cwl_groups = {}
+        self.cwl_wars = {}
+        self.cwl_rounds = {}
+        self._rosters = {}
+        for c, clan_tag in enumerate(self.clan_tags):
+            group = [clan_tag] + ['BO%02d%d' % (c, k) for k in range(CWL_CLANS - 1)]
+            self.cwl_groups[clan_tag] = group
+            self.cwl_rounds[clan_tag] = []
+            for day, pairs in enumerate(self._round_robin(group)):
+                war_tags = []
+                for p, (first, second) in enumerate(pairs):
+                    war_tag = 'BW%02d%d%d' % (c, day, p)
+                    self.cwl_wars[war_tag] = (first, second, day)
+                    war_tags.append(war_tag)
+                self.cwl_rounds[clan_tag].append(war_tags)
+
+    @staticmethod
+    def _round_robin(group):
+        # circle method: every clan meets every other one once over len(group) - 1 rounds
+        ring = list(group)
+        for _ in range(len(ring) - 1):
+            yield [(ring[i], ring[-1 - i]) for i in range(len(ring) // 2)]
+            ring.insert(1, ring.pop())
+
+    def _rnd(self, *key):
+        return random.Random(':'.join(map(str, (self.seed, *key))))
+
+    def _roster(self, clan_tag: str):
+        # players of a clan as (tag, name, town hall), opponent clans get made up ones
+        if clan_tag not in self._rosters:
+            if clan_tag in self.member_tags:
+                roster = [(tag, 'name ' + tag, self.player(tag, self.days)['townHallLevel']) for tag in self.member_tags[clan_tag]]
+            else:
+                rnd = self._rnd('roster', clan_tag)
+                roster = [(f"{clan_tag}P{m:02d}", f"opponent {clan_tag} {m}", rnd.randint(12, 16)) for m in range(self.members)]
+            self._rosters[clan_tag] = roster
+        return self._rosters[clan_tag]
+
+    def clan_name(self, clan_tag: str):
+        return ('bench clan ' if clan_tag in self.member_tags else 'opponent clan ') + clan_tag
+
+    def player(self, player_tag: str, day: int):
+        """The player payload of `player_tag` on day `day`, day `days` is today's (not stored)."""
+        return player_snapshot(player_tag, day + self._offset[player_tag], self._rnd('player', player_tag, day))
+
+    def clan(self, clan_tag: str):
+        rnd = self._rnd('clan', clan_tag)
+        member_list = []
+        for rank, tag in enumerate(self.member_tags[clan_tag]):
+            player = self.player(tag, self.days)
+            member_list.append({
+                'tag': '#' + tag, 'name': player['name'], 'role': ROLES[rank % len(ROLES)],
+                'townHallLevel': player['townHallLevel'], 'expLevel': player['expLevel'],
+                'league': {'id': 29000000 + rank % len(LEAGUES), 'name': LEAGUES[rank % len(LEAGUES)]},
+                'trophies': player['trophies'], 'builderBaseTrophies': 2500 + rnd.randint(0, 2000),
+                'clanRank': rank + 1, 'previousClanRank': rank + 1 + rnd.randint(-2, 2),
+                'donations': player['donations'], 'donationsReceived': player['donationsReceived'],
+            })
+        return {
+            'tag': '#' + clan_tag, 'name': self.clan_name(clan_tag), 'type': 'inviteOnly',
+            'description': 'Synthetic clan for the offline benchmarks. Active war clan, donate max level troops.',
+            'location': {'id': 32000006, 'name': 'International', 'isCountry': False},
+            'isFamilyFriendly': False, 'clanLevel': 20 + rnd.randint(0, 10), 'clanPoints': 40000 + rnd.randint(0, 10000),
+            'clanBuilderBasePoints': 30000 + rnd.randint(0, 10000), 'clanCapitalPoints': 3000 + rnd.randint(0, 2000),
+            'requiredTrophies': 2000, 'warFrequency': 'always', 'warWinStreak': rnd.randint(0, 20),
+            'warWins': 500 + rnd.randint(0, 500), 'warTies': rnd.randint(0, 20), 'warLosses': rnd.randint(0, 200),
+            'isWarLogPublic': True, 'warLeague': {'id': 48000015, 'name': 'Champion League I'},
+            'members': len(member_list), 'memberList': member_list,
+            'labels': [{'id': 56000000, 'name': 'Clan Wars'}, {'id': 56000004, 'name': 'Clan War League'}],
+        }
+
+    def _war_side(self, clan_tag: str, opponent_tag: str, team: int, attacks: int, key):
+        rnd = self._rnd('war', clan_tag, key)
+        roster = self._roster(clan_tag)[:team]
+        opponents = self._roster(opponent_tag)[:team]
+        members = []
+        for position, (tag, name, town_hall) in enumerate(roster):
+            member = {'tag': '#' + tag, 'name': name, 'townhallLevel': town_hall, 'mapPosition': position + 1,
+                      'opponentAttacks': rnd.randint(0, attacks)}
+            made = rnd.randint(attacks - 1, attacks) if attacks else 0
+            if made:
+                # like the API, a member who has not attacked has no attacks key
+                member['attacks'] = [{
+                    'attackerTag': '#' + tag, 'defenderTag': '#' + opponents[rnd.randrange(len(opponents))][0],
+                    'stars': rnd.choice((1, 2, 2, 3, 3, 3)), 'destructionPercentage': rnd.randint(40, 100),
+                    'order': position * attacks + a + 1, 'duration': rnd.randint(60, 180),
+                } for a in range(made)]
+            members.append(member)
+        made = [attack for member in members for attack in member.get('attacks', [])]
+        return {
+            'tag': '#' + clan_tag, 'name': self.clan_name(clan_tag), 'clanLevel': 20 + rnd.randint(0, 10),
+            'attacks': len(made), 'stars': sum(attack['stars'] for attack in made),
+            'destructionPercentage': round(sum(attack['destructionPercentage'] for attack in made) / max(len(made), 1), 2),
+            'members': members,
+        }
+
+    def _war(self, clan_tag: str, opponent_tag: str, state: str, end: datetime, team: int, attacks: int, key):
+        return {
+            'state': state, 'teamSize': team, 'attacksPerMember': attacks,
+            'preparationStartTime': _api_time(end - timedelta(days=2)), 'startTime': _api_time(end - timedelta(days=1)),
+            'endTime': _api_time(end),
+            'clan': self._war_side(clan_tag, opponent_tag, team, attacks if state != 'preparation' else 0, key),
+            'opponent': self._war_side(opponent_tag, clan_tag, team, attacks if state != 'preparation' else 0, key),
+        }
+
+    def current_war(self, clan_tag: str):
+        return self._war(clan_tag, clan_tag + 'OPP', 'inWar', self.now + timedelta(hours=6), WAR_TEAM, 2, 'current')
+
+    def finished_war(self, clan_tag: str, end: datetime):
+        return self._war(clan_tag, clan_tag + 'OP' + end.strftime('%m%d'), 'warEnded', end, WAR_TEAM, 2, end)
+
+    def warlog(self, clan_tag: str):
+        items = []
+        for end in self.war_ends[clan_tag][:30]:
+            war = self.finished_war(clan_tag, end)
+            result = 'win' if war['clan']['stars'] >= war['opponent']['stars'] else 'lose'
+            items.append({
+                'result': result, 'endTime': war['endTime'], 'teamSize': WAR_TEAM, 'attacksPerMember': 2,
+                'clan': {key: war['clan'][key] for key in ('tag', 'name', 'clanLevel', 'attacks', 'stars', 'destructionPercentage')},
+                'opponent': {key: war['opponent'][key] for key in ('tag', 'name', 'clanLevel', 'stars', 'destructionPercentage')},
+            })
+        return {'items': items, 'paging': {'cursors': {}}}
+
+    def league_group(self, clan_tag: str, season: str):
+        state = 'inWar' if season == self.season else 'ended'
+        clans = [{'tag': '#' + tag, 'name': self.clan_name(tag), 'clanLevel': 20,
+                  'members': [{'tag': '#' + player, 'name': name, 'townHallLevel': town_hall}
+                              for player, name, town_hall in self._roster(tag)[:CWL_ROSTER]]}
+                 for tag in self.cwl_groups[clan_tag]]
+        return {'state': state, 'season': season, 'clans': clans,
+                'rounds': [{'warTags': ['#' + war_tag for war_tag in war_tags]} for war_tags in self.cwl_rounds[clan_tag]]}
+
+    def cwl_war(self, war_tag: str):
+        # rounds before the last two are over, the second last is being fought, the last is in preparation
+        first, second, day = self.cwl_wars[war_tag]
+        rounds = CWL_CLANS - 1
+        end = self.now + timedelta(days=day - rounds + 3, hours=-1)
+        state = 'warEnded' if day < rounds - 2 else 'inWar' if day == rounds - 2 else 'preparation'
+        return dict(self._war(first, second, state, end, CWL_TEAM, 1, war_tag), warStartTime=_api_time(end - timedelta(days=1)))
+
+    def api_response(self, endpoint: str):
+        """(JSON bytes, status) for a CoC API URL, a 404 body like the API's for unknown tags."""
+        # /v1/players/%23TAG, /v1/clans/%23TAG/warlog, /v1/clanwarleagues/wars/%23TAG ...
+        parts = [urllib.parse.unquote(part) for part in urllib.parse.urlsplit(endpoint).path.split('/')[2:]]
+        tag = next((part[1:] for part in parts if part.startswith('#')), '')
+        route = [part for part in parts if not part.startswith('#')]
+        try:
+            if route == ['players']:
+                data = self.player(tag, self.days)
+            elif route == ['clans']:
+                data = self.clan(tag)
+            elif route == ['clans', 'currentwar']:
+                data = self.current_war(tag)
+            elif route == ['clans', 'warlog']:
+                data = self.warlog(tag)
+            elif route == ['clans', 'currentwar', 'leaguegroup']:
+                data = self.league_group(tag, self.season)
+            elif route == ['clanwarleagues', 'wars']:
+                data = self.cwl_war(tag)
+            else:
+                raise KeyError(endpoint)
+        except KeyError:
+            return dumps({'reason': 'notFound'}), 404
+        return dumps(data), 200
+
+    def write(self, path: str):
+        """Create the database at `path` (migrated to the current schema) and store the dataset in it."""
+        conn = sqlite3.connect(path)
+        conn.row_factory = sqlite3.Row
+        migrate(conn)
+        with app.app_context():
+            self._write_players(conn)
+            self._write_clans(conn)
+            conn.commit()
+            backfill_player_metrics(conn)
+            keyframe_interval = app.config.get('PLAYER_SNAPSHOT_KEYFRAME_INTERVAL', 1)
+            if keyframe_interval > 1:
+                rebuild_player_history(conn, keyframe_interval)
+            conn.commit()
+        conn.close()
+        return self
+
+    def _write_players(self, conn):
+        for tag in self.player_tags:
+            rows = []
+            for day in range(self.days):
+                data = dumps(self.player(tag, day))
+                data_time = _time(self.now - timedelta(days=self.days - day, hours=1))
+                rows.append((tag, data_time, encode_cocdata('player', data), content_hash(data)))
+            conn.executemany('INSERT INTO player (tag, dataTime, cocdata, contentHash) VALUES (?, ?, ?, ?)', rows)
+
+    def _write_clans(self, conn):
+        fresh = _time(self.now - timedelta(minutes=5))
+        for clan_tag in self.clan_tags:
+            clan = self.clan(clan_tag)
+            data = dumps(clan)
+            conn.execute('INSERT INTO clan (tag, dataTime, cocdata, contentHash) VALUES (?, ?, ?, ?)',
+                         (clan_tag, _time(self.now - timedelta(hours=1)), encode_cocdata('clan', data), content_hash(data)))
+            store_clan_members(conn, clan_tag, clan)
+
+            current = dumps(self.current_war(clan_tag))
+            conn.execute('INSERT INTO warlog (endTime, tag, cocdata, dataTime) VALUES (?, ?, ?, ?)',
+                         (clan_tag + _api_time(self.now + timedelta(hours=6))[:8], clan_tag, encode_cocdata('warlog', current), fresh))
+            conn.executemany('INSERT OR REPLACE INTO warlog (endTime, tag, cocdata, dataTime) VALUES (?, ?, ?, ?)',
+                             [(clan_tag + _api_time(end)[:8], clan_tag, encode_cocdata('warlog', dumps(self.finished_war(clan_tag, end))), _time(end))
+                              for end in self.war_ends[clan_tag]])
+            conn.execute('INSERT INTO clanwarlog (tag, cocdata, dataTime) VALUES (?, ?, ?)',
+                         (clan_tag, encode_cocdata('clanwarlog', dumps(self.warlog(clan_tag))), fresh))
+
+            for back, season in enumerate(self.seasons):
+                conn.execute('INSERT INTO clanwarleague (clanSeason, tag, cocdata, season, dataTime) VALUES (?, ?, ?, ?, ?)',
+                             (clan_tag + season, clan_tag, encode_cocdata('clanwarleague', dumps(self.league_group(clan_tag, season))),
+                              season, _time(self.now - timedelta(days=30 * back, hours=2))))
+            # wars are stored as they were last fetched: the one in preparation not yet, the running one 10 minutes ago
+            rows = []
+            for war_tags in self.cwl_rounds[clan_tag]:
+                for war_tag in war_tags:
+                    war = self.cwl_war(war_tag)
+                    if war['state'] == 'preparation':
+                        continue
+                    age = timedelta(minutes=10) if war['state'] == 'inWar' else timedelta(days=1)
+                    rows.append((self.season + war_tag, war_tag, encode_cocdata('cwlwarlog', dumps(war)), _time(self.now - age)))
+            conn.executemany('INSERT INTO cwlwarlog (seasonWarTag, warTag, cocdata, dataTime) VALUES (?, ?, ?, ?)', rows)
+
+
+def build_dataset(path: str, clans=4, members=50, days=90, seed=1):
+    """Generate a dataset into a new database at `path`, return its Dataset."""
+    return Dataset(clans=clans, members=members, days=days, seed=seed).write(path)
+
+
+@click.command()
+@click.argument('path', type=click.Path(dir_okay=False))
+@click.option('--clans', default=4, show_default=True, help='Clans, each with its own CWL group.')
+@click.option('--members', default=50, show_default=True, help='Members per clan.')
+@click.option('--days', default=90, show_default=True, help='Daily player snapshots per member.')
+@click.option('--seed', default=1, show_default=True)
+def main(path, clans, members, days, seed):
+    """Write a synthetic CoC dataset to a new SQLite database at PATH."""
+    if os.path.exists(path):
+        raise click.ClickException(f"{path} exists, the generator only writes new databases")
+    dataset = build_dataset(path, clans=clans, members=members, days=days, seed=seed)
+    click.echo(f"{path}: {len(dataset.clan_tags)} clans, {len(dataset.player_tags)} players x {days} days, "
+               f"{len(dataset.cwl_wars)} CWL wars of {dataset.season}, {os.path.getsize(path) / 1024 / 1024:.1f} MB")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,62 @@
+# app/benchmarks/json_codec.py
+# Decode and encode time per payload, standard library json against orjson, for
+# CoC API player snapshots as they are stored and for the clan progress document
+# the app builds from them, plus a stored snapshot sent back as it is against
+# parsing and encoding it again (the old /api/player/fetch path).
+#   DATABASE_PATH=/tmp python -m cocapi20250719.benchmarks.json_codec
+import json
+import random
+
+from .. import app
+from ..utils import jsoncodec
+from ..utils.blobs import decode_blob, encode_cocdata
+from .common import player_snapshot, print_results, time_calls
+
+
+def _payloads(players, days):
+    rnd = random.Random(1)
+    snapshots = [player_snapshot('BM%03d' % i, days, rnd) for i in range(players)]
+    raw = [json.dumps(snapshot).encode('utf-8') for snapshot in snapshots]
+    progress = {'memberList': [{'tag': s['tag'], 'name': s['name'], 'role': s['role'],
+                                'clanprogress': {str(day): s['warStars'] - day for day in range(days)}}
+                               for s in snapshots]}
+    return snapshots, raw, progress
+
+
+def _codecs():
+    codecs = {'json': (json.loads, lambda value: json.dumps(value, separators=(',', ':')).encode('utf-8'))}
+    if jsoncodec.orjson is not None:
+        codecs['orjson'] = (jsoncodec.orjson.loads, jsoncodec.orjson.dumps)
+    else:
+        print('orjson is not installed, only the standard library is measured')
+    return codecs
+
+
+def main(players=50, days=60, repeat=50):
+    snapshots, raw, progress = _payloads(players, days)
+    stored = [encode_cocdata('player', data) for data in raw]
+    kb = round(sum(len(data) for data in raw) / len(raw) / 1024, 1)
+
+    results = {}
+    with app.app_context():
+        for name, (loads, dumps) in _codecs().items():
+            per_snapshot = lambda stats: round(stats['median_ms'] / players, 4)
+            results[f"{name}: player snapshot ({kb} KB)"] = {
+                'loads_ms': per_snapshot(time_calls(lambda: [loads(data) for data in raw], repeat=repeat)),
+                'dumps_ms': per_snapshot(time_calls(lambda: [dumps(snapshot) for snapshot in snapshots], repeat=repeat)),
+                # a stored row: decompress, then parse and encode again or send as it is
+                'reencode_ms': per_snapshot(time_calls(lambda: [dumps(loads(decode_blob(blob))) for blob in stored], repeat=repeat)),
+                'passthrough_ms': per_snapshot(time_calls(lambda: [decode_blob(blob) for blob in stored], repeat=repeat)),
+            }
+            sorted_dumps = (lambda value: json.dumps(value, sort_keys=True, separators=(',', ':'))) if name == 'json' else (
+                    lambda value: jsoncodec.orjson.dumps(value, option=jsoncodec.orjson.OPT_SORT_KEYS))
+            size = round(len(sorted_dumps(progress)) / 1024, 1)
+            results[f"{name}: clan progress ({size} KB)"] = {
+                'dumps_sorted_ms': time_calls(lambda: sorted_dumps(progress), repeat=repeat)['median_ms'],
+            }
+
+    print_results(f"{players} player snapshots, median per payload (backend in use: {jsoncodec.BACKEND})", results)
+
+
+if __name__ == '__main__':
+    main()
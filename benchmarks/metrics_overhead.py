@@ -0,0 +1,84 @@
+# app/benchmarks/metrics_overhead.py
+# What utils/metrics.py adds to every request (its before / after / teardown
+# hooks, flushes included) and what a /metrics scrape costs, with the series of
+# several forked processes summed through process_metric as under mod_wsgi.
+#   DATABASE_PATH=/tmp python -m cocapi20250719.benchmarks.metrics_overhead
+import multiprocessing
+import os
+import shutil
+import sqlite3
+import time
+
+from flask import Response
+
+from .. import app
+from ..utils import metrics
+from ..utils.schema import migrate
+from .common import print_results, temp_db_path, time_calls
+
+ROUTE = 'clan.get_clan_details'
+
+
+def _hooks(requests):
+    response = Response(status=200)
+    with app.test_request_context('/api/clan/get_clan_details/BENCH'):
+        start = time.perf_counter()
+        for _ in range(requests):
+            metrics._start_request()
+            metrics._keep_status(response)
+            metrics._finish_request()
+        return (time.perf_counter() - start) / requests * 1e6
+
+
+def _worker(requests):
+    # a mod_wsgi daemon process: count some requests, then flush on the way out
+    with app.app_context():
+        for i in range(requests):
+            metrics.record_request(ROUTE, 200, 0.001 * (i % 20))
+        metrics.flush()
+
+
+def _scraped_count(text):
+    for line in text.splitlines():
+        if line.startswith(f'cocapi_request_duration_seconds_count{{route="{ROUTE}"}}'):
+            return int(float(line.rsplit(' ', 1)[1]))
+    return 0
+
+
+def main(requests=20000, processes=4):
+    db_path = temp_db_path()
+    conn = sqlite3.connect(db_path)
+    migrate(conn)
+    conn.close()
+    saved = {name: app.config.get(name) for name in ('DATABASE_PATH', 'METRICS_FLUSH_INTERVAL')}
+    app.config['DATABASE_PATH'] = db_path
+    results = {}
+    try:
+        for interval in (15, 0.01):
+            app.config['METRICS_FLUSH_INTERVAL'] = interval
+            results[f"request hooks, flush every {interval}s"] = {'us_per_request': round(_hooks(requests), 2)}
+
+        before = _scraped_count(app.test_client().get('/metrics').data.decode())
+        context = multiprocessing.get_context('fork')
+        workers = [context.Process(target=_worker, args=(1000,)) for _ in range(processes)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        client = app.test_client()
+        text = client.get('/metrics').data.decode()
+        scrape = time_calls(lambda: client.get('/metrics').data)
+        results[f"/metrics with {processes + 1} processes"] = {
+            'forked_requests_counted': _scraped_count(text) - before,
+            'expected': processes * 1000,
+            'scrape_ms': scrape['median_ms'],
+        }
+    finally:
+        app.config.update(saved)
+        shutil.rmtree(os.path.dirname(db_path), ignore_errors=True)
+
+    print_results('metrics collection', results)
+
+
+if __name__ == '__main__':
+    main()
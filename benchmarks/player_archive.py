@@ -0,0 +1,92 @@
+# app/benchmarks/player_archive.py
+# The player routes as the history grows, with every snapshot in the player
+# table and after flask archive-player-history moved all but PLAYER_HOT_DAYS
+# to the monthly partitions (utils/archive.py): the /fetch TTL check,
+# get_clan_details, get_player_info today and most of a year back, and
+# get_player_progress_data, next to the rows left hot and the file sizes.
+#   DATABASE_PATH=/tmp python -m cocapi20250719.benchmarks.player_archive --days 180 --days 730
+import logging
+import os
+import shutil
+from datetime import datetime, timedelta
+
+import click
+
+from .. import app
+from ..utils.db import connect
+from ..utils.ingest import archive_player_history
+from .common import print_results, temp_db_path, time_calls
+from .generator import Dataset
+
+
+def _routes(dataset, days: int):
+    player, clan = dataset.player_tags[0], dataset.clan_tags[0]
+    back = min(300, days - 10)
+    from_date = (datetime.now() - timedelta(days = back)).strftime('%Y-%m-%d')
+    return [
+        # a TTL that never runs out, the stored row answers without a CoC API call
+        ('fetch ttl check', f"/api/player/fetch/{player}/999999999"),
+        ('clan get_clan_details', f"/api/clan/get_clan_details/{clan}"),
+        ('player info', f"/api/player/get_player_info/{player}"),
+        (f"player info {back} days back", f"/api/player/get_player_info/{player}/{from_date}"),
+        ('player progress', f"/api/player/get_player_progress_data/{player}"),
+    ]
+
+
+def _measure(db_path, routes, repeat: int):
+    client = app.test_client()
+    stats = {}
+    for name, url in routes:
+        status = client.get(url).status_code
+        stats[f"{name} ms"] = time_calls(lambda: client.get(url).get_data(), repeat = repeat)['median_ms']
+        if status != 200:
+            stats[f"{name} status"] = status
+    conn = connect(db_path, app.config)
+    stats['hot rows'] = conn.execute('SELECT COUNT(*) FROM player').fetchone()[0]
+    conn.close()
+    archive = os.path.splitext(db_path)[0] + '-archive.db'
+    stats['db_mb'] = round(os.path.getsize(db_path) / 1024 / 1024, 2)
+    stats['archive_mb'] = round(os.path.getsize(archive) / 1024 / 1024, 2) if os.path.exists(archive) else 0
+    return stats
+
+
+@click.command()
+@click.option('--clans', default=2, show_default=True)
+@click.option('--members', default=30, show_default=True)
+@click.option('--days', 'day_counts', multiple=True, type=int, help='Daily snapshots per member, repeatable. Default 180, 365, 730.')
+@click.option('--hot-days', default=120, show_default=True, help='History kept in the player table after archiving.')
+@click.option('--keyframe-interval', default=30, show_default=True, help='PLAYER_SNAPSHOT_KEYFRAME_INTERVAL of the dataset.')
+@click.option('--repeat', default=20, show_default=True, help='Timed requests per route.')
+def main(clans, members, day_counts, hot_days, keyframe_interval, repeat):
+    """Player route latency against history length, with and without the archive tier."""
+    names = ('DATABASE_PATH', 'RESPONSE_CACHE_MAX_BYTES', 'PLAYER_SNAPSHOT_KEYFRAME_INTERVAL', 'PLAYER_ARCHIVE_PATH')
+    saved = {name: app.config.get(name) for name in names}
+    log_level = app.logger.level
+    app.logger.setLevel(logging.ERROR)
+    results = {}
+    try:
+        for days in day_counts or (180, 365, 730):
+            dataset = Dataset(clans = clans, members = members, days = days)
+            db_path = temp_db_path()
+            # the archive goes beside the dataset, see utils/archive.py archive_path()
+            app.config.update(DATABASE_PATH = db_path, RESPONSE_CACHE_MAX_BYTES = 0,
+                              PLAYER_SNAPSHOT_KEYFRAME_INTERVAL = keyframe_interval, PLAYER_ARCHIVE_PATH = None)
+            dataset.write(db_path)
+            routes = _routes(dataset, days)
+            results[f"{days} days, all hot"] = _measure(db_path, routes, repeat)
+            with app.app_context():
+                conn = connect(db_path, app.config)
+                archive_player_history(conn, hot_days)
+                conn.execute('VACUUM')
+                conn.close()
+            results[f"{days} days, {hot_days} hot"] = _measure(db_path, routes, repeat)
+            shutil.rmtree(os.path.dirname(db_path), ignore_errors=True)
+    finally:
+        app.config.update(saved)
+        app.logger.setLevel(log_level)
+
+    print_results(f"{clans} clans x {members} members, keyframe every {keyframe_interval}", results)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,53 @@
+# app/benchmarks/player_deltas.py
+# Player history stored in full against keyframes plus deltas: database size,
+# the newest snapshot of every member, one snapshot from the middle of a chain
+# and a forward walk over a player's whole history.
+#   DATABASE_PATH=/tmp python -m cocapi20250719.benchmarks.player_deltas
+import os
+import shutil
+import sqlite3
+
+from .. import app
+from ..utils.blobs import recompress_table
+from ..utils.ingest import rebuild_player_history
+from ..utils.snapshots import iter_player_snapshots, load_latest_snapshots, load_player_snapshot
+from .common import build_clan_db, temp_db_path, time_calls, print_results
+
+CLAN_TAG = 'BENCHCLAN'
+
+
+def main(members=50, days=365):
+    base_path = temp_db_path()
+    tags = build_clan_db(base_path, members=members, days=days, clan_tag=CLAN_TAG)
+
+    variants = [('full', 'none', 1), ('zlib', 'zlib', 1),
+                ('deltas / 30', 'none', 30), ('zlib + deltas / 30', 'zlib', 30), ('zlib + deltas / 90', 'zlib', 90)]
+    results = {}
+    with app.app_context():
+        for name, codec, interval in variants:
+            app.config['COCDATA_COMPRESSION'] = codec
+            db_path = os.path.join(os.path.dirname(base_path), f"{codec}{interval}.db")
+            shutil.copy(base_path, db_path)
+            conn = sqlite3.connect(db_path)
+            conn.row_factory = sqlite3.Row
+            recompress_table(conn, 'player', codec)
+            rebuild_player_history(conn, interval)
+            conn.commit()
+            conn.execute('VACUUM')
+
+            data_times = [row[0] for row in conn.execute('SELECT dataTime FROM player WHERE tag = ? ORDER BY dataTime', (tags[0],))]
+            middle = data_times[len(data_times) // 2]
+            stats = {'db_mb': round(os.path.getsize(db_path) / 1024 / 1024, 2)}
+            stats['latest_members_ms'] = time_calls(lambda: load_latest_snapshots(conn, 'player', tags))['median_ms']
+            stats['old_snapshot_ms'] = time_calls(lambda: load_player_snapshot(conn, tags[0], middle))['median_ms']
+            stats['history_walk_ms'] = time_calls(lambda: list(iter_player_snapshots(conn, tags[0])), repeat=5)['median_ms']
+            results[name] = stats
+            conn.close()
+        app.config['COCDATA_COMPRESSION'] = 'none'
+
+    print_results(f"{members} members x {days} daily snapshots", results)
+    shutil.rmtree(os.path.dirname(base_path), ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
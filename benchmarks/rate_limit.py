@@ -0,0 +1,126 @@
+# app/benchmarks/rate_limit.py
+# Concurrent CoC API calls against a local stub that enforces a token bucket per
+# API key and answers 429 beyond it, as the real API does. Throughput, 429s seen
+# and queue wait for a pool of 1, 2 and 4 keys through utils/ratelimit.py, and
+# for one key with the limiter effectively off.
+#   DATABASE_PATH=/tmp python -m cocapi20250719.benchmarks.rate_limit
+import os
+import shutil
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from .. import app
+from ..utils.coc_api import client_stats, fetch_coc_api_data
+from ..utils.ratelimit import rate_limiter_stats
+from ..utils.schema import migrate
+from .common import print_results, temp_db_path
+
+STUB_RATE = 20 # calls per second per key the stub allows
+STUB_BURST = 5
+
+
+class StubRateLimitedApi(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, rate: float, burst: float):
+        super().__init__(('127.0.0.1', 0), StubHandler)
+        self.rate = rate
+        self.burst = burst
+        self.buckets = {} # key -> (tokens, updated)
+        self.served = 0
+        self.rejected = 0
+        self.lock = threading.Lock()
+
+    @property
+    def base_url(self):
+        return f'http://127.0.0.1:{self.server_address[1]}'
+
+    def admit(self, key: str):
+        now = time.monotonic()
+        with self.lock:
+            tokens, updated = self.buckets.get(key, (self.burst, now))
+            tokens = min(self.burst, tokens + (now - updated) * self.rate)
+            allowed = tokens >= 1.0
+            self.buckets[key] = (tokens - allowed, now)
+            if allowed:
+                self.served += 1
+            else:
+                self.rejected += 1
+            return allowed
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+
+    def do_GET(self):
+        if self.server.admit(self.headers.get('Authorization', '')):
+            self.send_response(200)
+            body = b'{"tag": "#STUB"}'
+        else:
+            self.send_response(429)
+            body = b'{"reason": "requestThrottled"}'
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def _run(server, keys, calls, workers):
+    server.served = server.rejected = 0
+    app.config['APIKEYS'] = keys
+    limiter_before, client_before = rate_limiter_stats(), client_stats()
+
+    def call(i):
+        with app.app_context():
+            return fetch_coc_api_data(endpoint=f'{server.base_url}/v1/players/%23P{i}', data_type='bench', tag_value=str(i))[1]
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers = workers) as executor:
+        statuses = list(executor.map(call, range(calls)))
+    elapsed = time.perf_counter() - start
+    limiter, client = rate_limiter_stats(), client_stats()
+    waits = limiter['waits'] - limiter_before['waits']
+    return {
+        'calls_per_s': round(statuses.count(200) / elapsed, 1),
+        'ok': statuses.count(200),
+        'failed': len(statuses) - statuses.count(200),
+        'stub_429s': server.rejected,
+        'retries': client['retries'] - client_before['retries'],
+        'mean_wait_ms': round((limiter['wait_seconds'] - limiter_before['wait_seconds']) * 1000 / max(1, waits), 1),
+    }
+
+
+def main(calls=200, workers=16):
+    db_path = temp_db_path()
+    conn = sqlite3.connect(db_path)
+    migrate(conn)
+    conn.close()
+    server = StubRateLimitedApi(STUB_RATE, STUB_BURST)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    saved = {name: app.config.get(name) for name in ('DATABASE_PATH', 'APIKEYS', 'COC_API_KEY_RATE', 'COC_API_KEY_BURST')}
+    app.config.update(DATABASE_PATH = db_path, COC_API_KEY_BURST = STUB_BURST)
+    results = {}
+    try:
+        app.config['COC_API_KEY_RATE'] = 1000
+        results['1 key, limiter off'] = _run(server, ['off-1'], calls, workers)
+        app.config['COC_API_KEY_RATE'] = STUB_RATE * 0.95
+        for count in (1, 2, 4):
+            results[f"{count} key{'s' if count > 1 else ''}"] = _run(server, [f"key-{count}-{i}" for i in range(count)], calls, workers)
+    finally:
+        app.config.update(saved)
+        server.shutdown()
+        shutil.rmtree(os.path.dirname(db_path), ignore_errors=True)
+
+    print_results(f"{calls} calls from {workers} threads, stub allows {STUB_RATE}/s per key", results)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,256 @@
+# app/benchmarks/routes.py
+# Every route of api/clan, api/player and api/cwl driven through Flask's test
+# client against a generated dataset (benchmarks/generator.py), with
+# fetch_coc_api_data stubbed by the dataset's payloads so the /fetch routes and
+# the refreshes of stale data run offline. Per route: the latency distribution,
+# the peak Python heap of a request (tracemalloc, in a pass of its own so it
+# does not slow the timed one) and what utils/timing.py counted: SQL queries,
+# rows, JSON bytes decoded and CoC API calls. --output saves the run as JSON,
+# --compare prints it against a saved run, e.g. of the commit before.
+#   DATABASE_PATH=/tmp python -m cocapi20250719.benchmarks.routes --output /tmp/before.json
+#   DATABASE_PATH=/tmp python -m cocapi20250719.benchmarks.routes --compare /tmp/before.json
+import json
+import logging
+import os
+import platform
+import shutil
+import sqlite3
+import statistics
+import subprocess
+import sys
+import time
+import tracemalloc
+import urllib.parse
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+
+import click
+
+from .. import app
+from ..utils import coc_api, jsoncodec
+from ..utils.timing import current_timings, last_request_timings
+from .common import print_results, temp_db_path
+from .generator import Dataset
+
+_quote = urllib.parse.quote
+
+
+def _clan(d, i):
+    return d.clan_tags[i % len(d.clan_tags)]
+
+
+def _player(d, i):
+    # members of every clan in turn
+    return d.player_tags[i * 7 % len(d.player_tags)]
+
+
+def _war_date(d, i):
+    ends = d.war_ends[_clan(d, i)]
+    return ends[i % len(ends)].strftime('%Y%m%d')
+
+
+def _war_tag(d, i):
+    war_tags = list(d.cwl_wars)
+    return war_tags[i * 5 % len(war_tags)]
+
+
+# (name, url of the i-th request), the routes that write or call the CoC API every time are marked upstream
+ROUTES = [
+    ('clan get_clan_details', lambda d, i: f"/api/clan/get_clan_details/{_clan(d, i)}"),
+    ('clan supertroops', lambda d, i: f"/api/clan/supertroops/{_clan(d, i)}"),
+    ('clan troops', lambda d, i: f"/api/clan/troops/{_clan(d, i)}"),
+    ('clan progress', lambda d, i: f"/api/clan/progress/{_clan(d, i)}"),
+    ('clan progress achievement', lambda d, i: f"/api/clan/progress/{_clan(d, i)}/{_quote('Friend in Need')}"),
+    ('clan currentwar', lambda d, i: f"/api/clan/currentwar/{_clan(d, i)}"),
+    ('clan currentwar upstream', lambda d, i: f"/api/clan/currentwar/{_clan(d, i)}/now"),
+    ('clan warlog', lambda d, i: f"/api/clan/warlog/{_clan(d, i)}"),
+    ('clan wardetail', lambda d, i: f"/api/clan/wardetail/{_clan(d, i)}/{_war_date(d, i)}"),
+    ('clan fetch', lambda d, i: f"/api/clan/fetch/{_clan(d, i)}"),
+    ('clan fetch upstream', lambda d, i: f"/api/clan/fetch/{_clan(d, i)}/0"),
+    ('clan fetch_members upstream', lambda d, i: f"/api/clan/fetch_members/{_clan(d, i)}/0"),
+    ('player get_player_info', lambda d, i: f"/api/player/get_player_info/{_player(d, i)}"),
+    ('player get_player_info from_date', lambda d, i: f"/api/player/get_player_info/{_player(d, i)}/"
+                                                       f"{(d.now - timedelta(days=d.days // 2)).strftime('%Y-%m-%d')}"),
+    ('player get_player_progress_data', lambda d, i: f"/api/player/get_player_progress_data/{_player(d, i)}"),
+    ('player fetch', lambda d, i: f"/api/player/fetch/{_player(d, i)}"),
+    ('player fetch upstream', lambda d, i: f"/api/player/fetch/{_player(d, i)}/0"),
+    ('cwl get_cwl_list', lambda d, i: f"/api/cwl/get_cwl_list/{_clan(d, i)}"),
+    ('cwl get_cwl_season_data', lambda d, i: f"/api/cwl/get_cwl_season_data/{_clan(d, i)}"),
+    ('cwl get_cwl_season_data season', lambda d, i: f"/api/cwl/get_cwl_season_data/{_clan(d, i)}/{d.seasons[1]}"),
+    ('cwl wartag', lambda d, i: f"/api/cwl/wartag/{_war_tag(d, i)}/{d.season}"),
+    ('cwl summary', lambda d, i: f"/api/cwl/summary/{_clan(d, i)}/{d.season}"),
+    ('cwl fetch upstream', lambda d, i: f"/api/cwl/fetch/{_clan(d, i)}"),
+]
+
+# per request counters of utils/timing.py kept as their median
+COUNTERS = ('queries', 'rows', 'sql_ms', 'decoded_bytes', 'decode_ms', 'upstream_calls', 'upstream_ms')
+
+
+@contextmanager
+def stubbed_coc_api(dataset, latency: float = 0.0):
+    """
+    Answer fetch_coc_api_data from `dataset` in every module that imported it,
+    after `latency` seconds, counting the calls into the request timings as the
+    real client does.
+    """
+    original = coc_api.fetch_coc_api_data
+
+    def fetch_coc_api_data(endpoint: str, data_type: str, tag_value: str):
+        start = time.perf_counter()
+        if latency:
+            time.sleep(latency)
+        data, status_code = dataset.api_response(endpoint)
+        timings = current_timings()
+        if timings is not None:
+            timings.add_upstream(urllib.parse.urlsplit(endpoint).path, status_code, (time.perf_counter() - start) * 1000)
+        if status_code >= 400:
+            return jsoncodec.dumps({'error': data.decode('utf-8')}), status_code
+        return data, status_code
+
+    package = __package__.rpartition('.')[0]
+    modules = [module for name, module in list(sys.modules.items())
+               if name.startswith(package) and getattr(module, 'fetch_coc_api_data', None) is original]
+    for module in modules:
+        module.fetch_coc_api_data = fetch_coc_api_data
+    try:
+        yield
+    finally:
+        for module in modules:
+            module.fetch_coc_api_data = original
+
+
+def _request(client, url):
+    # the whole body is read and the response closed, a streamed one finishes its request only then
+    start = time.perf_counter()
+    response = client.get(url)
+    size = len(response.get_data())
+    response.close()
+    return (time.perf_counter() - start) * 1000, response.status_code, size, last_request_timings() or {}
+
+
+def _distribution(samples):
+    samples = sorted(samples)
+    pick = lambda q: round(samples[min(len(samples) - 1, int(q * len(samples)))], 3)
+    return {
+        'n': len(samples), 'mean_ms': round(statistics.fmean(samples), 3),
+        'stdev_ms': round(statistics.stdev(samples), 3) if len(samples) > 1 else 0.0,
+        'min_ms': round(samples[0], 3), 'p50_ms': pick(0.5), 'p90_ms': pick(0.9), 'p99_ms': pick(0.99),
+        'max_ms': round(samples[-1], 3),
+    }
+
+
+def measure_route(client, dataset, url, repeat: int, warmup: int = 2, alloc_repeat: int = 3):
+    latencies, statuses, sizes, counters, peaks = [], {}, [], [], []
+    for i in range(warmup):
+        _request(client, url(dataset, i))
+    for i in range(warmup, warmup + repeat):
+        ms, status_code, size, timings = _request(client, url(dataset, i))
+        latencies.append(ms)
+        statuses[str(status_code)] = statuses.get(str(status_code), 0) + 1
+        sizes.append(size)
+        counters.append(timings)
+    for i in range(warmup + repeat, warmup + repeat + alloc_repeat):
+        tracemalloc.start()
+        _request(client, url(dataset, i))
+        peaks.append(tracemalloc.get_traced_memory()[1])
+        tracemalloc.stop()
+    result = _distribution(latencies)
+    result.update({name: statistics.median(timings.get(name, 0) for timings in counters) for name in COUNTERS})
+    result.update(status = statuses, body_bytes = statistics.median(sizes), peak_alloc_kb = round(statistics.median(peaks) / 1024, 1))
+    return result
+
+
+def _commit():
+    try:
+        return subprocess.run(['git', 'describe', '--always', '--dirty'], cwd=os.path.dirname(os.path.dirname(__file__)),
+                              capture_output=True, text=True, timeout=30).stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        return None
+
+
+def run(dataset, routes, repeat: int, response_cache: bool, upstream_ms: float):
+    """Generate `dataset` into a temporary database and measure `routes` on it, return the results document."""
+    db_path = temp_db_path()
+    dataset.write(db_path)
+    saved = {name: app.config.get(name) for name in ('DATABASE_PATH', 'RESPONSE_CACHE_MAX_BYTES', 'REQUEST_TIMING')}
+    log_level = app.logger.level
+    app.config.update(DATABASE_PATH = db_path, REQUEST_TIMING = True)
+    if not response_cache:
+        # the handlers themselves, not the cache in front of them
+        app.config['RESPONSE_CACHE_MAX_BYTES'] = 0
+    # the INFO lines of every request would be measured with it
+    app.logger.setLevel(logging.WARNING)
+    results = {}
+    try:
+        client = app.test_client()
+        with stubbed_coc_api(dataset, upstream_ms / 1000):
+            for name, url in routes:
+                results[name] = measure_route(client, dataset, url, repeat)
+    finally:
+        app.config.update(saved)
+        app.logger.setLevel(log_level)
+        shutil.rmtree(os.path.dirname(db_path), ignore_errors=True)
+    return {
+        'meta': {
+            'commit': _commit(), 'date': datetime.now().isoformat(timespec='seconds'),
+            'python': platform.python_version(), 'sqlite': sqlite3.sqlite_version, 'json_backend': jsoncodec.BACKEND,
+            'dataset': {'clans': len(dataset.clan_tags), 'members': dataset.members, 'days': dataset.days, 'seed': dataset.seed},
+            'repeat': repeat, 'response_cache': response_cache, 'upstream_ms': upstream_ms,
+        },
+        'routes': results,
+    }
+
+
+def _change(before, after):
+    if not before:
+        return ''
+    return f" ({(after - before) / before:+.0%})"
+
+
+def compare(before, after):
+    """Print the routes of two results documents side by side."""
+    print(f"{before['meta'].get('commit')} ({before['meta'].get('date')}) -> {after['meta'].get('commit')} ({after['meta'].get('date')})")
+    for key in ('dataset', 'repeat', 'response_cache', 'upstream_ms', 'python', 'sqlite', 'json_backend'):
+        if before['meta'].get(key) != after['meta'].get(key):
+            print(f"  note: {key} differs, {before['meta'].get(key)} -> {after['meta'].get(key)}")
+    for name, stats in after['routes'].items():
+        old = before['routes'].get(name)
+        if old is None:
+            print(f"  {name:<36} new")
+            continue
+        print(f"  {name:<36} p50 {old['p50_ms']} -> {stats['p50_ms']} ms{_change(old['p50_ms'], stats['p50_ms'])}"
+              f"  p90 {old['p90_ms']} -> {stats['p90_ms']} ms{_change(old['p90_ms'], stats['p90_ms'])}"
+              f"  queries {old['queries']} -> {stats['queries']}  peak {old['peak_alloc_kb']} -> {stats['peak_alloc_kb']} KB")
+
+
+@click.command()
+@click.option('--clans', default=2, show_default=True)
+@click.option('--members', default=50, show_default=True)
+@click.option('--days', default=60, show_default=True, help='Daily player snapshots per member.')
+@click.option('--seed', default=1, show_default=True)
+@click.option('--repeat', default=30, show_default=True, help='Timed requests per route, after 2 warm-up ones.')
+@click.option('--route', 'only', multiple=True, help='Only the routes whose name contains this, repeatable.')
+@click.option('--response-cache', is_flag=True, help='Leave the response cache on, repeated reads are then cache hits.')
+@click.option('--upstream-ms', default=0.0, show_default=True, help='Latency of every stubbed CoC API call.')
+@click.option('--output', type=click.Path(dir_okay=False), help='Save the results as JSON.')
+@click.option('--compare', 'baseline', type=click.Path(exists=True, dir_okay=False), help='Results JSON to compare against.')
+def main(clans, members, days, seed, repeat, only, response_cache, upstream_ms, output, baseline):
+    """Measure every API route on a generated dataset with a stubbed CoC API."""
+    routes = [(name, url) for name, url in ROUTES if not only or any(part in name for part in only)]
+    dataset = Dataset(clans=clans, members=members, days=days, seed=seed)
+    results = run(dataset, routes, repeat, response_cache, upstream_ms)
+
+    print_results(f"{len(routes)} routes, {clans} clans x {members} members x {days} days, "
+                  f"{repeat} requests each ({results['meta']['commit']})",
+                  {name: {key: stats[key] for key in ('p50_ms', 'p90_ms', 'p99_ms', 'queries', 'rows', 'upstream_calls', 'peak_alloc_kb', 'status')}
+                   for name, stats in results['routes'].items()})
+    if output:
+        with open(output, 'w') as f:
+            json.dump(results, f, indent=1, sort_keys=True)
+    if baseline:
+        with open(baseline) as f:
+            compare(json.load(f), results)
+
+
+if __name__ == '__main__':
+    main()
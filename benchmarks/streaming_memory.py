@@ -0,0 +1,78 @@
+# app/benchmarks/streaming_memory.py
+# Peak Python heap (tracemalloc) while one progress response is built and sent,
+# jsonify-style (STREAM_JSON_RESPONSES off) against chunked streaming, for a
+# growing player history and a growing clan. The response cache is off so only
+# the request itself is measured.
+#   DATABASE_PATH=/tmp python -m cocapi20250719.benchmarks.streaming_memory
+import os
+import shutil
+import sqlite3
+import tracemalloc
+
+from .. import app
+from ..utils.ingest import backfill_player_metrics
+from .common import build_clan_db, print_results, temp_db_path
+
+CLAN_TAG = 'BENCHCLAN'
+
+
+def _build(members, days):
+    path = temp_db_path()
+    tags = build_clan_db(path, members=members, days=days, clan_tag=CLAN_TAG)
+    conn = sqlite3.connect(path)
+    conn.row_factory = sqlite3.Row
+    with app.app_context():
+        backfill_player_metrics(conn)
+    conn.close()
+    return path, tags
+
+
+def _peak(client, url):
+    # send the whole body and drop every chunk, as the WSGI server does
+    tracemalloc.start()
+    response = client.get(url, buffered=False)
+    size = sum(len(chunk) for chunk in response.response)
+    response.close()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    assert response.status_code == 200, response.status_code
+    return size, peak
+
+
+def _measure(path, url):
+    app.config['DATABASE_PATH'] = path
+    client = app.test_client()
+    result = {}
+    for mode, streaming in (('jsonify', False), ('stream', True)):
+        app.config['STREAM_JSON_RESPONSES'] = streaming
+        client.get(url, buffered=False).close() # warm the connection and statement caches
+        size, peak = _peak(client, url)
+        result['body_kb'] = round(size / 1024, 1)
+        result[f'{mode}_peak_kb'] = round(peak / 1024, 1)
+    return result
+
+
+def main():
+    saved = {name: app.config.get(name) for name in ('DATABASE_PATH', 'STREAM_JSON_RESPONSES', 'RESPONSE_CACHE_MAX_BYTES')}
+    app.config['RESPONSE_CACHE_MAX_BYTES'] = 0
+    results = {}
+    paths = []
+    try:
+        for days in (90, 180, 360):
+            path, tags = _build(members=2, days=days)
+            paths.append(path)
+            results[f"player progress, {days} days"] = _measure(path, f'/api/player/get_player_progress_data/{tags[0]}')
+        for members in (25, 50, 100):
+            path, tags = _build(members=members, days=61)
+            paths.append(path)
+            results[f"clan progress, {members} members"] = _measure(path, f'/api/clan/progress/{CLAN_TAG}/Gold Grab')
+    finally:
+        app.config.update(saved)
+        for path in paths:
+            shutil.rmtree(os.path.dirname(path), ignore_errors=True)
+
+    print_results('peak traced heap per request', results)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,164 @@
+# ./cli.py
+# Maintenance commands, e.g.
+#   flask --app cocapi20250719 backfill-metrics
+import click
+from flask import current_app
+from flask.cli import with_appcontext
+
+from .utils.blobs import CODECS, COCDATA_TABLES, recompress_table, train_dictionary
+from .utils.db import get_db
+from .utils.ingest import archive_player_history, backfill_player_metrics, rebuild_player_history
+from .utils.refresh import refresh_clan_members
+from .utils.scheduler import RefreshScheduler
+from .utils.schema import check_query_plans
+
+
+@click.command('archive-player-history')
+@click.option('--hot-days', type=int, default=None, help='Days of history kept in the player table. Default PLAYER_HOT_DAYS.')
+@click.option('--tag-batch', default=100, show_default=True, help='Players moved and committed per batch.')
+@click.option('--vacuum', is_flag=True, help='VACUUM afterwards to return the freed pages to the filesystem.')
+@with_appcontext
+def archive_player_history_command(hot_days: int, tag_batch: int, vacuum: bool):
+    """Move the older player history to the monthly archive partitions while the site keeps serving."""
+    if hot_days is None:
+        hot_days = current_app.config.get('PLAYER_HOT_DAYS', 120)
+    if hot_days < 1:
+        raise click.BadParameter('must be at least 1', param_hint='--hot-days')
+    conn = get_db()
+    try:
+        archived, moved, skipped = archive_player_history(
+                conn, hot_days,
+                tag_batch = tag_batch,
+                progress = lambda players, rows, tag: click.echo(f"{players} players, {rows} rows archived, at {tag}")
+                )
+    except ValueError as e:
+        raise click.ClickException(str(e))
+    click.echo(f"player: {archived} players, {moved} rows archived, {skipped} corrupt skipped")
+    if vacuum:
+        conn.execute('VACUUM')
+        click.echo('vacuum complete')
+
+
+@click.command('backfill-metrics')
+@click.option('--chunk-size', default=500, show_default=True, help='Snapshots decoded and committed per batch.')
+@with_appcontext
+def backfill_metrics_command(chunk_size: int):
+    """Fill player_metric, player_unit_level and player_upgrade from the existing player history."""
+    processed, skipped = backfill_player_metrics(
+            get_db(),
+            chunk_size = chunk_size,
+            progress = lambda done, bad, key: click.echo(f"{done} snapshots processed, {bad} skipped, at {key[0]} {key[1]}")
+            )
+    click.echo(f"backfill complete: {processed} snapshots processed, {skipped} malformed snapshots skipped")
+
+
+@click.command('check-query-plans')
+@click.option('--verbose', is_flag=True, help='Print the full plan of every query.')
+@with_appcontext
+def check_query_plans_command(verbose: bool):
+    """EXPLAIN QUERY PLAN every hot route query and fail on full scans or temp B-tree sorts."""
+    failed = 0
+    for route, plan, problems in check_query_plans(get_db()):
+        click.echo(f"{'FAIL' if problems else 'ok'}  {route}")
+        for problem in problems:
+            click.echo(f"      {problem}")
+        if verbose:
+            for detail in plan:
+                click.echo(f"        | {detail}")
+        failed += bool(problems)
+    if failed:
+        raise click.ClickException(f"{failed} queries regressed to full scans or sorts")
+
+
+@click.command('compress-cocdata')
+@click.option('--codec', type=click.Choice(CODECS), default='zlib', show_default=True, help='Target format, none decompresses.')
+@click.option('--level', default=6, show_default=True, help='Compression level.')
+@click.option('--table', 'tables', multiple=True, type=click.Choice(COCDATA_TABLES), help='Tables to rewrite, default all.')
+@click.option('--dictionary', is_flag=True, help='Train a dictionary per table from its newest rows and compress with it.')
+@click.option('--batch-size', default=500, show_default=True, help='Rows rewritten and committed per batch.')
+@click.option('--vacuum', is_flag=True, help='VACUUM afterwards to return the freed pages to the filesystem.')
+@with_appcontext
+def compress_cocdata_command(codec: str, level: int, tables, dictionary: bool, batch_size: int, vacuum: bool):
+    """Rewrite stored cocdata into another format while the site keeps serving."""
+    conn = get_db()
+    for table in tables or COCDATA_TABLES:
+        dictionary_id = None
+        if dictionary and codec != 'none':
+            try:
+                dictionary_id = train_dictionary(conn, table, codec)
+            except ValueError as e:
+                click.echo(f"{table}: no dictionary, {e}")
+            else:
+                click.echo(f"{table}: trained dictionary {dictionary_id}")
+        seen, rewritten, skipped, bytes_before, bytes_after = recompress_table(
+                conn, table, codec,
+                level = level,
+                dictionary_id = dictionary_id,
+                batch_size = batch_size,
+                progress = lambda name, done, changed: click.echo(f"{name}: {done} rows, {changed} rewritten")
+                )
+        click.echo(f"{table}: {seen} rows, {rewritten} rewritten, {skipped} corrupt skipped, "
+                   f"cocdata {bytes_before} -> {bytes_after} bytes")
+    if vacuum:
+        conn.execute('VACUUM')
+        click.echo('vacuum complete')
+    elif codec != 'none':
+        click.echo('run with --vacuum (or VACUUM) to shrink the database file')
+
+
+@click.command('encode-player-history')
+@click.option('--keyframe-interval', type=int, default=None,
+              help='Snapshots per keyframe, 1 stores every one in full. Default PLAYER_SNAPSHOT_KEYFRAME_INTERVAL.')
+@click.option('--chunk-size', default=500, show_default=True, help='Snapshots re-encoded and committed per batch.')
+@click.option('--vacuum', is_flag=True, help='VACUUM afterwards to return the freed pages to the filesystem.')
+@with_appcontext
+def encode_player_history_command(keyframe_interval: int, chunk_size: int, vacuum: bool):
+    """Re-encode the stored player history as keyframes and deltas while the site keeps serving."""
+    if keyframe_interval is None:
+        keyframe_interval = current_app.config.get('PLAYER_SNAPSHOT_KEYFRAME_INTERVAL', 1)
+    if keyframe_interval < 1:
+        raise click.BadParameter('must be at least 1', param_hint='--keyframe-interval')
+    conn = get_db()
+    seen, rewritten, skipped, bytes_before, bytes_after = rebuild_player_history(
+            conn, keyframe_interval,
+            chunk_size = chunk_size,
+            progress = lambda done, changed, key: click.echo(f"{done} snapshots, {changed} rewritten, at {key[0]} {key[1]}")
+            )
+    click.echo(f"player: {seen} snapshots, {rewritten} rewritten, {skipped} corrupt skipped, "
+               f"cocdata {bytes_before} -> {bytes_after} bytes")
+    if vacuum:
+        conn.execute('VACUUM')
+        click.echo('vacuum complete')
+
+
+@click.command('fetch-clan-members')
+@click.argument('clan_tag')
+@click.option('--max-age', default=82801, show_default=True, help='Seconds since a member was last fetched before it is fetched again.')
+@with_appcontext
+def fetch_clan_members_command(clan_tag: str, max_age: int):
+    """Fetch the members of a stored clan from the CoC API in parallel and store them in one transaction."""
+    report, status_code = refresh_clan_members(get_db(), clan_tag.lstrip('#'), max_age)
+    if status_code != 200:
+        raise click.ClickException(report['error'])
+    for player_tag, member in report['members'].items():
+        detail = member.get('error') or member.get('dataTime', '')
+        click.echo(f"{player_tag:<12} {member['status']:<9} {member.get('fetch_ms', ''):>8} {detail}")
+    counts = ', '.join(f"{count} {status}" for status, count in report['counts'].items())
+    click.echo(f"{clan_tag}: {counts}; fetch {report['fetch_ms']} ms, store {report['store_ms']} ms, total {report['total_ms']} ms")
+
+
+@click.command('refresh-scheduler')
+@click.option('--concurrency', type=int, default=None, help='Refreshes in flight. Default REFRESH_CONCURRENCY.')
+@click.option('--rate', type=float, default=None, help='Refreshes started per second at most. Default REFRESH_RATE.')
+@click.option('--once', is_flag=True, help='Refresh whatever is due now and exit, e.g. from cron.')
+@with_appcontext
+def refresh_scheduler_command(concurrency: int, rate: float, once: bool):
+    """Keep every known clan, member, current war, CWL group and CWL war refreshed from the CoC API."""
+    scheduler = RefreshScheduler(current_app._get_current_object(), concurrency = concurrency, rate = rate)
+    click.echo(f"refresh scheduler: {scheduler.concurrency} workers, {scheduler.rate} refreshes/s")
+    try:
+        stats = scheduler.run(until_idle = once)
+    except KeyboardInterrupt:
+        stats = dict(scheduler.stats)
+    click.echo(f"refresh scheduler stopped: {stats['refreshes']} refreshes, {stats['failures']} failed, "
+               f"{stats['rate_limited']} rate limited, {scheduler.queued()} queued")
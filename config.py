@@ -10,12 +10,67 @@ class Config:
     # SECRET_KEY = os.environ.get('SECRET_KEY') or 'default-secret-key'
     SECRET_KEY = os.urandom(24).hex()
     APIKEY = os.environ.get('APIKEY')
+    # pool of CoC API keys, comma separated, calls are spread over them (utils/ratelimit.py); empty uses APIKEY
+    APIKEYS = [key.strip() for key in os.environ.get('APIKEYS', '').split(',') if key.strip()]
+    COC_API_URL = 'https://api.clashofclans.com/v1'
+    COC_API_TIMEOUT = 10 # seconds per CoC API call on the pooled keep-alive connection
+    COC_API_KEY_RATE = 10 # calls per second per key, shared by all processes
+    COC_API_KEY_BURST = 10 # calls a key that sat idle may make at once
+    COC_API_MAX_QUEUE_WAIT = 30 # seconds a call waits for a free key before failing with 429
+    COC_API_RETRIES = 3 # retries of a call answered 429 or 503
+    COC_API_BACKOFF = 0.5 # seconds, base of the jittered exponential backoff between them
+    COC_API_BACKOFF_MAX = 30
+    COC_API_ASYNC_CONNECTIONS = 256 # CoC API calls in flight per asgi.py worker
+    CWL_FETCH_CONCURRENCY = 8 # war tags fetched in parallel by /api/cwl/summary
+    CLAN_MEMBER_FETCH_CONCURRENCY = 8 # players fetched in parallel by /api/clan/fetch_members, across all its requests of a process
+    SINGLE_FLIGHT_LEASE = 30 # seconds a refresh lease blocks other processes before it expires
+    # serialized responses of the read-only routes, see utils/response_cache.py (0 disables)
+    RESPONSE_CACHE_MAX_BYTES = 32 * 1024 * 1024
+    # progress and CWL summary JSON is sent with chunked transfer while it is encoded (utils/streaming.py)
+    STREAM_JSON_RESPONSES = True
+    STREAM_CHUNK_BYTES = 16384
+    # per request SQL / JSON decode / CoC API timings as a Server-Timing header and a log line (utils/timing.py)
+    REQUEST_TIMING = True
+    SLOW_REQUEST_MS = 1000 # requests slower than this also log their slowest queries and calls (0 disables)
+    SLOW_REQUEST_SAMPLES = 20
+    # Prometheus text at /metrics, see utils/metrics.py
+    METRICS_ENABLED = True
+    METRICS_FLUSH_INTERVAL = 15 # seconds between writes of a process's series to process_metric
+    METRICS_RETENTION = 7 * 86400 # series of processes silent for this long are dropped
+    METRICS_DB_SIZE_INTERVAL = 300 # seconds the per table sizes (a walk of every page) are reused
+    # asgi.py: threads running the views without an async handler, threads for the handlers' SQLite calls
+    ASGI_WSGI_THREADS = 16
+    ASGI_DB_THREADS = 8
     # Define a default log directory relative to the project root
     # Note: Using basedir is a good practice for non-instance files
     LOG_DIR = os.path.join(basedir, 'logs') 
     LOG_LEVEL = 'INFO'
     # DATABASE_PATH = os.path.join(basedir, 'instance', 'app.db')
     DATABASE_PATH = os.path.join(os.environ.get('DATABASE_PATH'), 'database.db')
+    # SQLite pragmas applied once per pooled connection (see utils/db.py)
+    SQLITE_BUSY_TIMEOUT = 5.0 # seconds a writer waits for the lock
+    SQLITE_SYNCHRONOUS = 'NORMAL' # safe with WAL, fsync on checkpoint only
+    SQLITE_CACHE_SIZE = -20000 # negative is KiB, about 20 MB of page cache per connection
+    SQLITE_MMAP_SIZE = 256 * 1024 * 1024
+    SQLITE_STATEMENT_CACHE = 256
+    # format of newly stored cocdata: 'none', 'zlib' or 'zstd' (needs zstandard), see utils/blobs.py
+    COCDATA_COMPRESSION = 'none'
+    COCDATA_COMPRESSION_LEVEL = 6
+    COCDATA_USE_DICTIONARY = False # compress with the newest dictionary from flask compress-cocdata --dictionary
+    # player snapshots between keyframes are stored as deltas (utils/delta.py), 1 keeps every one in full;
+    # convert the existing history with flask encode-player-history
+    PLAYER_SNAPSHOT_KEYFRAME_INTERVAL = 1
+    # player history older than this moves to monthly partitions with flask archive-player-history (utils/archive.py);
+    # keep it above the 61 days clan progress reads, whose lastSeen comes from the hot store only
+    PLAYER_HOT_DAYS = 120
+    PLAYER_ARCHIVE_PATH = None # file of the partitions, None puts <database>-archive.db beside DATABASE_PATH
+    # background refresh, flask refresh-scheduler (utils/scheduler.py)
+    REFRESH_CADENCE = {} # seconds per target kind, overrides scheduler.DEFAULT_CADENCE
+    REFRESH_CONCURRENCY = 4 # refreshes in flight
+    REFRESH_RATE = 10 # refreshes started per second at most
+    REFRESH_RETRY = 300 # seconds before a failed refresh is tried again
+    REFRESH_RATE_LIMIT_PAUSE = 60 # seconds every refresh waits after a 429 from the CoC API
+    REFRESH_RESCAN = 600 # seconds between database scans for new clans, members and war tags
 
 class DevelopmentConfig(Config):
     """Development configuration."""
@@ -0,0 +1,146 @@
+# app/utils/archive.py
+# Time tiering of the player history. `player` is the hot store: the last
+# PLAYER_HOT_DAYS days of every tag and its newest snapshot whatever its age,
+# starting each tag at a full snapshot so the delta chains there are whole.
+# Older rows move (flask archive-player-history, utils/ingest.py) to monthly
+# partitions player_YYYYMM of a second database file, attached to every
+# connection as `archive`. A partition also starts each tag at a full
+# snapshot, so a month can be dropped or moved to slower storage on its own.
+# The newest snapshot reads (cocplayer's TTL check, get_clan_details, the
+# conditional probes) never leave the hot store, whose size does not grow with
+# the history. Range reads go through player_rows() and player_row_at(), which
+# carry on into the partitions only when the hot store runs out of rows, and
+# only for the tags archive.player_span lists.
+import os
+
+PARTITION_PREFIX = 'player_'
+
+ARCHIVE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS archive.player_span (
+    tag TEXT PRIMARY KEY,
+    first TEXT NOT NULL, -- oldest and newest archived dataTime of the tag
+    last TEXT NOT NULL
+)
+"""
+
+# the archived span of a tag and where its hot store rows start
+SPAN_SQL = 'SELECT first, last FROM archive.player_span WHERE tag = ?'
+HOT_START_SQL = 'SELECT MIN(dataTime) FROM player WHERE tag = ?'
+
+# same columns and key as player, see utils/schema.py
+PARTITION_SCHEMA = """
+CREATE TABLE IF NOT EXISTS archive.{name} (
+    tag TEXT NOT NULL,
+    dataTime TEXT NOT NULL,
+    cocdata BLOB,
+    contentHash TEXT,
+    lastSeen TEXT,
+    PRIMARY KEY (tag, dataTime)
+)
+"""
+
+
+def archive_path(database_path: str, config=None):
+    """The archive file of `database_path`: PLAYER_ARCHIVE_PATH, or <name>-archive.db beside it."""
+    path = (config or {}).get('PLAYER_ARCHIVE_PATH')
+    if path:
+        return path
+    if database_path == ':memory:' or database_path.startswith('file:'):
+        return None
+    return os.path.splitext(database_path)[0] + '-archive.db'
+
+
+def attach_archive(conn, path: str):
+    """Attach the archive database of `conn` as `archive`, created empty on first use."""
+    conn.execute('ATTACH DATABASE ? AS archive', (path,))
+    conn.execute('PRAGMA archive.journal_mode = WAL')
+    conn.execute(ARCHIVE_SCHEMA)
+    conn.has_archive = True
+
+
+def partition_name(data_time: str):
+    return f"{PARTITION_PREFIX}{data_time[:4]}{data_time[5:7]}"
+
+
+def ensure_partition(conn, name: str):
+    conn.execute(PARTITION_SCHEMA.format(name = name))
+
+
+def archive_range(conn, player_tag: str, since: str = None, until: str = None):
+    """
+    The archive partitions that may hold rows of a tag in [since, until], newest
+    first, and the dataTime archived rows must be older than: a row copied to
+    the archive but not yet deleted from the hot store is only read there.
+    ([], None) when the tag has nothing archived.
+    """
+    if not getattr(conn, 'has_archive', False):
+        return [], None
+    span = conn.execute(SPAN_SQL, (player_tag,)).fetchone()
+    if span is None:
+        return [], None
+    first = span[0] if since is None else max(span[0], since)
+    last = span[1] if until is None else min(span[1], until)
+    if last < first:
+        return [], None
+    sql = "SELECT name FROM archive.sqlite_master WHERE type = 'table' AND name BETWEEN ? AND ? ORDER BY name DESC"
+    tables = [f"archive.{row[0]}" for row in conn.execute(sql, (partition_name(first), partition_name(last)))]
+    before = conn.execute(HOT_START_SQL, (player_tag,)).fetchone()[0]
+    return tables, before or '9999'
+
+
+def player_rows_sql(table: str, columns: str, until: bool = False, limit: bool = False):
+    """
+    `columns` of the rows of a tag in the hot store or an archive partition,
+    newest first. Takes the tag, the `until` dataTime, for a partition the
+    dataTime its rows must be older than (see archive_range()), and the `limit`.
+    """
+    where = 'tag = ? AND dataTime <= ?' if until else 'tag = ?'
+    if table != 'player':
+        where += ' AND dataTime < ?'
+    order = 'ORDER BY dataTime DESC LIMIT ?' if limit else 'ORDER BY dataTime DESC'
+    return f"SELECT {columns} FROM {table} WHERE {where} {order}"
+
+
+def player_rows(conn, player_tag: str, columns: str, until: str = None, limit: int = None):
+    """
+    `columns` of the player rows of a tag at or before `until`, newest first and
+    at most `limit`: those of the hot store, then of the archive partitions
+    back in time while rows are missing.
+    """
+    params = [player_tag] if until is None else [player_tag, until]
+    sql = player_rows_sql('player', columns, until is not None, limit is not None)
+    rows = conn.execute(sql, params if limit is None else [*params, limit]).fetchall()
+    if limit is not None and len(rows) >= limit:
+        return rows
+    tables, before = archive_range(conn, player_tag, until = until)
+    for table in tables:
+        sql = player_rows_sql(table, columns, until is not None, limit is not None)
+        rows += conn.execute(sql, [*params, before] if limit is None else [*params, before, limit - len(rows)]).fetchall()
+        if limit is not None and len(rows) >= limit:
+            break
+    return rows
+
+
+def player_row_at(conn, player_tag: str, data_time: str, columns: str):
+    """
+    (table, row) of the newest player row of a tag at or before `data_time`,
+    row None if there is none. The table also holds the row's delta chain.
+    """
+    row = conn.execute(player_rows_sql('player', columns, until = True, limit = True), (player_tag, data_time, 1)).fetchone()
+    if row is not None:
+        return 'player', row
+    tables, before = archive_range(conn, player_tag, until = data_time)
+    for table in tables:
+        sql = player_rows_sql(table, columns, until = True, limit = True)
+        row = conn.execute(sql, (player_tag, data_time, before, 1)).fetchone()
+        if row is not None:
+            return table, row
+    return 'player', None
+
+
+def record_span(conn, player_tag: str, first: str, last: str):
+    """Widen the archived span of a tag to cover [first, last]."""
+    conn.execute("""
+        INSERT INTO archive.player_span (tag, first, last) VALUES (?, ?, ?)
+        ON CONFLICT (tag) DO UPDATE SET first = MIN(first, excluded.first), last = MAX(last, excluded.last)
+    """, (player_tag, first, last))
@@ -0,0 +1,14 @@
+# app/utils/async_views.py
+# Coroutine versions of the fetch-heavy views, served by asgi.py in place of
+# the Flask view of the same endpoint. A handler takes the SQLiteExecutor of
+# the worker and the view's arguments and returns what the view would, it runs
+# in the request context with the same before / after / teardown hooks.
+ASYNC_VIEWS = {}
+
+
+def async_view(blueprint, endpoint: str):
+    """Register the decorated `async def handler(db, **view_args)` for `blueprint`.`endpoint`."""
+    def register(handler):
+        ASYNC_VIEWS[f"{blueprint.name}.{endpoint}"] = handler
+        return handler
+    return register
@@ -0,0 +1,251 @@
+# app/utils/blobs.py
+import json
+import struct
+import threading
+import zlib
+from flask import current_app, has_app_context
+
+from .jsoncodec import dumps, loads
+
+try:
+    import zstandard
+except ImportError: # optional, zlib is always available
+    zstandard = None
+
+# cocdata is either the raw CoC API JSON (every row written before compression
+# was enabled, first byte '{' or '[') or a header byte and the compressed JSON:
+#   0x01  zlib
+#   0x02  zlib with a preset dictionary, followed by its 2-byte blob_dictionary id
+#   0x03  zstd
+#   0x04  zstd with a trained dictionary, followed by its 2-byte blob_dictionary id
+#   0x05  player snapshot stored as a delta against the snapshot before it
+#         (utils/delta.py), followed by the delta JSON in any of the formats above
+FORMAT_ZLIB = 0x01
+FORMAT_ZLIB_DICT = 0x02
+FORMAT_ZSTD = 0x03
+FORMAT_ZSTD_DICT = 0x04
+FORMAT_DELTA = 0x05
+
+CODECS = ('none', 'zlib', 'zstd')
+
+# every table with a cocdata column
+COCDATA_TABLES = ('player', 'clan', 'warlog', 'clanwarlog', 'clanwarleague', 'cwlwarlog')
+
+# zlib only looks back 32 KB, a longer preset dictionary is wasted
+ZLIB_DICTIONARY_SIZE = 32 * 1024
+
+_DICT_ID = struct.Struct('>H')
+
+# blob_dictionary rows are immutable, cache them for the life of the process
+_lock = threading.Lock()
+_dictionaries = {}
+_latest_dictionary = {}
+
+
+def load_dictionaries(conn):
+    """Read every blob_dictionary row into the process cache."""
+    rows = conn.execute('SELECT id, tablename, codec, data FROM blob_dictionary ORDER BY id').fetchall()
+    with _lock:
+        for dictionary_id, table, codec, data in rows:
+            _dictionaries[dictionary_id] = (codec, bytes(data))
+            _latest_dictionary[(table, codec)] = dictionary_id
+
+
+def _dictionary(dictionary_id: int):
+    if dictionary_id not in _dictionaries and has_app_context():
+        # trained by another process after this one loaded the table
+        from .db import get_db
+        load_dictionaries(get_db())
+    try:
+        return _dictionaries[dictionary_id][1]
+    except KeyError:
+        raise json.JSONDecodeError(f"unknown cocdata dictionary {dictionary_id}", '', 0)
+
+
+def _zstd_dictionary(data: bytes):
+    return zstandard.ZstdCompressionDict(data, dict_type=zstandard.DICT_TYPE_FULLDICT)
+
+
+def decode_blob(blob):
+    """Return the raw JSON bytes of a stored cocdata value, whatever its format."""
+    if isinstance(blob, str):
+        return blob.encode('utf-8')
+    blob = bytes(blob)
+    if not blob or blob[0] > FORMAT_DELTA:
+        return blob
+    header = blob[0]
+    if header == FORMAT_DELTA:
+        raise json.JSONDecodeError('delta encoded cocdata needs its base snapshot, see utils/snapshots.py', '', 0)
+    try:
+        if header == FORMAT_ZLIB:
+            return zlib.decompress(blob[1:])
+        if header == FORMAT_ZLIB_DICT:
+            (dictionary_id,) = _DICT_ID.unpack_from(blob, 1)
+            decompressor = zlib.decompressobj(zdict=_dictionary(dictionary_id))
+            return decompressor.decompress(blob[1 + _DICT_ID.size:]) + decompressor.flush()
+        if zstandard is None:
+            raise json.JSONDecodeError('zstd compressed cocdata but zstandard is not installed', '', 0)
+        if header == FORMAT_ZSTD:
+            return zstandard.ZstdDecompressor().decompress(blob[1:])
+        (dictionary_id,) = _DICT_ID.unpack_from(blob, 1)
+        decompressor = zstandard.ZstdDecompressor(dict_data=_zstd_dictionary(_dictionary(dictionary_id)))
+        return decompressor.decompress(blob[1 + _DICT_ID.size:])
+    except (zlib.error, struct.error) as e:
+        raise json.JSONDecodeError(f"corrupt compressed cocdata: {e}", '', 0)
+    except Exception as e:
+        if zstandard is not None and isinstance(e, zstandard.ZstdError):
+            raise json.JSONDecodeError(f"corrupt compressed cocdata: {e}", '', 0)
+        raise
+
+
+def cocdata_text(blob):
+    """
+    The JSON text of a stored cocdata value, registered as the SQLite function
+    cocdata_json() on every connection (utils/db.py) so SQL can json_extract
+    from compressed values. NULL for delta encoded and corrupt values.
+    """
+    if blob is None:
+        return None
+    try:
+        return decode_blob(blob).decode('utf-8')
+    except (json.JSONDecodeError, UnicodeDecodeError):
+        return None
+
+
+def load_json(blob):
+    """Parse a stored cocdata value. Corrupt data raises json.JSONDecodeError like malformed JSON does."""
+    return loads(decode_blob(blob))
+
+
+def is_delta(blob):
+    return blob is not None and not isinstance(blob, str) and len(blob) > 0 and blob[0] == FORMAT_DELTA
+
+
+def decode_delta(blob):
+    """Parse the delta of a FORMAT_DELTA value."""
+    return loads(decode_blob(bytes(blob)[1:]))
+
+
+def encode_delta(table: str, delta: dict):
+    """Encode a delta for `table`, its JSON compressed like any other cocdata value."""
+    return bytes([FORMAT_DELTA]) + bytes(encode_cocdata(table, dumps(delta)))
+
+
+def encode_blob(data, codec: str = 'zlib', level: int = 6, dictionary_id: int = None):
+    """Compress raw JSON bytes into the stored format. codec 'none' keeps them as they are."""
+    if isinstance(data, str):
+        data = data.encode('utf-8')
+    if codec == 'none':
+        return bytes(data)
+    if codec == 'zlib':
+        if dictionary_id is None:
+            return bytes([FORMAT_ZLIB]) + zlib.compress(data, level)
+        compressor = zlib.compressobj(level, zdict=_dictionary(dictionary_id))
+        return bytes([FORMAT_ZLIB_DICT]) + _DICT_ID.pack(dictionary_id) + compressor.compress(data) + compressor.flush()
+    if codec == 'zstd':
+        if zstandard is None:
+            raise RuntimeError('zstd compression needs the zstandard package')
+        if dictionary_id is None:
+            return bytes([FORMAT_ZSTD]) + zstandard.ZstdCompressor(level=level).compress(data)
+        compressor = zstandard.ZstdCompressor(level=level, dict_data=_zstd_dictionary(_dictionary(dictionary_id)))
+        return bytes([FORMAT_ZSTD_DICT]) + _DICT_ID.pack(dictionary_id) + compressor.compress(data)
+    raise ValueError(f"unknown cocdata codec {codec}")
+
+
+def encode_cocdata(table: str, data):
+    """
+    Encode a CoC API response for `table` as configured: COCDATA_COMPRESSION
+    ('none', 'zlib' or 'zstd') at COCDATA_COMPRESSION_LEVEL, with the newest
+    trained dictionary of the table when COCDATA_USE_DICTIONARY is set.
+    """
+    config = current_app.config if has_app_context() else {}
+    codec = config.get('COCDATA_COMPRESSION') or 'none'
+    if codec == 'none':
+        return data
+    dictionary_id = None
+    if config.get('COCDATA_USE_DICTIONARY'):
+        if (table, codec) not in _latest_dictionary:
+            from .db import get_db
+            load_dictionaries(get_db())
+        dictionary_id = _latest_dictionary.get((table, codec))
+    return encode_blob(data, codec, config.get('COCDATA_COMPRESSION_LEVEL', 6), dictionary_id)
+
+
+def train_dictionary(conn, table: str, codec: str = 'zlib', samples: int = 200, size: int = 64 * 1024):
+    """
+    Build a dictionary from the newest `samples` rows of `table`, store it in
+    blob_dictionary and return its id. zstd trains on the samples, zlib uses the
+    tail of a typical snapshot since it can only reference the last 32 KB.
+    """
+    if table not in COCDATA_TABLES:
+        raise ValueError(f"{table} has no cocdata column")
+    rows = conn.execute(f'SELECT cocdata FROM {table} ORDER BY rowid DESC LIMIT ?', (samples,)).fetchall()
+    documents = []
+    for row in rows:
+        try:
+            documents.append(decode_blob(row[0]))
+        except json.JSONDecodeError:
+            continue
+    if not documents:
+        raise ValueError(f"no {table} rows to train a dictionary on")
+
+    if codec == 'zstd':
+        if zstandard is None:
+            raise RuntimeError('zstd dictionaries need the zstandard package')
+        data = zstandard.train_dictionary(size, documents).as_bytes()
+    elif codec == 'zlib':
+        documents.sort(key=len)
+        data = documents[len(documents) // 2][-ZLIB_DICTIONARY_SIZE:]
+    else:
+        raise ValueError(f"codec {codec} does not use dictionaries")
+
+    cur = conn.execute('INSERT INTO blob_dictionary (tablename, codec, data) VALUES (?, ?, ?)', (table, codec, data))
+    conn.commit()
+    load_dictionaries(conn)
+    return cur.lastrowid
+
+
+def recompress_table(conn, table: str, codec: str, level: int = 6, dictionary_id: int = None,
+                     batch_size: int = 500, progress=None):
+    """
+    Rewrite every cocdata value of `table` into the given format, walking rowids
+    in batches of `batch_size` and committing after each one, so readers and the
+    ingest routes keep running. Values already in that format are left alone.
+    Returns (rows seen, rows rewritten, rows skipped as corrupt, bytes before, bytes after).
+    """
+    if table not in COCDATA_TABLES:
+        raise ValueError(f"{table} has no cocdata column")
+    seen = rewritten = skipped = bytes_before = bytes_after = 0
+    last_rowid = 0
+    while True:
+        rows = conn.execute(f'SELECT rowid, cocdata FROM {table} WHERE rowid > ? ORDER BY rowid LIMIT ?',
+                            (last_rowid, batch_size)).fetchall()
+        if not rows:
+            break
+        updates = []
+        for rowid, blob in rows:
+            seen += 1
+            if blob is None:
+                continue
+            blob = bytes(blob) if not isinstance(blob, str) else blob.encode('utf-8')
+            bytes_before += len(blob)
+            try:
+                if is_delta(blob):
+                    # only the delta JSON is compressed, the header stays in front
+                    encoded = blob[:1] + encode_blob(decode_blob(blob[1:]), codec, level, dictionary_id)
+                else:
+                    encoded = encode_blob(decode_blob(blob), codec, level, dictionary_id)
+            except json.JSONDecodeError:
+                skipped += 1
+                bytes_after += len(blob)
+                continue
+            bytes_after += len(encoded)
+            if encoded != blob:
+                updates.append((encoded, rowid))
+        conn.executemany(f'UPDATE {table} SET cocdata = ? WHERE rowid = ?', updates)
+        conn.commit()
+        rewritten += len(updates)
+        last_rowid = rows[-1][0]
+        if progress:
+            progress(table, seen, rewritten)
+    return seen, rewritten, skipped, bytes_before, bytes_after
@@ -1,64 +1,344 @@
 # app/utils/coc_api.py
-import urllib.request
-import urllib.error
+import asyncio
+import gzip
+import http.client
 import json
+import os
+import random
+import ssl
+import threading
+import time
 import traceback
+import urllib.parse
 from flask import current_app
 
-# return json dump data , status code
-def fetch_coc_api_data(endpoint: str, data_type: str, tag_value: str):
-    data = None
-    status_code = 200
-    try:
-        current_app.logger.info (f"Attempting to fetch {data_type} {tag_value}")
-        current_app.logger.info (f"url : {endpoint}")
+from .ratelimit import RateLimitTimeout, acquire_key, acquire_key_async, penalize_key
+from .jsoncodec import dumps, loads
+from .metrics import inc
+from .timing import current_timings
+
+# Keep-alive connections to the CoC API, one per worker thread and host, so a
+# burst of calls (cwl_summary fetches up to 28 war tags) pays for a single
+# TCP + TLS handshake instead of one per call.
+_local = threading.local()
+
+_stats_lock = threading.Lock()
+_stats = {'connections': 0, 'requests': 0, 'bytes_received': 0, 'bytes_decoded': 0,
+          'rate_limited': 0, 'unavailable': 0, 'retries': 0}
+
+
+def _count(**increments):
+    with _stats_lock:
+        for name, value in increments.items():
+            _stats[name] += value
+
+
+def client_stats():
+    """
+    Process-wide counters: connections opened, requests sent, body bytes on the
+    wire / after gunzip, 429 and 503 answers and the retries they caused.
+    """
+    with _stats_lock:
+        return dict(_stats)
+
+
+def reset_client_stats():
+    # a forked child starts counting again, see utils/metrics.py
+    global _stats_lock
+    _stats_lock = threading.Lock()
+    for name in _stats:
+        _stats[name] = 0
+
+
+class _CountingHTTPConnection(http.client.HTTPConnection):
+    def connect(self):
+        _count(connections=1)
+        super().connect()
+
 
-        req = urllib.request.Request(endpoint)
-        req.add_header('Accept', 'application/json')
+class _CountingHTTPSConnection(http.client.HTTPSConnection):
+    def connect(self):
+        _count(connections=1)
+        super().connect()
 
-        APIKEY = current_app.config.get('APIKEY')
-        # current_app.logger.info(f"APIKEY: {APIKEY}")
-        req.add_header('Authorization', "Bearer " + APIKEY)
 
-        #r = urllib.request.urlopen(req)
-        #data = r.read()
-        # current_app.logger.info(f"api return data: {data}")
-        #status_code = r.getcode()
-        # current_app.logger.info(f"api return code: {status_code}")
+def _get_connection(scheme: str, netloc: str, timeout: float):
+    # pooled connections must not cross a fork
+    if getattr(_local, 'pid', None) != os.getpid():
+        _local.pid = os.getpid()
+        _local.connections = {}
+    conn = _local.connections.get((scheme, netloc))
+    if conn is None:
+        if scheme == 'https':
+            conn = _CountingHTTPSConnection(netloc, timeout=timeout)
+        else:
+            conn = _CountingHTTPConnection(netloc, timeout=timeout)
+        _local.connections[(scheme, netloc)] = conn
+    return conn
 
-        with urllib.request.urlopen(req) as r:
+
+def _get(endpoint: str, headers: dict, timeout: float):
+    """GET `endpoint` over the pooled connection, return (status, body bytes)."""
+    url = urllib.parse.urlsplit(endpoint)
+    path = url.path + ('?' + url.query if url.query else '')
+    for attempt in range(2):
+        conn = _get_connection(url.scheme, url.netloc, timeout)
+        reused = conn.sock is not None
+        try:
+            conn.request('GET', path, headers=headers)
+            r = conn.getresponse()
             data = r.read()
-            status_code = r.getcode()
+        except (http.client.RemoteDisconnected, ConnectionResetError, BrokenPipeError):
+            conn.close()
+            # the server dropped an idle keep-alive connection, retry once on a fresh one
+            if reused and attempt == 0:
+                continue
+            raise
+        except Exception:
+            conn.close()
+            raise
+        if r.will_close:
+            conn.close()
+        _count(requests=1, bytes_received=len(data))
+        if r.getheader('Content-Encoding', '').lower() == 'gzip':
+            data = gzip.decompress(data)
+        _count(bytes_decoded=len(data))
+        return r.status, data
+
+
+# asgi.py's calls go over asyncio streams instead: keep-alive connections per
+# host shared by all tasks of the event loop, at most COC_API_ASYNC_CONNECTIONS
+# requests in flight, so a worker waits on hundreds of calls without a thread each.
+_async_pool = {'loop': None, 'idle': {}, 'limit': None}
+
+
+def _async_state():
+    # the pool belongs to one event loop, a new loop (or a forked process) starts a new one
+    loop = asyncio.get_running_loop()
+    if _async_pool['loop'] is not loop:
+        limit = int(current_app.config.get('COC_API_ASYNC_CONNECTIONS', 256))
+        _async_pool.update(loop = loop, idle = {}, limit = asyncio.Semaphore(limit))
+    return _async_pool
+
+
+async def _open_async(url, timeout: float):
+    https = url.scheme == 'https'
+    port = url.port or (443 if https else 80)
+    _count(connections=1)
+    return await asyncio.wait_for(
+            asyncio.open_connection(url.hostname, port, ssl = ssl.create_default_context() if https else None),
+            timeout)
+
+
+async def _read_response(reader):
+    # (status, lowercased headers, body, will_close) of one HTTP/1.1 response
+    status_line = await reader.readline()
+    if not status_line:
+        raise http.client.RemoteDisconnected('Remote end closed connection without response')
+    version, status = status_line.split(None, 2)[:2]
+    status = int(status)
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if line in (b'\r\n', b'\n', b''):
+            break
+        name, _, value = line.decode('latin-1').partition(':')
+        headers[name.strip().lower()] = value.strip()
+    will_close = version == b'HTTP/1.0' or headers.get('connection', '').lower() == 'close'
+    if status in (204, 304) or 100 <= status < 200:
+        body = b''
+    elif headers.get('transfer-encoding', '').lower() == 'chunked':
+        chunks = []
+        while True:
+            size = int((await reader.readline()).split(b';', 1)[0], 16)
+            if size == 0:
+                while (await reader.readline()) not in (b'\r\n', b'\n', b''):
+                    pass
+                break
+            chunks.append(await reader.readexactly(size))
+            await reader.readexactly(2)
+        body = b''.join(chunks)
+    elif 'content-length' in headers:
+        body = await reader.readexactly(int(headers['content-length']))
+    else:
+        body, will_close = await reader.read(), True
+    return status, headers, body, will_close
+
+
+async def _get_async(endpoint: str, headers: dict, timeout: float):
+    """_get() on the event loop's pool, return (status, body bytes)."""
+    url = urllib.parse.urlsplit(endpoint)
+    path = url.path + ('?' + url.query if url.query else '')
+    request = f"GET {path} HTTP/1.1\r\nHost: {url.netloc}\r\n"
+    request += ''.join(f"{name}: {value}\r\n" for name, value in headers.items()) + '\r\n'
+    pool = _async_state()
+    async with pool['limit']:
+        idle = pool['idle'].setdefault((url.scheme, url.netloc), [])
+        for attempt in range(2):
+            reused = bool(idle)
+            reader, writer = idle.pop() if reused else await _open_async(url, timeout)
+            try:
+                writer.write(request.encode('latin-1'))
+                await writer.drain()
+                status, response_headers, data, will_close = await asyncio.wait_for(_read_response(reader), timeout)
+            except (http.client.RemoteDisconnected, ConnectionResetError, BrokenPipeError, asyncio.IncompleteReadError) as e:
+                writer.close()
+                # the server dropped an idle keep-alive connection, retry once on a fresh one
+                if reused and attempt == 0:
+                    continue
+                if isinstance(e, asyncio.IncompleteReadError):
+                    raise http.client.IncompleteRead(e.partial) from e
+                raise
+            except BaseException:
+                writer.close()
+                raise
+            if will_close:
+                writer.close()
+            else:
+                idle.append((reader, writer))
+            break
+    _count(requests=1, bytes_received=len(data))
+    if response_headers.get('content-encoding', '').lower() == 'gzip':
+        data = gzip.decompress(data)
+    _count(bytes_decoded=len(data))
+    return status, data
+
+
+def _backoff(attempt: int, config):
+    # full jitter: anywhere between 0 and the exponential step
+    step = config.get('COC_API_BACKOFF', 0.5) * 2 ** attempt
+    return random.uniform(0, min(config.get('COC_API_BACKOFF_MAX', 30), step))
 
-        json.loads(data)
 
-        return data, status_code
+def _headers(api_key: str):
+    return {
+        'Accept': 'application/json',
+        'Accept-Encoding': 'gzip',
+        'Authorization': "Bearer " + api_key,
+        'Connection': 'keep-alive',
+    }
 
-    except urllib.error.HTTPError as e:
-        error_msg = f"CoC API HTTP Error fetching {data_type} {tag_value} : {e.code}"
+
+def _answered(endpoint: str, status_code: int, start: float):
+    # count one answer, True if it is a 429 / 503 worth a retry
+    timings = current_timings()
+    if timings is not None:
+        timings.add_upstream(urllib.parse.urlsplit(endpoint).path, status_code, (time.perf_counter() - start) * 1000)
+    inc('coc_api_responses_total', status = str(status_code))
+    if status_code not in (429, 503):
+        return False
+    _count(rate_limited=int(status_code == 429), unavailable=int(status_code == 503))
+    return True
+
+
+def _get_with_keys(endpoint: str, api_keys: list, config):
+    """
+    GET `endpoint` with a key of the pool that has a token, return (status,
+    body bytes). A 429 benches that key for the backoff and retries on the
+    next free one, a 503 sleeps the backoff first.
+    """
+    timeout = config.get('COC_API_TIMEOUT', 10)
+    retries = config.get('COC_API_RETRIES', 3)
+    for attempt in range(retries + 1):
+        api_key, _ = acquire_key(api_keys)
+        start = time.perf_counter()
+        status_code, data = _get(endpoint, _headers(api_key), timeout)
+        if not _answered(endpoint, status_code, start) or attempt == retries:
+            break
+        _count(retries=1)
+        delay = _backoff(attempt, config)
+        if status_code == 429:
+            penalize_key(api_key, delay)
+        else:
+            time.sleep(delay)
+    return status_code, data
+
+
+async def _get_with_keys_async(endpoint: str, api_keys: list, config):
+    """_get_with_keys() without holding a thread while queued, in flight or backing off."""
+    timeout = config.get('COC_API_TIMEOUT', 10)
+    retries = config.get('COC_API_RETRIES', 3)
+    for attempt in range(retries + 1):
+        api_key, _ = await acquire_key_async(api_keys)
+        start = time.perf_counter()
+        status_code, data = await _get_async(endpoint, _headers(api_key), timeout)
+        if not _answered(endpoint, status_code, start) or attempt == retries:
+            break
+        _count(retries=1)
+        delay = _backoff(attempt, config)
+        if status_code == 429:
+            await asyncio.to_thread(penalize_key, api_key, delay)
+        else:
+            await asyncio.sleep(delay)
+    return status_code, data
+
+
+def _api_keys(endpoint: str, data_type: str, tag_value: str):
+    current_app.logger.info (f"Attempting to fetch {data_type} {tag_value}")
+    current_app.logger.info (f"url : {endpoint}")
+    config = current_app.config
+    api_keys = [key for key in config.get('APIKEYS') or [config.get('APIKEY')] if key]
+    if not api_keys:
+        current_app.logger.critical('No CoC API key configured, set APIKEY or APIKEYS')
+    return api_keys
+
+
+def _result(status_code: int, data: bytes, data_type: str, tag_value: str):
+    if status_code >= 400:
+        error_msg = f"CoC API HTTP Error fetching {data_type} {tag_value} : {status_code}"
         current_app.logger.warning(error_msg)
-        try:
-            error_details = e.read().decode('utf-8')
-            current_app.logger.warning(f"CoC API Error Response Body: {error_details}")
-            return json.dumps({'error': error_details}), e.code
-        except Exception as read_e:
-            current_app.logger.warning(f"Could not read error body from CoC API: {read_e}")
-            return_data =  {'error': f"Failed to fetch {data_type} {tag_value}. CoC API returned status {read_e.code}"}
-            return json.dumps(return_data), read_e.code
-
-    except urllib.error.URLError as e:
+        error_details = data.decode('utf-8', errors='replace')
+        current_app.logger.warning(f"CoC API Error Response Body: {error_details}")
+        return dumps({'error': error_details}), status_code
+
+    loads(data)
+
+    return data, status_code
+
+
+def _failure(e: Exception, data_type: str, tag_value: str):
+    # (json dump data, status_code) for a call that raised `e`, called from its except block
+    if isinstance(e, RateLimitTimeout):
+        current_app.logger.warning(f"CoC API rate limit, not fetching {data_type} {tag_value}: {e}")
+        return dumps({'error': 'CoC API rate limit reached, try again later'}), 429
+
+    if isinstance(e, json.JSONDecodeError):
+        current_app.logger.error(f"CoC API JSON decoding error for {data_type} {tag_value}: {e}")
+        return dumps({'error': f"CoC API returned malformed data for {data_type} {tag_value}"}), 502
+
+    if isinstance(e, (OSError, http.client.HTTPException)):
         error_msg = f"CoC API Network/URL Error fetching {data_type} {tag_value}"
         current_app.logger.warning(error_msg)
-        return json.dumps({'error': f"Network error when connecting to CoC API: {e.reason}"}), 503
+        return dumps({'error': f"Network error when connecting to CoC API: {e}"}), 503
 
-    except json.JSONDecodeError as e:
-        current_app.logger.error(f"CoC API JSON decoding error for {data_type} {tag_value}: {e}")
-        return json.dumps({'error': f"CoC API returned malformed data for {data_type} {tag_value}"}), e.code
+    error_msg = f"CoC API unexpected error occurred while fetching {data_type} {tag_value}"
+    current_app.logger.critical (f"{error_msg}\n{traceback.format_exc()}")
+    return dumps({'error': 'An unexpected internal server error occured.'}), 500
+
+
+# return json dump data , status code
+def fetch_coc_api_data(endpoint: str, data_type: str, tag_value: str):
+    try:
+        api_keys = _api_keys(endpoint, data_type, tag_value)
+        if not api_keys:
+            return dumps({'error': 'An unexpected internal server error occured.'}), 500
+
+        status_code, data = _get_with_keys(endpoint, api_keys, current_app.config)
+        return _result(status_code, data, data_type, tag_value)
 
     except Exception as e:
-        error_msg = f"CoC API unexpected error occurred while fetching {data_type} {tag_value}"
-        current_app.logger.critical (f"{error_msg}\n{traceback.format_exc()}")
-        return json.dumps({'error': 'An unexpected internal server error occured.'}), 500
+        return _failure(e, data_type, tag_value)
 
 
+async def fetch_coc_api_data_async(endpoint: str, data_type: str, tag_value: str):
+    """fetch_coc_api_data() for a coroutine of asgi.py, the same results and errors."""
+    try:
+        api_keys = _api_keys(endpoint, data_type, tag_value)
+        if not api_keys:
+            return dumps({'error': 'An unexpected internal server error occured.'}), 500
+
+        status_code, data = await _get_with_keys_async(endpoint, api_keys, current_app.config)
+        return _result(status_code, data, data_type, tag_value)
 
+    except Exception as e:
+        return _failure(e, data_type, tag_value)
@@ -0,0 +1,119 @@
+# app/utils/conditional.py
+import functools
+import hashlib
+from datetime import datetime, timezone
+from flask import current_app, g, request
+
+from .archive import player_rows
+from .db import get_db
+from .snapshots import latest_row_sql
+
+# Conditional GET for the read-only routes. A probe returns the newest dataTime
+# of every table a view reads, using MAX(dataTime) index seeks only, so an
+# unchanged resource is answered with 304 before any snapshot blob is loaded.
+
+CLAN_DATA_TIMES_SQL = """
+    SELECT (SELECT MAX(dataTime) FROM clan WHERE tag = ?),
+           (SELECT MAX((SELECT MAX(dataTime) FROM player WHERE tag = m.player_tag))
+            FROM clan_member m WHERE m.clan_tag = ?),
+           (SELECT MAX((SELECT lastSeen FROM player WHERE tag = m.player_tag ORDER BY dataTime DESC LIMIT 1))
+            FROM clan_member m WHERE m.clan_tag = ?)
+"""
+
+# the CWL group of a season and the newest of its stored wars, whose tags the group lists
+CWL_SUMMARY_DATA_TIMES_SQL = """
+    SELECT l.dataTime,
+           (SELECT MAX(w.dataTime)
+            FROM json_each(cocdata_json(l.cocdata), '$.rounds') r, json_each(r.value, '$.warTags') t
+            JOIN cwlwarlog w ON w.seasonWarTag = l.season || substr(t.value, 2))
+    FROM clanwarleague l
+    WHERE l.clanSeason = ?
+"""
+
+
+def latest_data_time(conn, table: str, tag: str):
+    return conn.execute(f'SELECT MAX(dataTime) FROM {table} WHERE tag = ?', (tag,)).fetchone()[0]
+
+
+def latest_seen(conn, table: str, tag: str, until: str = None):
+    """
+    dataTime and lastSeen of the newest player or clan snapshot of a tag, the
+    newest at or before `until` when given. lastSeen moves when a fetch finds
+    the snapshot unchanged, which extends the daily history series.
+    """
+    if until is None:
+        row = conn.execute(latest_row_sql(table, 'dataTime, lastSeen'), (tag,)).fetchone()
+    elif table == 'player':
+        # an older date may be archived, see utils/archive.py
+        rows = player_rows(conn, tag, 'dataTime, lastSeen', until, 1)
+        row = rows[0] if rows else None
+    else:
+        sql = f'SELECT dataTime, lastSeen FROM {table} WHERE tag = ? AND dataTime <= ? ORDER BY dataTime DESC LIMIT 1'
+        row = conn.execute(sql, (tag, until)).fetchone()
+    return tuple(row) if row else (None, None)
+
+
+def clan_data_times(conn, clan_tag: str):
+    """Newest dataTime of the clan and of any of its members' player snapshots, and the newest member lastSeen."""
+    return tuple(conn.execute(CLAN_DATA_TIMES_SQL, (clan_tag, clan_tag, clan_tag)).fetchone())
+
+
+def cwl_summary_data_times(conn, clan_tag: str, season: str):
+    """dataTime of the CWL group of a clan's season and the newest dataTime of its wars."""
+    row = conn.execute(CWL_SUMMARY_DATA_TIMES_SQL, (clan_tag + season,)).fetchone()
+    return tuple(row) if row else (None, None)
+
+
+def start_of_today():
+    # for views whose output counts days back from today
+    return datetime.now().strftime('%Y-%m-%d 00:00:00')
+
+
+def _http_time(data_time: str):
+    # dataTime is local time, see the column defaults in utils/schema.py
+    return datetime.strptime(data_time[:19], '%Y-%m-%d %H:%M:%S').astimezone(timezone.utc)
+
+
+def _not_modified(etag: str, last_modified: datetime):
+    if request.if_none_match:
+        return request.if_none_match.contains(etag)
+    if request.if_modified_since:
+        return last_modified <= request.if_modified_since
+    return False
+
+
+def conditional(probe):
+    """
+    Add a strong ETag and Last-Modified to the 200 responses of a view and answer
+    If-None-Match / If-Modified-Since with 304. `probe(conn, **view_args)` returns
+    the dataTime values the response is built from; the ETag hashes them with the
+    view name and arguments. Views with no data (every value None) pass through.
+    Goes above @cached_response, which keys its entries on the same values.
+    """
+    def decorator(view):
+        @functools.wraps(view)
+        def wrapper(*args, **kwargs):
+            data_times = tuple(probe(get_db(), *args, **kwargs))
+            # @cached_response keys the body on the same values as the ETag
+            g.data_times = data_times
+            known = [data_time for data_time in data_times if data_time]
+            if not known:
+                return view(*args, **kwargs)
+
+            key = repr((view.__name__, args, sorted(kwargs.items()), data_times))
+            etag = hashlib.sha1(key.encode('utf-8')).hexdigest()
+            last_modified = _http_time(max(known))
+
+            if _not_modified(etag, last_modified):
+                response = current_app.response_class(status=304)
+            else:
+                response = current_app.make_response(view(*args, **kwargs))
+                if response.status_code != 200:
+                    return response
+            response.set_etag(etag)
+            response.last_modified = last_modified
+            # clients revalidate every poll instead of guessing a freshness lifetime
+            response.cache_control.no_cache = True
+            return response
+        return wrapper
+    return decorator
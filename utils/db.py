@@ -1,20 +1,121 @@
 # app/utils/db.py
 import sqlite3 # Assuming you are using sqlite3, adjust if using psycopg2, mysql.connector etc.
-from flask import g, current_app # If you adopt the more robust Flask connection pattern later
+from flask import g, current_app
+import asyncio
+import contextvars
 import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from .archive import archive_path, attach_archive
+from .blobs import cocdata_text
+from .schema import migrate
+from .timing import InstrumentedConnection
+
+# One connection per worker thread and database file, opened on first use and
+# kept for the life of the process. sqlite3 keeps each connection's prepared
+# statements in its own cache, so they survive from one request to the next.
+_local = threading.local()
+
+
+def connect(database_path: str, config=None):
+    """Open a connection to `database_path` in WAL mode with the configured pragmas."""
+    config = config or {}
+    conn = sqlite3.connect(
+            database_path,
+            timeout = config.get('SQLITE_BUSY_TIMEOUT', 5.0),
+            cached_statements = config.get('SQLITE_STATEMENT_CACHE', 256),
+            factory = InstrumentedConnection
+            )
+    conn.row_factory = sqlite3.Row
+    # WAL lets readers carry on while cocplayer / read_from_coccwl write
+    conn.execute('PRAGMA journal_mode = WAL')
+    conn.execute(f"PRAGMA synchronous = {config.get('SQLITE_SYNCHRONOUS', 'NORMAL')}")
+    conn.execute(f"PRAGMA cache_size = {int(config.get('SQLITE_CACHE_SIZE', -20000))}")
+    conn.execute(f"PRAGMA mmap_size = {int(config.get('SQLITE_MMAP_SIZE', 268435456))}")
+    conn.execute('PRAGMA temp_store = MEMORY')
+    # stored cocdata as JSON text for json_extract, see utils/snapshots.py load_fields()
+    conn.create_function('cocdata_json', 1, cocdata_text, deterministic=True)
+    # the older player history, see utils/archive.py
+    path = archive_path(database_path, config)
+    if path:
+        attach_archive(conn, path)
+    return conn
+
+
+def _thread_connection(database_path: str):
+    # connections must not cross a fork, mod_wsgi may start processes from a loaded parent
+    if getattr(_local, 'pid', None) != os.getpid():
+        _local.pid = os.getpid()
+        _local.connections = {}
+    conn = _local.connections.get(database_path)
+    if conn is None:
+        conn = connect(database_path, current_app.config)
+        _local.connections[database_path] = conn
+    return conn
+
+
+def autocommit_connection():
+    """
+    A connection of this thread in autocommit mode, for bookkeeping writes (rate
+    limit buckets, metrics) that must not join the transaction of get_db()'s.
+    """
+    database_path = current_app.config.get('DATABASE_PATH')
+    if getattr(_local, 'autocommit_pid', None) != os.getpid() or _local.autocommit_path != database_path:
+        conn = connect(database_path, current_app.config)
+        conn.isolation_level = None
+        _local.autocommit_pid, _local.autocommit_path, _local.autocommit = os.getpid(), database_path, conn
+    return _local.autocommit
+
 
-# Example of a more robust Flask pattern for DB connection
-# (This would involve registering a teardown function in __init__.py)
 def get_db():
     if 'db' not in g:
         DATABASE_PATH = current_app.config.get('DATABASE_PATH')
-        #DATABASE_PATH = os.path.join(os.environ.get('DATABASE_PATH'), 'database.db')
-        g.db = sqlite3.connect(DATABASE_PATH)
-        g.db.row_factory = sqlite3.Row
+        g.db = _thread_connection(DATABASE_PATH)
     return g.db
 
+
 def close_db(e=None):
+    # hand the connection back to the thread, discarding any uncommitted work
     db = g.pop('db', None)
-    if db is not None:
-        db.close()
+    if db is not None and db.in_transaction:
+        db.rollback()
+
+
+class SQLiteExecutor:
+    """
+    SQLite access for the coroutines of asgi.py. Each call runs on one of
+    `threads` worker threads with that thread's pooled connection, in an app
+    context of its own, so the event loop never waits on a query or a lock.
+    The context variables of the caller (its request timings) come along.
+    """
+
+    def __init__(self, app, threads: int):
+        self.app = app
+        self.executor = ThreadPoolExecutor(max_workers = threads, thread_name_prefix = 'sqlite')
+
+    def _call(self, fn, *args):
+        with self.app.app_context():
+            return fn(*args)
+
+    async def call(self, fn, *args):
+        """fn(*args) on a worker thread."""
+        context = contextvars.copy_context()
+        return await asyncio.get_running_loop().run_in_executor(self.executor, context.run, self._call, fn, *args)
+
+    async def run(self, fn, *args):
+        """fn(conn, *args) on a worker thread, uncommitted writes are rolled back afterwards."""
+        return await self.call(lambda: fn(get_db(), *args))
+
+    def shutdown(self):
+        self.executor.shutdown(wait = True)
+
 
+def init_db(app):
+    app.teardown_appcontext(close_db)
+    # bring the schema up to date once at startup, outside any worker's pooled connection
+    conn = connect(app.config.get('DATABASE_PATH'), app.config)
+    try:
+        migrate(conn, log=app.logger.info)
+    finally:
+        conn.close()
@@ -0,0 +1,80 @@
+# app/utils/delta.py
+# Structural deltas between two parsed JSON documents, used to store a player
+# snapshot as the change from the snapshot before it. A delta is a dict:
+#   {'=': value}                    replace the whole value
+#   {'+': {key: value},             dict: set keys (new or changed type)
+#    '-': [key, ...],               dict: remove keys
+#    '~': {key: delta}}             dict: patch the value under key
+#   {'@': {'index': delta},         list: patch items in place
+#    '<': length,                   list: truncate to length first
+#    '#': [value, ...]}             list: append items
+# An empty dict means the documents are equal.
+
+REPLACE = '='
+SET = '+'
+REMOVE = '-'
+PATCH = '~'
+ITEMS = '@'
+TRUNCATE = '<'
+APPEND = '#'
+
+
+def diff(base, target):
+    """Return the delta that turns `base` into `target`."""
+    if type(base) is dict and type(target) is dict:
+        delta = {}
+        for key, value in target.items():
+            if key not in base:
+                delta.setdefault(SET, {})[key] = value
+            elif base[key] != value:
+                sub = diff(base[key], value)
+                if REPLACE in sub:
+                    delta.setdefault(SET, {})[key] = value
+                else:
+                    delta.setdefault(PATCH, {})[key] = sub
+        removed = [key for key in base if key not in target]
+        if removed:
+            delta[REMOVE] = removed
+        return delta
+
+    if type(base) is list and type(target) is list:
+        delta = {}
+        common = min(len(base), len(target))
+        for index in range(common):
+            if base[index] != target[index]:
+                delta.setdefault(ITEMS, {})[str(index)] = diff(base[index], target[index])
+        if len(target) < len(base):
+            delta[TRUNCATE] = len(target)
+        elif len(target) > len(base):
+            delta[APPEND] = target[common:]
+        return delta
+
+    if base == target and type(base) is type(target):
+        return {}
+    return {REPLACE: target}
+
+
+def apply(base, delta):
+    """
+    Return `base` with `delta` applied. `base` is not modified; containers along
+    the patched paths are copied and everything else is shared with `base`.
+    """
+    if REPLACE in delta:
+        return delta[REPLACE]
+    if not delta:
+        return base
+
+    if type(base) is dict:
+        result = dict(base)
+        for key in delta.get(REMOVE, ()):
+            result.pop(key, None)
+        for key, sub in delta.get(PATCH, {}).items():
+            result[key] = apply(base[key], sub)
+        result.update(delta.get(SET, {}))
+        return result
+
+    result = list(base[:delta[TRUNCATE]]) if TRUNCATE in delta else list(base)
+    for index, sub in delta.get(ITEMS, {}).items():
+        result[int(index)] = apply(result[int(index)], sub)
+    result.extend(delta.get(APPEND, ()))
+    return result
@@ -0,0 +1,145 @@
+# app/utils/history.py
+import itertools
+from datetime import date, timedelta
+
+from .ingest import metric_name
+
+_MAX_TAGS_PER_QUERY = 500
+
+# one player's metrics and upgrade events over a dataTime range, range scans of their primary keys
+SNAPSHOT_METRICS_SQL = 'SELECT dataTime, name, value FROM player_metric WHERE tag = ? AND dataTime BETWEEN ? AND ?'
+UPGRADE_EVENTS_SQL = """
+    SELECT dataTime, village, name, level FROM player_upgrade
+    WHERE tag = ? AND dataTime > ? AND dataTime <= ?
+    ORDER BY dataTime
+"""
+
+
+def metric_history_sql(tag_count: int):
+    # pos keeps the caller's tag order, so each tag's rows can be consumed as they arrive
+    values = ', '.join(f'({pos}, ?)' for pos in range(tag_count))
+    return f"""
+        WITH wanted(pos, tag) AS (VALUES {values}),
+        ranked AS (
+            SELECT m.tag, m.dataTime, m.value,
+                   ROW_NUMBER() OVER (PARTITION BY m.tag ORDER BY m.dataTime DESC) AS rn
+            FROM player_metric m
+            WHERE m.name = ? AND m.tag IN (SELECT tag FROM wanted)
+        )
+        SELECT w.pos, r.tag, r.dataTime, r.value, p.lastSeen
+        FROM ranked r
+        JOIN wanted w ON w.tag = r.tag
+        LEFT JOIN player p ON p.tag = r.tag AND p.dataTime = r.dataTime
+        WHERE r.rn <= ?
+        ORDER BY w.pos, r.dataTime DESC
+    """
+
+
+def daily_points(rows, until: str = None):
+    """
+    Turn newest-first [(dataTime, lastSeen), ...] snapshot rows into newest-first
+    [(point time, dataTime), ...]: every snapshot, plus one point for each later
+    day on which a fetch found it unchanged and only moved its lastSeen, so the
+    series stay daily. Days after `until` and days that have a newer snapshot
+    of their own are left out.
+    """
+    points = []
+    newer_day = '9999-12-31'
+    for data_time, last_seen in rows:
+        day = data_time[:10]
+        if last_seen and last_seen[:10] > day:
+            seen = min(last_seen[:10], until[:10]) if until else last_seen[:10]
+            seen = date.fromisoformat(seen)
+            while seen.isoformat() > day:
+                if seen.isoformat() < newer_day:
+                    points.append((seen.isoformat() + data_time[10:], data_time))
+                seen -= timedelta(days=1)
+        points.append((data_time, data_time))
+        newer_day = day
+    return points
+
+
+def _metric_series(rows, limit: int):
+    values = {row['dataTime']: row['value'] for row in rows}
+    points = daily_points([(row['dataTime'], row['lastSeen']) for row in rows])[:limit]
+    return [(point, values[data_time]) for point, data_time in points]
+
+
+def iter_metric_history(conn, tags, metric: str, limit: int, is_achievement: bool = False):
+    """
+    Yield (tag, [(dataTime, value), ...]) for every entry of `tags` in order, the
+    newest `limit` daily points newest first for a single metric (see
+    daily_points). The window query ranks the narrow player_metric rows on their
+    (tag, name, dataTime) key, so no snapshot blob is read or decoded, and each
+    tag's series is built from the cursor only when it is asked for.
+    """
+    name = metric_name(metric, is_achievement)
+    tags = list(tags)
+    for start in range(0, len(tags), _MAX_TAGS_PER_QUERY):
+        chunk = tags[start:start + _MAX_TAGS_PER_QUERY]
+        groups = itertools.groupby(conn.execute(metric_history_sql(len(chunk)), (*chunk, name, limit)),
+                                   key=lambda row: row['pos'])
+        group = next(groups, None)
+        for pos, tag in enumerate(chunk):
+            rows = []
+            if group is not None and group[0] == pos:
+                rows = [row for row in group[1] if row['value'] is not None]
+                group = next(groups, None)
+            yield tag, _metric_series(rows, limit)
+
+
+def load_snapshot_metrics(conn, tag: str, data_times):
+    """
+    Return [(dataTime, {name: value}), ...] newest first for the given snapshot
+    times of one player, read with a single range scan over player_metric.
+    """
+    if not data_times:
+        return []
+    snapshots = {data_time: {} for data_time in sorted(data_times, reverse=True)}
+    for row in conn.execute(SNAPSHOT_METRICS_SQL, (tag, min(data_times), max(data_times))):
+        if row['dataTime'] in snapshots:
+            snapshots[row['dataTime']][row['name']] = row['value']
+    return list(snapshots.items())
+
+
+def iter_upgrade_progress(conn, tag: str, after: str, until: str):
+    """
+    Yield (date, {village: {name: level}}) oldest first straight from the
+    player_upgrade cursor, for the home and builderBase upgrade events of one
+    player with after < dataTime <= until. When a day has several snapshots,
+    the newest one wins.
+    """
+    day = data_time = levels = None
+    for row in conn.execute(UPGRADE_EVENTS_SQL, (tag, after, until)):
+        if row['dataTime'] != data_time:
+            if day is not None and row['dataTime'][:10] != day:
+                yield day, levels
+            data_time = row['dataTime']
+            day = data_time[:10]
+            levels = {}
+        if row['village'] in ('home', 'builderBase'):
+            levels.setdefault(row['village'], {})[row['name']] = row['level']
+    if day is not None:
+        yield day, levels
+
+
+def metric_deltas(series):
+    """
+    Turn a newest-first [(dataTime, value), ...] series into {date: value}, where
+    the newest day keeps its absolute value and every older day holds the change
+    up to the next newer snapshot (the progressItem semantics of the routes).
+    """
+    progress = {}
+    previous = None
+    for data_time, value in series:
+        if previous is None:
+            progress[data_time[:10]] = value
+        else:
+            progress[data_time[:10]] = previous - value
+        previous = value
+    return progress
+
+
+def metric_values(series):
+    """Turn a newest-first [(dataTime, value), ...] series into {date: value} of the absolute values, as the routes report achievements."""
+    return {data_time[:10]: value for data_time, value in series}
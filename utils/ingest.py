@@ -0,0 +1,422 @@
+# app/utils/ingest.py
+import hashlib
+import itertools
+import json
+from datetime import datetime, timedelta
+from flask import current_app, has_app_context
+
+from .archive import ensure_partition, partition_name, record_span
+from .blobs import decode_blob, encode_cocdata, encode_delta, is_delta, load_json
+from .delta import diff
+from .jsoncodec import dumps, loads
+from .snapshots import SNAPSHOT_AT_SQL, latest_row_sql, load_player_snapshot, parse_player_row, replay_chain, snapshot_chain
+
+# achievements share the player_metric namespace with top-level counters
+ACHIEVEMENT_PREFIX = 'achievement:'
+
+# unit lists tracked per village in player_unit_level
+UNIT_TYPES = ('troops', 'spells', 'heroes')
+
+# player_metric rows that take part in the upgrade diff next to the unit levels
+HALL_LEVELS = ('townHallLevel', 'townHallWeaponLevel', 'builderHallLevel')
+
+def metric_name(name: str, is_achievement: bool = False):
+    if is_achievement:
+        return ACHIEVEMENT_PREFIX + name
+    return name
+
+
+def extract_player_metrics(player_data: dict):
+    """Return [(name, value), ...] for every numeric top-level field and achievement."""
+    metrics = [(name, value) for name, value in player_data.items()
+               if isinstance(value, int) and not isinstance(value, bool)]
+    for achievement in player_data.get('achievements', []):
+        if 'name' in achievement and isinstance(achievement.get('value'), int):
+            metrics.append((metric_name(achievement['name'], True), achievement['value']))
+    return metrics
+
+
+def extract_unit_levels(player_data: dict):
+    """Return [(village, name, level), ...] for troops, spells and heroes."""
+    levels = []
+    for item_type in UNIT_TYPES:
+        for item in player_data.get(item_type, []):
+            if item.get('name'):
+                levels.append((item.get('village', 'home'), item['name'], item.get('level', 0)))
+    return levels
+
+
+def store_player_metrics(conn, player_tag: str, data_time: str, player_data: dict):
+    conn.executemany('INSERT OR REPLACE INTO player_metric (tag, dataTime, name, value) VALUES (?, ?, ?, ?)',
+                     [(player_tag, data_time, name, value) for name, value in extract_player_metrics(player_data)])
+    conn.executemany('INSERT OR REPLACE INTO player_unit_level (tag, dataTime, village, name, level) VALUES (?, ?, ?, ?, ?)',
+                     [(player_tag, data_time, village, name, level) for village, name, level in extract_unit_levels(player_data)])
+
+
+def _keyframe_interval():
+    if not has_app_context():
+        return 1
+    return current_app.config.get('PLAYER_SNAPSHOT_KEYFRAME_INTERVAL', 1)
+
+
+def _delta_encode_previous(conn, player_tag: str, data_time: str, keyframe_interval: int):
+    """
+    Replace the full snapshot stored right before `data_time` with its delta
+    against the snapshot before that. The first snapshot of a player stays full,
+    and so does every `keyframe_interval`th one to bound the chains readers replay.
+    """
+    if keyframe_interval <= 1:
+        return
+    sql = 'SELECT dataTime, cocdata FROM player WHERE tag = ? AND dataTime < ? ORDER BY dataTime DESC LIMIT 2'
+    rows = conn.execute(sql, (player_tag, data_time)).fetchall()
+    if len(rows) < 2 or is_delta(rows[0][1]):
+        return
+    previous_time, previous_blob = rows[0]
+    chain = snapshot_chain(conn, player_tag, rows[1][0], keyframe_interval - 1)
+    if is_delta(chain[0][1]):
+        return
+    try:
+        delta = encode_delta('player', diff(replay_chain(chain), load_json(previous_blob)))
+    except json.JSONDecodeError as e:
+        current_app.logger.warning(f"keeping full player snapshot {player_tag} {previous_time}: {e}")
+        return
+    if len(delta) < len(previous_blob):
+        conn.execute('UPDATE player SET cocdata = ? WHERE tag = ? AND dataTime = ?', (delta, player_tag, previous_time))
+
+
+def content_hash(coc_data):
+    """sha1 of the CoC API payload as fetched."""
+    if isinstance(coc_data, str):
+        coc_data = coc_data.encode('utf-8')
+    return hashlib.sha1(coc_data).hexdigest()
+
+
+def _touch_unchanged(conn, table: str, tag: str, digest: str):
+    """
+    If the newest snapshot of `tag` holds the same payload, record the fetch as
+    its lastSeen instead of storing a copy and return its dataTime, else None.
+    Rows stored before contentHash existed are hashed here once.
+    """
+    sql = latest_row_sql(table, 'dataTime, contentHash')
+    row = conn.execute(sql, (tag,)).fetchone()
+    if row is None:
+        return None
+    data_time, stored_hash = row
+    if stored_hash is None:
+        sql = SNAPSHOT_AT_SQL.format(table)
+        try:
+            # the newest snapshot is never delta encoded
+            stored_hash = content_hash(decode_blob(conn.execute(sql, (tag, data_time)).fetchone()[0]))
+        except json.JSONDecodeError:
+            return None
+        conn.execute(f'UPDATE {table} SET contentHash = ? WHERE tag = ? AND dataTime = ?', (stored_hash, tag, data_time))
+    if stored_hash != digest:
+        return None
+    conn.execute(f"UPDATE {table} SET lastSeen = datetime('now', 'localtime') WHERE tag = ? AND dataTime = ?", (tag, data_time))
+    return data_time
+
+
+def store_player_snapshot(conn, player_tag: str, coc_data):
+    """
+    Write a player snapshot and its extracted metric and unit level rows in the
+    caller's transaction. The newest snapshot is always stored in full; with
+    PLAYER_SNAPSHOT_KEYFRAME_INTERVAL above 1 the one it replaces as newest is
+    turned into a delta. A payload identical to the newest snapshot only moves
+    that row's lastSeen. Returns the dataTime the snapshot is stored under.
+    """
+    return store_player_snapshots(conn, [(player_tag, coc_data)])[player_tag][0]
+
+
+def store_player_snapshots(conn, snapshots):
+    """
+    Write [(player_tag, coc_data), ...] in the caller's transaction with one
+    executemany per table for the whole batch, each snapshot stored as
+    store_player_snapshot() describes. Returns {player_tag: (dataTime, changed)}.
+    """
+    stored = {}
+    rows = []
+    for player_tag, coc_data in snapshots:
+        digest = content_hash(coc_data)
+        data_time = _touch_unchanged(conn, 'player', player_tag, digest)
+        if data_time is not None:
+            stored[player_tag] = (data_time, False)
+        else:
+            rows.append((player_tag, coc_data, digest))
+    if not rows:
+        return stored
+
+    # one dataTime for the batch, in the format of the column default
+    data_time = conn.execute("SELECT datetime('now', 'localtime')").fetchone()[0]
+    conn.executemany('INSERT OR REPLACE INTO player (tag, dataTime, cocdata, contentHash) VALUES (?, ?, ?, ?)',
+                     [(player_tag, data_time, encode_cocdata('player', coc_data), digest)
+                      for player_tag, coc_data, digest in rows])
+    metrics, levels, upgrades = [], [], []
+    for player_tag, coc_data, _ in rows:
+        player_data = loads(coc_data)
+        metrics += [(player_tag, data_time, name, value) for name, value in extract_player_metrics(player_data)]
+        levels += [(player_tag, data_time, village, name, level) for village, name, level in extract_unit_levels(player_data)]
+        # upgrade events against the previous snapshot, the first one of a player is the baseline
+        previous = _previous_upgrade_state(conn, player_tag, data_time)
+        if previous is not None:
+            upgrades += [(player_tag, data_time, village, name, level)
+                         for village, name, level in diff_upgrades(previous, upgrade_state(player_data))]
+        stored[player_tag] = (data_time, True)
+    conn.executemany('INSERT OR REPLACE INTO player_metric (tag, dataTime, name, value) VALUES (?, ?, ?, ?)', metrics)
+    conn.executemany('INSERT OR REPLACE INTO player_unit_level (tag, dataTime, village, name, level) VALUES (?, ?, ?, ?, ?)', levels)
+    conn.executemany('INSERT OR REPLACE INTO player_upgrade (tag, dataTime, village, name, level) VALUES (?, ?, ?, ?, ?)', upgrades)
+    keyframe_interval = _keyframe_interval()
+    for player_tag, _, _ in rows:
+        _delta_encode_previous(conn, player_tag, data_time, keyframe_interval)
+    return stored
+
+
+def store_clan_members(conn, clan_tag: str, clan_data: dict):
+    """Replace the clan_member rows of a clan with the member list of its newest snapshot."""
+    conn.execute('DELETE FROM clan_member WHERE clan_tag = ?', (clan_tag,))
+    conn.executemany('INSERT OR REPLACE INTO clan_member (clan_tag, player_tag) VALUES (?, ?)',
+                     [(clan_tag, member['tag'][1:]) for member in clan_data.get('memberList', []) if member.get('tag')])
+
+
+def store_clan_snapshot(conn, clan_tag: str, coc_data, clan_data: dict = None):
+    """
+    Write a clan snapshot and its member list in the caller's transaction, or
+    only move lastSeen of the newest snapshot when the payload is unchanged.
+    """
+    digest = content_hash(coc_data)
+    if _touch_unchanged(conn, 'clan', clan_tag, digest) is not None:
+        return
+    if clan_data is None:
+        clan_data = loads(coc_data)
+    conn.execute('INSERT OR REPLACE INTO clan (tag, cocdata, contentHash) VALUES (?, ?, ?)',
+                 (clan_tag, encode_cocdata('clan', coc_data), digest))
+    store_clan_members(conn, clan_tag, clan_data)
+
+
+def upgrade_state(player_data: dict):
+    """Hall and unit levels of one snapshot, per village, as the upgrade diff sees them."""
+    state = {
+        'home': {'townHallLevel': player_data.get('townHallLevel', 0)},
+        'builderBase': {'builderHallLevel': player_data.get('builderHallLevel', 0)}
+    }
+    if 'townHallWeaponLevel' in player_data:
+        state['home']['townHallWeaponLevel'] = player_data['townHallWeaponLevel']
+    for village, name, level in extract_unit_levels(player_data):
+        if name[:5] != 'Super':
+            state.setdefault(village, {})[name] = level
+    return state
+
+
+def load_upgrade_state(conn, player_tag: str, data_time: str):
+    """Rebuild upgrade_state() of a stored snapshot from its narrow rows, None if it has none."""
+    placeholders = ', '.join(['?'] * len(HALL_LEVELS))
+    halls = dict(conn.execute(
+            f'SELECT name, value FROM player_metric WHERE tag = ? AND dataTime = ? AND name IN ({placeholders})',
+            (player_tag, data_time, *HALL_LEVELS)).fetchall())
+    units = conn.execute('SELECT village, name, level FROM player_unit_level WHERE tag = ? AND dataTime = ?',
+                         (player_tag, data_time)).fetchall()
+    if not halls and not units:
+        return None
+    state = {
+        'home': {'townHallLevel': halls.get('townHallLevel', 0)},
+        'builderBase': {'builderHallLevel': halls.get('builderHallLevel', 0)}
+    }
+    if 'townHallWeaponLevel' in halls:
+        state['home']['townHallWeaponLevel'] = halls['townHallWeaponLevel']
+    for village, name, level in units:
+        if name[:5] != 'Super':
+            state.setdefault(village, {})[name] = level
+    return state
+
+
+def diff_upgrades(previous: dict, current: dict):
+    """Return [(village, name, level), ...] for every level in `current` that differs from `previous`."""
+    upgrades = []
+    for village, levels in current.items():
+        previous_levels = previous.get(village, {})
+        for name, level in levels.items():
+            if level != previous_levels.get(name, 0):
+                upgrades.append((village, name, level))
+    return upgrades
+
+
+def _previous_upgrade_state(conn, player_tag: str, data_time: str):
+    sql = 'SELECT MAX(dataTime) FROM player WHERE tag = ? AND dataTime < ?'
+    previous_time = conn.execute(sql, (player_tag, data_time)).fetchone()[0]
+    if previous_time is None:
+        return None
+    state = load_upgrade_state(conn, player_tag, previous_time)
+    if state is None:
+        # snapshot stored before the narrow tables existed
+        try:
+            state = upgrade_state(load_player_snapshot(conn, player_tag, previous_time))
+        except json.JSONDecodeError:
+            return None
+    return state
+
+
+def _walk_player_history(conn, chunk_size: int):
+    """Yield chunks of player rows in (tag, dataTime) order, committing after each one."""
+    last_key = ('', '')
+    while True:
+        rows = conn.execute(
+                'SELECT tag, dataTime, cocdata FROM player WHERE (tag, dataTime) > (?, ?) '
+                'ORDER BY tag, dataTime LIMIT ?', (*last_key, chunk_size)).fetchall()
+        if not rows:
+            break
+        yield rows
+        conn.commit()
+        last_key = (rows[-1]['tag'], rows[-1]['dataTime'])
+
+
+def backfill_player_metrics(conn, chunk_size: int = 500, progress=None):
+    """
+    Extract metric, unit level and upgrade rows from the existing player history.
+    Rows are walked in (tag, dataTime) order with keyset pagination and committed
+    per chunk, so memory stays bounded by `chunk_size` snapshots. Re-running is
+    safe. Returns (snapshots processed, snapshots skipped as malformed).
+    """
+    processed = skipped = 0
+    previous_tag, previous, player_data = None, None, None
+    for rows in _walk_player_history(conn, chunk_size):
+        for row in rows:
+            if row['tag'] != previous_tag:
+                previous_tag, previous, player_data = row['tag'], None, None
+            try:
+                # deltas apply to the snapshot before, the walk is already there
+                player_data = parse_player_row(conn, row['tag'], row['dataTime'], row['cocdata'], player_data)
+            except json.JSONDecodeError:
+                skipped += 1
+                player_data = None
+                continue
+            store_player_metrics(conn, row['tag'], row['dataTime'], player_data)
+            current = upgrade_state(player_data)
+            if previous is not None:
+                conn.executemany('INSERT OR REPLACE INTO player_upgrade (tag, dataTime, village, name, level) VALUES (?, ?, ?, ?, ?)',
+                                 [(row['tag'], row['dataTime'], village, name, level)
+                                  for village, name, level in diff_upgrades(previous, current)])
+            previous = current
+            processed += 1
+        if progress:
+            progress(processed, skipped, (rows[-1]['tag'], rows[-1]['dataTime']))
+    return processed, skipped
+
+
+def rebuild_player_history(conn, keyframe_interval: int, chunk_size: int = 500, progress=None):
+    """
+    Re-encode the stored player history with a keyframe every `keyframe_interval`
+    snapshots and deltas in between, 1 stores every snapshot in full again. The
+    first and the newest snapshot of each player are always full. Walks like
+    backfill_player_metrics, committing per chunk. Returns (rows seen, rows
+    rewritten, rows skipped as corrupt, bytes before, bytes after).
+    """
+    seen = rewritten = skipped = bytes_before = bytes_after = 0
+    tag, newest, player_data, run = None, None, None, 0
+    for rows in _walk_player_history(conn, chunk_size):
+        updates = []
+        for row in rows:
+            seen += 1
+            blob = row['cocdata']
+            if blob is None:
+                continue
+            blob = bytes(blob) if not isinstance(blob, str) else blob.encode('utf-8')
+            bytes_before += len(blob)
+            if row['tag'] != tag:
+                tag, player_data, run = row['tag'], None, 0
+                newest = conn.execute('SELECT MAX(dataTime) FROM player WHERE tag = ?', (tag,)).fetchone()[0]
+            previous = player_data
+            try:
+                player_data = parse_player_row(conn, tag, row['dataTime'], blob, previous)
+            except json.JSONDecodeError:
+                skipped += 1
+                bytes_after += len(blob)
+                player_data, run = None, 0
+                continue
+
+            encoded = None
+            run += 1
+            if previous is not None and run <= keyframe_interval and row['dataTime'] != newest:
+                encoded = encode_delta('player', diff(previous, player_data))
+                if len(encoded) >= len(blob) and not is_delta(blob):
+                    encoded = None
+            if encoded is None:
+                run = 1
+                # rows that already are full keep their original bytes
+                encoded = blob if not is_delta(blob) else encode_cocdata(
+                        'player', dumps(player_data))
+            bytes_after += len(encoded)
+            if encoded != blob:
+                updates.append((encoded, tag, row['dataTime']))
+        conn.executemany('UPDATE player SET cocdata = ? WHERE tag = ? AND dataTime = ?', updates)
+        rewritten += len(updates)
+        if progress:
+            progress(seen, rewritten, (rows[-1]['tag'], rows[-1]['dataTime']))
+    return seen, rewritten, skipped, bytes_before, bytes_after
+
+
+def _archive_moves(conn, player_tag: str, cutoff: str):
+    """
+    The rows of a player to archive, [(partition, rows)]: all before the full
+    snapshot the row at `cutoff` is replayed from, so the hot store keeps a
+    whole chain and the newest snapshot. Returns that keyframe's dataTime too.
+    """
+    chain = snapshot_chain(conn, player_tag, cutoff)
+    if not chain or is_delta(chain[0][1]):
+        return None, []
+    keyframe = chain[0][0]
+    sql = 'SELECT dataTime, cocdata, contentHash, lastSeen FROM player WHERE tag = ? AND dataTime < ? ORDER BY dataTime'
+    rows = conn.execute(sql, (player_tag, keyframe)).fetchall()
+    groups = []
+    for name, group in itertools.groupby(rows, key=lambda row: partition_name(row[0])):
+        group = [tuple(row) for row in group]
+        data_time, blob, digest, last_seen = group[0]
+        if is_delta(blob):
+            # its keyframe goes to an older partition, each one starts a player in full
+            group[0] = (data_time, encode_cocdata('player', dumps(load_player_snapshot(conn, player_tag, data_time))), digest, last_seen)
+        groups.append((name, group))
+    return keyframe, groups
+
+
+def archive_player_history(conn, hot_days: int, tag_batch: int = 100, progress=None):
+    """
+    Move the player snapshots older than `hot_days` days to the monthly archive
+    partitions (utils/archive.py), the hot store keeps each player's newest
+    snapshot and its history back to a full one. Per batch of `tag_batch`
+    players the copies are committed to the archive first, then the rows are
+    deleted from `player`; a crash in between leaves copies readers skip.
+    Returns (players archived, rows moved, players skipped as corrupt).
+    """
+    if not getattr(conn, 'has_archive', False):
+        raise ValueError('no archive database is attached')
+    cutoff = (datetime.now() - timedelta(days = hot_days)).strftime('%Y-%m-%d %H:%M:%S')
+    tags = [row[0] for row in conn.execute('SELECT tag FROM player GROUP BY tag HAVING MIN(dataTime) < ?', (cutoff,))]
+    archived = moved = skipped = 0
+    for start in range(0, len(tags), tag_batch):
+        keyframes = []
+        for player_tag in tags[start:start + tag_batch]:
+            try:
+                keyframe, groups = _archive_moves(conn, player_tag, cutoff)
+            except json.JSONDecodeError as e:
+                current_app.logger.warning(f"not archiving player {player_tag}: {e}")
+                skipped += 1
+                continue
+            if not groups:
+                continue
+            for name, group in groups:
+                ensure_partition(conn, name)
+                conn.executemany(f'INSERT OR REPLACE INTO archive.{name} (tag, dataTime, cocdata, contentHash, lastSeen) VALUES (?, ?, ?, ?, ?)',
+                                 [(player_tag, *row) for row in group])
+            record_span(conn, player_tag, groups[0][1][0][0], groups[-1][1][-1][0])
+            keyframes.append((player_tag, keyframe))
+        conn.commit()
+        # a snapshot stored since may have made the keyframe a delta against an
+        # archived row, that player keeps its rows until the next run
+        conn.execute('BEGIN IMMEDIATE')
+        for player_tag, keyframe in keyframes:
+            row = conn.execute(SNAPSHOT_AT_SQL.format('player'), (player_tag, keyframe)).fetchone()
+            if row is not None and not is_delta(row[0]):
+                moved += conn.execute('DELETE FROM player WHERE tag = ? AND dataTime < ?', (player_tag, keyframe)).rowcount
+                archived += 1
+        conn.commit()
+        if progress:
+            progress(archived, moved, tags[min(start + tag_batch, len(tags)) - 1])
+    return archived, moved, skipped
@@ -0,0 +1,67 @@
+# app/utils/jsoncodec.py
+import json
+import time
+from flask import current_app
+from flask.json.provider import DefaultJSONProvider
+
+from .timing import current_timings
+
+try:
+    import orjson
+except ImportError: # optional, the standard library is used without it
+    orjson = None
+
+# The JSON codec of the whole app, stored cocdata, CoC API payloads and
+# responses alike: orjson when it is installed, the standard library otherwise.
+# loads() takes str or bytes and dumps() returns compact UTF-8 bytes. Bad input
+# raises json.JSONDecodeError either way (orjson's error subclasses it), so the
+# callers keep their except clauses.
+
+BACKEND = 'orjson' if orjson is not None else 'json'
+
+
+def _loads(data):
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+def loads(data):
+    timings = current_timings()
+    if timings is None:
+        return _loads(data)
+    start = time.perf_counter()
+    value = _loads(data)
+    timings.add_decode(len(data), (time.perf_counter() - start) * 1000)
+    return value
+
+
+def dumps(value, sort_keys: bool = False):
+    if orjson is not None:
+        return orjson.dumps(value, option=orjson.OPT_SORT_KEYS if sort_keys else 0)
+    return json.dumps(value, sort_keys=sort_keys, separators=(',', ':'), ensure_ascii=False).encode('utf-8')
+
+
+def json_response(body, status: int = 200):
+    """Response for JSON that is already encoded, e.g. cocdata sent back as it is stored."""
+    return current_app.response_class(body, status=status, mimetype=current_app.json.mimetype)
+
+
+class JsonProvider(DefaultJSONProvider):
+    """jsonify() and request.get_json() through orjson when it is installed."""
+
+    def dumps(self, obj, **kwargs):
+        if orjson is None:
+            return super().dumps(obj, **kwargs)
+        option = orjson.OPT_SORT_KEYS if kwargs.get('sort_keys', self.sort_keys) else 0
+        if kwargs.get('indent'):
+            option |= orjson.OPT_INDENT_2
+        # non-str keys as the standard library accepts them, dates and dataclasses through
+        # self.default so they come out as Flask formats them
+        option |= orjson.OPT_NON_STR_KEYS | orjson.OPT_PASSTHROUGH_DATETIME | orjson.OPT_PASSTHROUGH_DATACLASS
+        return orjson.dumps(obj, default=self.default, option=option).decode('utf-8')
+
+    def loads(self, s, **kwargs):
+        if orjson is None:
+            return super().loads(s, **kwargs)
+        return orjson.loads(s)
@@ -0,0 +1,367 @@
+# app/utils/metrics.py
+import bisect
+import contextvars
+import math
+import os
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from flask import current_app, request
+
+from .db import autocommit_connection
+from .jsoncodec import dumps, loads
+from .timing import collecting
+
+# Aggregate metrics in the Prometheus text format at /metrics: a latency
+# histogram and status counts per route, the TTL decisions of the routes that
+# serve stored CoC data until it is too old, CoC API answers by status, the
+# *_stats() counters of the other utils modules and the size of every table.
+# Each process counts in memory and writes its cumulative series to the
+# process_metric table at most every METRICS_FLUSH_INTERVAL seconds; /metrics
+# adds up the series of all processes, so whichever mod_wsgi daemon process
+# answers a scrape reports for all of them.
+
+# upper bounds of the latency buckets, in seconds
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+QUANTILES = (0.5, 0.95, 0.99)
+PREFIX = 'cocapi_'
+
+# [start, status] of the request being served, per thread or asyncio task
+_request = contextvars.ContextVar('metrics_request', default=None)
+_lock = threading.Lock()
+_histograms = {} # route -> [[count per bucket, +Inf last], sum of seconds]
+_counters = {} # (name, ((label, value), ...)) -> value
+_sources = {} # name -> (stats function, gauge keys, max keys, label of nested dicts, reset function)
+_flush_lock = threading.Lock()
+_state = {'pid': os.getpid(), 'process': f"{os.getpid()}:{time.time():.0f}", 'last_flush': 0.0}
+_db_size = {'at': 0.0, 'tables': {}}
+# flushes run on a thread of their own, a request or asgi.py's event loop never waits for the write lock;
+# the one long-lived thread keeps its autocommit connection
+_flusher = ThreadPoolExecutor(max_workers = 1, thread_name_prefix = 'metrics-flush')
+
+
+def _forked():
+    # pids are reused, so a process is its pid and start time; counters inherited over a fork start
+    # again, the registered sources' too, or the parent's counts would be flushed by both processes
+    global _lock, _flush_lock, _flusher
+    _lock, _flush_lock = threading.Lock(), threading.Lock()
+    _flusher = ThreadPoolExecutor(max_workers = 1, thread_name_prefix = 'metrics-flush')
+    _histograms.clear()
+    _counters.clear()
+    for *_, reset in _sources.values():
+        if reset is not None:
+            reset()
+    _state.update(pid = os.getpid(), process = f"{os.getpid()}:{time.time():.0f}", last_flush = 0.0)
+
+
+os.register_at_fork(after_in_child=_forked)
+
+
+def inc(name: str, value: float = 1, **labels):
+    """Add `value` to the counter `name` with `labels`, e.g. inc('coc_api_responses_total', status='200')."""
+    key = (name, tuple(sorted(labels.items())))
+    with _lock:
+        _counters[key] = _counters.get(key, 0) + value
+
+
+def count_cache_decision(endpoint: str, hit: bool):
+    """A route served stored data for `endpoint` (hit) or went to the CoC API because it was too old (miss)."""
+    inc('ttl_cache_total', endpoint = endpoint, result = 'hit' if hit else 'miss')
+
+
+def record_request(route: str, status: int, seconds: float):
+    index = bisect.bisect_left(LATENCY_BUCKETS, seconds)
+    key = ('requests_total', (('route', route), ('status', str(status))))
+    with _lock:
+        histogram = _histograms.get(route)
+        if histogram is None:
+            histogram = _histograms[route] = [[0] * (len(LATENCY_BUCKETS) + 1), 0.0]
+        histogram[0][index] += 1
+        histogram[1] += seconds
+        _counters[key] = _counters.get(key, 0) + 1
+
+
+def register_source(name: str, stats, gauges=(), maxima=(), label: str = 'key', reset=None):
+    """
+    Export the numeric values of the dict `stats()` returns as `name`_`key`
+    counters, the keys in `gauges` as gauges and the ones in `maxima` as the
+    maximum over processes. Nested dicts become one series per outer key,
+    labelled `label` (single_flight_stats() per endpoint). *_ratio values are
+    left out, they do not add up over processes. `reset()` zeroes the counters
+    in a forked child.
+    """
+    _sources[name] = (stats, frozenset(gauges), frozenset(maxima), label, reset)
+
+
+def _labels(**labels):
+    return dumps(labels, sort_keys=True).decode('utf-8')
+
+
+def _source_series(name, stats, gauges, maxima, label, extra=None):
+    for key, value in stats.items():
+        if isinstance(value, dict):
+            yield from _source_series(name, value, gauges, maxima, label, dict(extra or {}, **{label: key}))
+            continue
+        if isinstance(value, bool) or not isinstance(value, (int, float)) or key.endswith('_ratio'):
+            continue
+        kind = 'gauge' if key in gauges else 'max' if key in maxima else 'counter'
+        yield f"{name}_{key}", _labels(**(extra or {})), kind, value
+
+
+def _series():
+    """(name, labels JSON, kind, value) for every series of this process."""
+    with _lock:
+        histograms = {route: (list(counts), total) for route, (counts, total) in _histograms.items()}
+        counters = dict(_counters)
+    series = []
+    for route, (counts, total) in histograms.items():
+        cumulative = 0
+        for bound, count in zip((*LATENCY_BUCKETS, math.inf), counts):
+            cumulative += count
+            le = '+Inf' if bound == math.inf else repr(bound)
+            series.append(('request_duration_seconds_bucket', _labels(route = route, le = le), 'counter', cumulative))
+        series.append(('request_duration_seconds_sum', _labels(route = route), 'counter', total))
+        series.append(('request_duration_seconds_count', _labels(route = route), 'counter', cumulative))
+    for (name, labels), value in counters.items():
+        series.append((name, _labels(**dict(labels)), 'counter', value))
+    for name, (stats, gauges, maxima, label, _) in list(_sources.items()):
+        try:
+            series += _source_series(name, stats(), gauges, maxima, label)
+        except Exception as e:
+            current_app.logger.warning(f"metrics: {name} stats failed: {e}")
+    return series
+
+
+def flush():
+    """Write this process's series to process_metric."""
+    if not current_app.config.get('METRICS_ENABLED', True):
+        return
+    process = _state['process']
+    series = _series()
+    now = time.time()
+    _state['last_flush'] = time.monotonic()
+    # bookkeeping, not part of any request's SQL timings
+    with collecting(None):
+        conn = autocommit_connection()
+        try:
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                conn.executemany(
+                        'INSERT INTO process_metric (process, name, labels, kind, value, updated) VALUES (?, ?, ?, ?, ?, ?) '
+                        'ON CONFLICT (process, name, labels) DO UPDATE SET value = excluded.value, updated = excluded.updated',
+                        [(process, name, labels, kind, value, now) for name, labels, kind, value in series])
+                conn.execute('COMMIT')
+            except BaseException:
+                conn.execute('ROLLBACK')
+                raise
+        except sqlite3.Error as e:
+            current_app.logger.warning(f"metrics: could not write process metrics: {e}")
+
+
+def _flush_in_background(app):
+    try:
+        with app.app_context():
+            flush()
+    finally:
+        _flush_lock.release()
+
+
+def maybe_flush():
+    """Start a flush() on the flush thread if this process has not done so for METRICS_FLUSH_INTERVAL seconds."""
+    if time.monotonic() - _state['last_flush'] < current_app.config.get('METRICS_FLUSH_INTERVAL', 15):
+        return
+    # one flush at a time, the requests carry on
+    if _flush_lock.acquire(blocking = False):
+        try:
+            _flusher.submit(_flush_in_background, current_app._get_current_object())
+        except RuntimeError:
+            # the interpreter is shutting down
+            _flush_lock.release()
+
+
+def _alive(process: str):
+    pid = int(process.split(':', 1)[0])
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except OSError:
+        return True
+    return True
+
+
+def _aggregate(conn):
+    # {(name, labels JSON): (kind, value)} over every process; counters add up, gauges only from live processes
+    retention = current_app.config.get('METRICS_RETENTION', 7 * 86400)
+    conn.execute('DELETE FROM process_metric WHERE updated < ?', (time.time() - retention,))
+    totals = {}
+    alive = {}
+    for process, name, labels, kind, value in conn.execute('SELECT process, name, labels, kind, value FROM process_metric'):
+        key = (name, labels)
+        total = totals.get(key, (kind, None))[1]
+        if kind == 'max':
+            totals[key] = (kind, value if total is None else max(total, value))
+            continue
+        if kind == 'gauge':
+            if process not in alive:
+                alive[process] = _alive(process)
+            if not alive[process]:
+                continue
+        totals[key] = (kind, (total or 0) + value)
+    return totals
+
+
+def _table_sizes(conn):
+    # dbstat walks every page of the file, so it is refreshed only every METRICS_DB_SIZE_INTERVAL seconds
+    now = time.monotonic()
+    if _db_size['tables'] and now - _db_size['at'] < current_app.config.get('METRICS_DB_SIZE_INTERVAL', 300):
+        return _db_size['tables']
+    try:
+        tables = dict(conn.execute('SELECT name, SUM(pgsize) FROM dbstat GROUP BY name').fetchall())
+    except sqlite3.OperationalError:
+        # SQLite built without dbstat, the whole file only
+        page_size = conn.execute('PRAGMA page_size').fetchone()[0]
+        tables = {'*': conn.execute('PRAGMA page_count').fetchone()[0] * page_size}
+    _db_size.update(at = now, tables = tables)
+    return tables
+
+
+def _sort_key(item):
+    # buckets in the order of their bounds, everything else by name and labels
+    (name, labels), _ = item
+    if not name.endswith('_bucket'):
+        return name, labels, 0.0
+    labels = loads(labels)
+    return name, _labels(**{key: value for key, value in labels.items() if key != 'le'}), float(labels['le'])
+
+
+def _quantile(buckets, q: float):
+    # linear interpolation inside the bucket the q-th observation falls in, like histogram_quantile()
+    total = buckets[-1][1]
+    if not total:
+        return None
+    rank = q * total
+    lower, below = 0.0, 0
+    for bound, cumulative in buckets:
+        if cumulative >= rank:
+            if bound == math.inf:
+                return lower
+            return lower + (bound - lower) * (rank - below) / max(cumulative - below, 1)
+        lower, below = bound, cumulative
+    return lower
+
+
+def _format_labels(labels: dict):
+    if not labels:
+        return ''
+    escape = lambda value: str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+    return '{' + ','.join(f'{name}="{escape(value)}"' for name, value in labels.items()) + '}'
+
+
+def _format_value(value):
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value)
+
+
+def render(conn):
+    """The Prometheus text exposition of every process's metrics."""
+    flush()
+    families = {} # family -> (type, [(name, labels, value)])
+
+    def add(family, kind, name, labels, value):
+        families.setdefault(family, (kind, []))[1].append((PREFIX + name, labels, value))
+
+    histograms = {}
+    hits = {}
+    for (name, labels), (kind, value) in sorted(_aggregate(conn).items(), key=_sort_key):
+        if value is None:
+            continue
+        labels = loads(labels)
+        if name.startswith('request_duration_seconds'):
+            add('request_duration_seconds', 'histogram', name, labels, value)
+            if name.endswith('_bucket'):
+                bound = math.inf if labels['le'] == '+Inf' else float(labels['le'])
+                histograms.setdefault(labels['route'], []).append((bound, value))
+            continue
+        if name == 'ttl_cache_total':
+            hits.setdefault(labels['endpoint'], {})[labels['result']] = value
+        add(name, 'counter' if kind == 'counter' else 'gauge', name, labels, value)
+
+    for route, buckets in sorted(histograms.items()):
+        buckets.sort()
+        for q in QUANTILES:
+            value = _quantile(buckets, q)
+            if value is not None:
+                add('request_duration_seconds_quantile', 'gauge', 'request_duration_seconds_quantile',
+                    {'route': route, 'quantile': str(q)}, round(value, 6))
+    for endpoint, results in sorted(hits.items()):
+        decisions = results.get('hit', 0) + results.get('miss', 0)
+        add('ttl_cache_hit_ratio', 'gauge', 'ttl_cache_hit_ratio', {'endpoint': endpoint},
+            round(results.get('hit', 0) / decisions, 4) if decisions else 0.0)
+    for table, size in sorted(_table_sizes(conn).items()):
+        add('db_table_bytes', 'gauge', 'db_table_bytes', {'table': table}, size)
+
+    lines = []
+    for family, (kind, samples) in families.items():
+        lines.append(f"# TYPE {PREFIX}{family} {kind}")
+        lines += [f"{name}{_format_labels(labels)} {_format_value(value)}" for name, labels, value in samples]
+    return '\n'.join(lines) + '\n'
+
+
+def metrics_view():
+    with collecting(None):
+        body = render(autocommit_connection())
+    return current_app.response_class(body, mimetype='text/plain', headers={'Cache-Control': 'no-store'})
+
+
+def _start_request():
+    _request.set([time.perf_counter(), 500])
+
+
+def _keep_status(response):
+    state = _request.get()
+    if state is None:
+        return response
+    state[1] = response.status_code
+    if response.is_streamed:
+        # teardown runs before the body is generated, the latency runs until it is sent
+        _request.set(None)
+        app, route, status = current_app._get_current_object(), request.endpoint or 'unmatched', response.status_code
+        response.call_on_close(lambda: _record(app, route, status, state[0]))
+    return response
+
+
+def _record(app, route, status, start):
+    record_request(route, status, time.perf_counter() - start)
+    with app.app_context():
+        maybe_flush()
+
+
+def _finish_request(exc=None):
+    state = _request.get()
+    if state is None:
+        return
+    _request.set(None)
+    start, status = state
+    record_request(request.endpoint or 'unmatched', 500 if exc is not None else status, time.perf_counter() - start)
+    maybe_flush()
+
+
+def init_metrics(app):
+    if not app.config.get('METRICS_ENABLED', True):
+        return
+    from .coc_api import client_stats, reset_client_stats
+    from .ratelimit import rate_limiter_stats, reset_rate_limiter_stats
+    from .response_cache import reset_response_cache_stats, response_cache_stats
+    from .singleflight import reset_single_flight_stats, single_flight_stats
+    register_source('coc_client', client_stats, reset=reset_client_stats)
+    register_source('rate_limiter', rate_limiter_stats, maxima=('max_wait_seconds',), reset=reset_rate_limiter_stats)
+    register_source('single_flight', single_flight_stats, label='endpoint', reset=reset_single_flight_stats)
+    register_source('response_cache', response_cache_stats, gauges=('entries', 'bytes'), reset=reset_response_cache_stats)
+
+    app.before_request(_start_request)
+    app.after_request(_keep_status)
+    app.teardown_request(_finish_request)
+    app.add_url_rule('/metrics', 'metrics', metrics_view)
@@ -0,0 +1,163 @@
+# app/utils/ratelimit.py
+import asyncio
+import hashlib
+import math
+import random
+import sqlite3
+import threading
+import time
+from flask import current_app
+
+from .db import autocommit_connection
+
+# CoC API calls are spread over a pool of API keys (config APIKEYS), each with a
+# token bucket of its own: COC_API_KEY_RATE tokens a second, at most
+# COC_API_KEY_BURST banked. The buckets live in the api_rate_bucket table so all
+# threads and mod_wsgi processes draw from the same ones. A caller takes a token
+# from the fullest bucket, or sleeps until the first one refills. A key that got
+# a 429 sits out until blocked_until.
+_stats_lock = threading.Lock()
+_stats = {'acquired': 0, 'waits': 0, 'wait_seconds': 0.0, 'max_wait_seconds': 0.0, 'timeouts': 0, 'penalties': 0}
+
+
+class RateLimitTimeout(Exception):
+    """No API key had a token within COC_API_MAX_QUEUE_WAIT seconds."""
+
+
+def _count(**increments):
+    with _stats_lock:
+        for name, value in increments.items():
+            _stats[name] += value
+
+
+def rate_limiter_stats():
+    """
+    Process-wide counters: tokens acquired, acquisitions that had to queue
+    (waits) and the seconds they queued in total and at most, callers that gave
+    up (timeouts) and keys benched after a 429 (penalties).
+    """
+    with _stats_lock:
+        stats = dict(_stats)
+    stats['wait_seconds'] = round(stats['wait_seconds'], 4)
+    stats['max_wait_seconds'] = round(stats['max_wait_seconds'], 4)
+    return stats
+
+
+def reset_rate_limiter_stats():
+    # a forked child starts counting again, see utils/metrics.py
+    global _stats_lock
+    _stats_lock = threading.Lock()
+    for name in _stats:
+        _stats[name] = 0
+
+
+def key_id(api_key: str):
+    # the bucket table never holds the key itself
+    return hashlib.sha1(api_key.encode('utf-8')).hexdigest()[:16]
+
+
+def _take(conn, key_ids: list, rate: float, burst: float, now: float):
+    """Take a token from the fullest bucket, return (key id, 0) or (None, seconds until one refills)."""
+    conn.execute('BEGIN IMMEDIATE')
+    try:
+        conn.executemany('INSERT OR IGNORE INTO api_rate_bucket (key, tokens, updated) VALUES (?, ?, ?)',
+                         [(key, burst, now) for key in key_ids])
+        sql = f"SELECT key, tokens, updated, blocked_until FROM api_rate_bucket WHERE key IN ({','.join('?' * len(key_ids))})"
+        best, best_tokens, wait = None, 0.0, math.inf
+        for row in conn.execute(sql, key_ids):
+            tokens = min(burst, row['tokens'] + max(0.0, now - row['updated']) * rate)
+            refill = max(0.0, 1.0 - tokens) / rate
+            if row['blocked_until'] > now:
+                wait = min(wait, row['blocked_until'] - now + refill)
+            elif tokens >= 1.0:
+                if tokens > best_tokens:
+                    best, best_tokens = row['key'], tokens
+            else:
+                wait = min(wait, refill)
+        if best is not None:
+            conn.execute('UPDATE api_rate_bucket SET tokens = ?, updated = ? WHERE key = ?', (best_tokens - 1.0, now, best))
+        conn.execute('COMMIT')
+    except BaseException:
+        conn.execute('ROLLBACK')
+        raise
+    return (best, 0.0) if best is not None else (None, wait)
+
+
+def _limits():
+    config = current_app.config
+    rate = float(config.get('COC_API_KEY_RATE', 10))
+    burst = max(1.0, float(config.get('COC_API_KEY_BURST', rate)))
+    return rate, burst, config.get('COC_API_MAX_QUEUE_WAIT', 30)
+
+
+def _try_take(keys: dict, rate: float, burst: float):
+    try:
+        return _take(autocommit_connection(), list(keys), rate, burst, time.time())
+    except sqlite3.Error as e:
+        # a locked or missing bucket table must not stop the calls themselves
+        current_app.logger.warning(f"rate limiter: bucket table unavailable, not throttling: {e}")
+        return next(iter(keys)), 0.0
+
+
+def _settle(chosen, waited: float, wait: float, max_wait: float):
+    # True once a key was taken, raises once waiting `wait` more would pass max_wait
+    if chosen is not None:
+        with _stats_lock:
+            _stats['acquired'] += 1
+            if waited > 0:
+                _stats['waits'] += 1
+                _stats['wait_seconds'] += waited
+                _stats['max_wait_seconds'] = max(_stats['max_wait_seconds'], waited)
+        return True
+    if waited + wait > max_wait:
+        _count(timeouts=1)
+        raise RateLimitTimeout(f"no CoC API key free within {max_wait}s")
+    return False
+
+
+def acquire_key(api_keys: list):
+    """
+    Block until one of `api_keys` may make a call and return (api key, seconds
+    queued). Raises RateLimitTimeout when that would take longer than
+    COC_API_MAX_QUEUE_WAIT.
+    """
+    rate, burst, max_wait = _limits()
+    keys = {key_id(api_key): api_key for api_key in api_keys}
+    start = time.monotonic()
+    while True:
+        chosen, wait = _try_take(keys, rate, burst)
+        waited = time.monotonic() - start
+        if _settle(chosen, waited, wait, max_wait):
+            return keys[chosen], waited
+        # a little jitter so the queued callers do not all wake on the same refill
+        time.sleep(wait + random.uniform(0, 0.1 / rate))
+
+
+async def acquire_key_async(api_keys: list):
+    """
+    acquire_key() for a coroutine of asgi.py: the bucket queries run on a
+    worker thread and the queueing is an asyncio sleep, so a call waiting for a
+    token holds no thread.
+    """
+    rate, burst, max_wait = _limits()
+    keys = {key_id(api_key): api_key for api_key in api_keys}
+    start = time.monotonic()
+    while True:
+        chosen, wait = await asyncio.to_thread(_try_take, keys, rate, burst)
+        waited = time.monotonic() - start
+        if _settle(chosen, waited, wait, max_wait):
+            return keys[chosen], waited
+        await asyncio.sleep(wait + random.uniform(0, 0.1 / rate))
+
+
+def penalize_key(api_key: str, seconds: float):
+    """Bench `api_key` for `seconds` with an empty bucket, e.g. after the CoC API answered 429."""
+    now = time.time()
+    try:
+        autocommit_connection().execute(
+                'UPDATE api_rate_bucket SET tokens = 0, updated = ?, blocked_until = MAX(blocked_until, ?) WHERE key = ?',
+                (now, now + seconds, key_id(api_key)))
+    except sqlite3.Error as e:
+        current_app.logger.warning(f"rate limiter: could not bench key: {e}")
+        return
+    _count(penalties=1)
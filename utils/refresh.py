@@ -0,0 +1,340 @@
+# app/utils/refresh.py
+import asyncio
+import contextvars
+import os
+import threading
+import time
+import urllib.parse
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from flask import current_app
+
+from .blobs import decode_blob, encode_cocdata
+from .coc_api import fetch_coc_api_data, fetch_coc_api_data_async
+from .db import get_db
+from .ingest import store_clan_snapshot, store_player_snapshot, store_player_snapshots
+from .jsoncodec import dumps, loads
+from .response_cache import invalidate
+from .singleflight import hold_leases, hold_leases_async, single_flight, single_flight_async
+from .snapshots import latest_row_sql, load_latest_seen, load_latest_snapshots
+from .timing import collecting, current_timings
+
+# Fetch one CoC API resource and store it, shared by the /fetch routes, the
+# stale reads and the background scheduler (utils/scheduler.py). Every function
+# returns (json dump data, status_code) as fetch_coc_api_data does and commits
+# on success. The store_* halves take a result fetched elsewhere, e.g. by the
+# async handlers of asgi.py through fetch_async().
+
+# CoC API path of every data_type, the tag goes in quoted
+API_PATHS = {
+    'player': '/players/{}',
+    'clan': '/clans/{}',
+    'currentwar': '/clans/{}/currentwar',
+    'cwl': '/clans/{}/currentwar/leaguegroup',
+    'clanwarlog': '/clans/{}/warlog',
+    'WarTag': '/clanwarleagues/wars/{}',
+}
+
+
+def _quote(tag: str):
+    return '%23' + urllib.parse.quote(tag)
+
+
+def api_endpoint(data_type: str, tag: str):
+    """URL of the CoC API resource `data_type` (a key of API_PATHS) of `tag`, under config COC_API_URL."""
+    return current_app.config.get('COC_API_URL', 'https://api.clashofclans.com/v1') + API_PATHS[data_type].format(_quote(tag))
+
+
+def fetch(data_type: str, tag: str):
+    return fetch_coc_api_data(
+            endpoint = api_endpoint(data_type, tag),
+            data_type = data_type,
+            tag_value = tag
+            )
+
+
+async def fetch_async(data_type: str, tag: str):
+    return await fetch_coc_api_data_async(
+            endpoint = api_endpoint(data_type, tag),
+            data_type = data_type,
+            tag_value = tag
+            )
+
+
+def store_player_result(conn, player_tag: str, coc_data, status_code: int):
+    if status_code == 200:
+        store_player_snapshot(conn, player_tag, coc_data)
+        conn.commit()
+        invalidate(('player', player_tag))
+    return coc_data, status_code
+
+
+def refresh_player(conn, player_tag: str):
+    return store_player_result(conn, player_tag, *fetch('player', player_tag))
+
+
+def _stored_player(conn, player_tag: str):
+    # newest stored player snapshot as (cocdata, 200), None if there is none
+    row = conn.execute(latest_row_sql('player', 'cocdata'), (player_tag,)).fetchone()
+    if row is None:
+        return None
+    return decode_blob(row['cocdata']), 200
+
+
+def _fetch_player_coalesced(player_tag: str):
+    # (json dump data, status_code, refreshed, elapsed ms), shared with concurrent callers like _fetch_war_data_coalesced
+    conn = get_db()
+    start = time.perf_counter()
+    (coc_data, status_code), refreshed = single_flight(
+            conn,
+            endpoint = 'player',
+            tag = player_tag,
+            refresh = lambda: fetch('player', player_tag),
+            stale = lambda: _stored_player(conn, player_tag),
+            # wait out another process's lease, held until its batch committed (hold_leases()),
+            # so a 'shared' member is the snapshot it stored
+            serve_stale = False
+            )
+    return coc_data, status_code, refreshed, round((time.perf_counter() - start) * 1000, 1)
+
+
+# worker threads of _fetch_players_parallel, shared by every request of the
+# process so their pooled connections (utils/db.py) outlive a single clan
+_member_fetcher = None
+_member_fetcher_lock = threading.Lock()
+
+
+def _member_fetch_executor(workers: int):
+    global _member_fetcher
+    with _member_fetcher_lock:
+        if _member_fetcher is None:
+            _member_fetcher = ThreadPoolExecutor(max_workers = workers, thread_name_prefix = 'member-fetch')
+        return _member_fetcher
+
+
+def _forked():
+    # the worker threads of the parent do not exist in a forked child
+    global _member_fetcher, _member_fetcher_lock
+    _member_fetcher = None
+    _member_fetcher_lock = threading.Lock()
+
+
+os.register_at_fork(after_in_child = _forked)
+
+
+def _fetch_players_parallel(player_tags):
+    # {player_tag: (json dump data, status_code, refreshed, elapsed ms)}, up to CLAN_MEMBER_FETCH_CONCURRENCY API calls at a time
+    app = current_app._get_current_object()
+    timings = current_timings()
+
+    def fetch(player_tag):
+        with app.app_context(), collecting(timings):
+            return _fetch_player_coalesced(player_tag)
+
+    workers = max(1, int(app.config.get('CLAN_MEMBER_FETCH_CONCURRENCY', 8)))
+    if workers <= 1 or len(player_tags) <= 1:
+        return {player_tag: _fetch_player_coalesced(player_tag) for player_tag in player_tags}
+    # each call in a copy of this context, the leases join the caller's hold_leases() block
+    futures = [_member_fetch_executor(workers).submit(contextvars.copy_context().run, fetch, player_tag)
+               for player_tag in player_tags]
+    return {player_tag: future.result() for player_tag, future in zip(player_tags, futures)}
+
+
+async def _fetch_player_coalesced_async(db, player_tag: str):
+    start = time.perf_counter()
+    (coc_data, status_code), refreshed = await single_flight_async(
+            db,
+            endpoint = 'player',
+            tag = player_tag,
+            refresh = lambda: fetch_async('player', player_tag),
+            stale = lambda conn: _stored_player(conn, player_tag),
+            # wait out another process's lease, held until its batch committed (hold_leases()),
+            # so a 'shared' member is the snapshot it stored
+            serve_stale = False
+            )
+    return coc_data, status_code, refreshed, round((time.perf_counter() - start) * 1000, 1)
+
+
+def _stale_members(conn, clan_tag: str, max_age: int):
+    # (member tags, {tag: fresh member}) of the newest stored snapshot of a clan, None if there is none
+    clan_data = load_latest_snapshots(conn, 'clan', [clan_tag]).get(clan_tag)
+    if clan_data is None:
+        return None
+
+    now = datetime.now()
+    member_tags = [member['tag'][1:] for member in clan_data.get('memberList', []) if member.get('tag')]
+    members = {}
+    seen_map = load_latest_seen(conn, 'player', member_tags)
+    for player_tag in member_tags:
+        data_time, last_seen = seen_map.get(player_tag, (None, None))
+        seen = last_seen or data_time
+        if seen and (now - datetime.strptime(seen, '%Y-%m-%d %H:%M:%S')).total_seconds() <= max_age:
+            members[player_tag] = {'status': 'fresh', 'dataTime': seen}
+    return member_tags, members
+
+
+def _store_members(conn, clan_tag: str, member_tags, members: dict, fetched: dict, start: float, fetch_start: float):
+    # write what was fetched in one transaction, return the report of refresh_clan_members()
+    store_start = time.perf_counter()
+    stored = store_player_snapshots(conn, [(player_tag, coc_data) for player_tag, (coc_data, status_code, refreshed, _) in fetched.items()
+                                           if refreshed and status_code == 200])
+    conn.commit()
+    invalidate(*(('player', player_tag) for player_tag in stored))
+    store_end = time.perf_counter()
+
+    for player_tag, (coc_data, status_code, refreshed, elapsed_ms) in fetched.items():
+        member = {'status_code': status_code, 'fetch_ms': elapsed_ms}
+        if player_tag in stored:
+            data_time, changed = stored[player_tag]
+            member.update(status = 'updated' if changed else 'unchanged', dataTime = data_time)
+        elif status_code == 200:
+            # another caller's fetch of the same data, stored by that caller's batch
+            member['status'] = 'shared'
+        else:
+            member.update(status = 'error', error = loads(coc_data).get('error'))
+        members[player_tag] = member
+
+    members = {player_tag: members[player_tag] for player_tag in member_tags}
+    current_app.logger.info(f"clan members of {clan_tag}: {len(fetched)} fetched, {len(stored)} stored")
+    return {
+        'clan': clan_tag,
+        'counts': dict(Counter(member['status'] for member in members.values())),
+        'fetch_ms': round((store_start - fetch_start) * 1000, 1),
+        'store_ms': round((store_end - store_start) * 1000, 1),
+        'total_ms': round((store_end - start) * 1000, 1),
+        'members': members,
+    }
+
+
+def refresh_clan_members(conn, clan_tag: str, max_age: int):
+    """
+    Refresh every member of the newest stored snapshot of a clan whose player
+    snapshot was last seen more than `max_age` seconds ago. The members are
+    fetched concurrently and stored in one transaction, their single-flight
+    leases are held until it committed. Returns (report,
+    status_code). The report holds a status per member tag, with the fetch time
+    and the resulting dataTime.
+    """
+    start = time.perf_counter()
+    stale = _stale_members(conn, clan_tag, max_age)
+    if stale is None:
+        return {'error': f"No clan data found for tag: {clan_tag}"}, 404
+    member_tags, members = stale
+    stale_tags = [player_tag for player_tag in member_tags if player_tag not in members]
+
+    fetch_start = time.perf_counter()
+    with hold_leases(conn):
+        fetched = _fetch_players_parallel(stale_tags) if stale_tags else {}
+        return _store_members(conn, clan_tag, member_tags, members, fetched, start, fetch_start), 200
+
+
+async def refresh_clan_members_async(db, clan_tag: str, max_age: int):
+    """refresh_clan_members() on `db`, a SQLiteExecutor, with every stale member's call in flight at once."""
+    start = time.perf_counter()
+    stale = await db.run(_stale_members, clan_tag, max_age)
+    if stale is None:
+        return {'error': f"No clan data found for tag: {clan_tag}"}, 404
+    member_tags, members = stale
+    stale_tags = [player_tag for player_tag in member_tags if player_tag not in members]
+
+    fetch_start = time.perf_counter()
+    async with hold_leases_async(db):
+        results = await asyncio.gather(*(_fetch_player_coalesced_async(db, player_tag) for player_tag in stale_tags))
+        fetched = dict(zip(stale_tags, results))
+        return await db.run(_store_members, clan_tag, member_tags, members, fetched, start, fetch_start), 200
+
+
+def store_clan_result(conn, clan_tag: str, coc_data, status_code: int):
+    if status_code == 200:
+        store_clan_snapshot(conn, clan_tag, coc_data)
+        conn.commit()
+        invalidate(('clan', clan_tag))
+    return coc_data, status_code
+
+
+def refresh_clan(conn, clan_tag: str):
+    return store_clan_result(conn, clan_tag, *fetch('clan', clan_tag))
+
+
+def store_current_war(conn, clan_tag: str, api_response_data, status_code: int):
+    if status_code == 200:
+        war_data = loads(api_response_data)
+        stored_data = encode_cocdata('warlog', api_response_data)
+        if 'endTime' in war_data:
+            endTime = clan_tag + war_data['endTime'][:8]
+            endTime2 = datetime.strptime(war_data['endTime'][:15], '%Y%m%dT%H%M%S')
+            if (datetime.now() > endTime2):
+                sql = 'INSERT OR REPLACE INTO warlog (endtime, tag, cocdata, dataTime) VALUES (?, ?, ?, ?)'
+                conn.execute(sql, (endTime, clan_tag, stored_data, endTime2))
+            else:
+                sql = 'INSERT OR REPLACE INTO warlog (endtime, tag, cocdata) VALUES (?, ?, ?)'
+                conn.execute(sql, (endTime, clan_tag, stored_data))
+        else:
+            conn.execute("INSERT OR REPLACE INTO warlog (endtime, tag, cocdata) VALUES (?, ?, ?)",
+                         (war_data['state'], clan_tag, stored_data))
+        conn.commit()
+    return api_response_data, status_code
+
+
+def refresh_current_war(conn, clan_tag: str):
+    return store_current_war(conn, clan_tag, *fetch('currentwar', clan_tag))
+
+
+def store_cwl_group_result(conn, clan_tag: str, api_response_data, status_code: int):
+    """Store a CWL league group of a clan under its season, 200 without a season is left unstored."""
+    if status_code == 200:
+        cwl_data = loads(api_response_data)
+        if 'season' in cwl_data:
+            season = cwl_data['season']
+            sql = 'INSERT OR REPLACE INTO clanwarleague (clanSeason, tag, cocdata, season) VALUES (?, ?, ?, ?)'
+            conn.execute(sql, (clan_tag + season, clan_tag, encode_cocdata('clanwarleague', api_response_data), season))
+            conn.commit()
+            invalidate(('cwl', clan_tag))
+    return api_response_data, status_code
+
+
+def refresh_cwl_group(conn, clan_tag: str):
+    """Fetch the CWL league group of a clan and store it under its season, 200 without a season is left unstored."""
+    return store_cwl_group_result(conn, clan_tag, *fetch('cwl', clan_tag))
+
+
+def _other_season(war_tag: str, season: str):
+    # CWL wars can only be fetched during their own season
+    current_season = str(datetime.now())[:7]
+    if current_season != season:
+        return dumps({'error': f"Not current season {season} {war_tag}"}), 500
+    return None
+
+
+def fetch_war_tag(war_tag: str, season: str):
+    return _other_season(war_tag, season) or fetch('WarTag', war_tag)
+
+
+async def fetch_war_tag_async(war_tag: str, season: str):
+    return _other_season(war_tag, season) or await fetch_async('WarTag', war_tag)
+
+
+def store_war_tags(conn, season: str, fetched: dict):
+    """
+    Write {war_tag: (json dump data, status_code, refreshed)} to cwlwarlog in one
+    transaction. Only results the caller fetched itself (refreshed) with status
+    200 are written, shared and stale results are already stored.
+    """
+    rows = [(season + war_tag, war_tag, encode_cocdata('cwlwarlog', api_response_data))
+            for war_tag, (api_response_data, status_code, refreshed) in fetched.items()
+            if refreshed and status_code == 200]
+    if not rows:
+        return
+    sql = 'INSERT OR REPLACE INTO cwlwarlog (seasonWartag, wartag, cocdata) VALUES (?, ?, ?)'
+    conn.executemany(sql, rows)
+    conn.commit()
+    invalidate(*(('wartag', season_war_tag) for season_war_tag, _, _ in rows))
+    for season_war_tag, war_tag, _ in rows:
+        current_app.logger.info(f"wartag db successfully updated {war_tag} {season}")
+
+
+def refresh_war_tag(conn, war_tag: str, season: str):
+    api_response_data, status_code = fetch_war_tag(war_tag, season)
+    store_war_tags(conn, season, {war_tag: (api_response_data, status_code, True)})
+    return api_response_data, status_code
@@ -0,0 +1,238 @@
+# app/utils/response_cache.py
+import functools
+import os
+import threading
+import time
+from collections import OrderedDict
+from flask import current_app, g
+
+from .db import get_db
+
+# Serialized 200 responses of the read-only routes, least recently used first.
+# Entries are keyed on the dataTime values of the data a view reads, from the
+# probe of @conditional or one of its own: a snapshot stored by any process,
+# another mod_wsgi worker or flask refresh-scheduler, makes the next request
+# miss. Every entry also lists the data it was built from, e.g. ('player',
+# tag), and the ingest routes of this process drop the matching entries as
+# soon as they commit, so the outdated bodies do not wait for the LRU.
+_lock = threading.Lock()
+_entries = OrderedDict()
+_keys_by_dep = {}
+_invalidated_at = {} # dep -> seq of its last invalidate(), only kept while an older render is in flight
+_renders = {} # seq at the start of each render in flight -> how many
+_prune_at = 1024
+_seq = 0
+_size = 0
+
+_stats = {'hits': 0, 'misses': 0, 'stores': 0, 'evictions': 0, 'expirations': 0, 'invalidations': 0}
+
+
+class _Entry:
+    __slots__ = ('body', 'status', 'headers', 'expires', 'deps', 'size')
+
+    def __init__(self, body, status, headers, expires, deps):
+        self.body = body
+        self.status = status
+        self.headers = headers
+        self.expires = expires
+        self.deps = deps
+        self.size = len(body)
+
+
+def response_cache_stats():
+    """Hit / miss / store / eviction / expiration / invalidation counters, entry count and cached bytes."""
+    with _lock:
+        stats = dict(_stats)
+        stats['entries'] = len(_entries)
+        stats['bytes'] = _size
+    return stats
+
+
+def _forked():
+    # the renders of the parent's threads never end in a forked child
+    global _lock
+    _lock = threading.Lock()
+    _renders.clear()
+    _invalidated_at.clear()
+
+
+os.register_at_fork(after_in_child=_forked)
+
+
+def reset_response_cache_stats():
+    # a forked child starts counting again, see utils/metrics.py; the entries it inherited stay valid
+    for name in _stats:
+        _stats[name] = 0
+
+
+def cache_depends(*deps, ttl: float = None):
+    """
+    Record what the response being built depends on, e.g. ('clan', clan_tag),
+    and optionally cap how long it may be cached, for output that also depends
+    on the clock. Call from a @cached_response view.
+    """
+    if 'cache_deps' in g:
+        g.cache_deps.update(deps)
+        if ttl is not None:
+            g.cache_ttl = ttl if g.cache_ttl is None else min(g.cache_ttl, ttl)
+
+
+def invalidate(*deps):
+    """Drop every cached response built from any of `deps`, call after the write is committed."""
+    global _seq
+    with _lock:
+        _seq += 1
+        for dep in deps:
+            if _renders:
+                _invalidated_at[dep] = _seq
+            for key in _keys_by_dep.pop(dep, ()):
+                if key in _entries:
+                    _remove(key)
+                    _stats['invalidations'] += 1
+        if len(_invalidated_at) > _prune_at:
+            _prune()
+
+
+def _prune():
+    # an invalidation at or before the start of the oldest render in flight cannot fail any store
+    global _prune_at
+    oldest = min(_renders, default=_seq)
+    for dep in [dep for dep, seq in _invalidated_at.items() if seq <= oldest]:
+        del _invalidated_at[dep]
+    _prune_at = max(1024, 2 * len(_invalidated_at))
+
+
+def _end_render(started_seq):
+    with _lock:
+        _renders[started_seq] -= 1
+        if not _renders[started_seq]:
+            del _renders[started_seq]
+        if not _renders:
+            # every render from now on starts at the current seq
+            _invalidated_at.clear()
+
+
+def _remove(key):
+    global _size
+    entry = _entries.pop(key)
+    _size -= entry.size
+    for dep in entry.deps:
+        keys = _keys_by_dep.get(dep)
+        if keys is not None:
+            keys.discard(key)
+            if not keys:
+                del _keys_by_dep[dep]
+
+
+def _lookup(key):
+    with _lock:
+        entry = _entries.get(key)
+        if entry is None:
+            _stats['misses'] += 1
+            _renders[_seq] = _renders.get(_seq, 0) + 1
+            return None, _seq
+        if entry.expires < time.monotonic():
+            _remove(key)
+            _stats['expirations'] += 1
+            _stats['misses'] += 1
+            _renders[_seq] = _renders.get(_seq, 0) + 1
+            return None, _seq
+        _entries.move_to_end(key)
+        _stats['hits'] += 1
+        return entry, _seq
+
+
+def _store(key, entry, started_seq, max_bytes):
+    global _size
+    if entry.size > max_bytes:
+        return
+    with _lock:
+        # an ingest committed while the response was built, it may already be outdated
+        if any(_invalidated_at.get(dep, 0) > started_seq for dep in entry.deps):
+            return
+        if key in _entries:
+            _remove(key)
+        _entries[key] = entry
+        _size += entry.size
+        for dep in entry.deps:
+            _keys_by_dep.setdefault(dep, set()).add(key)
+        _stats['stores'] += 1
+        while _size > max_bytes:
+            _remove(next(iter(_entries)))
+            _stats['evictions'] += 1
+
+
+def _tee(chunks, key, status, headers, expires, deps, started_seq, max_bytes):
+    # pass a streamed body through and store it once it was sent in full, unless it outgrew the cache
+    body = []
+    size = 0
+    try:
+        for chunk in chunks:
+            if isinstance(chunk, str):
+                chunk = chunk.encode('utf-8')
+            yield chunk
+            if body is not None:
+                size += len(chunk)
+                if size > max_bytes:
+                    body = None
+                else:
+                    body.append(chunk)
+        if body is not None:
+            _store(key, _Entry(b''.join(body), status, headers, expires, deps), started_seq, max_bytes)
+    finally:
+        if hasattr(chunks, 'close'):
+            chunks.close()
+
+
+def cached_response(view=None, *, probe=None):
+    """
+    Serve `view` from the response cache, keyed by view name, URL arguments and
+    the dataTime values the view reads: those @conditional probed, or
+    `probe(conn, **view_args)` for a view without it. A view with neither is
+    not cached. Only 200 responses of views that declared cache_depends() are
+    stored, until their ttl if they gave one, and RESPONSE_CACHE_MAX_BYTES
+    bounds the total body size. A streamed response is stored once its last
+    chunk has been sent.
+    """
+    if view is None:
+        return lambda view: cached_response(view, probe = probe)
+
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        config = current_app.config
+        max_bytes = config.get('RESPONSE_CACHE_MAX_BYTES', 0)
+        if not max_bytes:
+            return view(*args, **kwargs)
+
+        data_times = g.get('data_times') if probe is None else tuple(probe(get_db(), *args, **kwargs))
+        if data_times is None:
+            return view(*args, **kwargs)
+        # a newer snapshot stored by any process is another key
+        key = (view.__name__, args, tuple(sorted(kwargs.items())), data_times)
+        entry, started_seq = _lookup(key)
+        if entry is not None:
+            return current_app.response_class(entry.body, status=entry.status, headers=entry.headers)
+
+        # a miss starts a render, which ends once it was stored or given up
+        g.cache_deps = set()
+        g.cache_ttl = None
+        try:
+            response = current_app.make_response(view(*args, **kwargs))
+        except BaseException:
+            _end_render(started_seq)
+            raise
+        if response.status_code == 200 and g.cache_deps:
+            ttl = float('inf') if g.cache_ttl is None else g.cache_ttl
+            if ttl > 0 and response.is_streamed:
+                response.response = _tee(response.response, key, response.status_code, list(response.headers),
+                                         time.monotonic() + ttl, frozenset(g.cache_deps), started_seq, max_bytes)
+                # the server closes the body after its last chunk, or when the client went away
+                response.call_on_close(functools.partial(_end_render, started_seq))
+                return response
+            if ttl > 0:
+                entry = _Entry(response.get_data(), response.status_code, list(response.headers),
+                               time.monotonic() + ttl, frozenset(g.cache_deps))
+                _store(key, entry, started_seq, max_bytes)
+        _end_render(started_seq)
+        return response
+    return wrapper
@@ -0,0 +1,306 @@
+# app/utils/scheduler.py
+import heapq
+import itertools
+import json
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+
+from .blobs import load_json
+from .conditional import latest_seen
+from .db import get_db
+from .metrics import flush, maybe_flush, register_source
+from .refresh import refresh_clan, refresh_current_war, refresh_cwl_group, refresh_player, refresh_war_tag
+from .snapshots import latest_row_sql, load_latest_snapshots
+from .wars import cwl_war_sql, latest_cwl_sql
+
+# Background refresh of everything the site tracks, run by flask refresh-scheduler
+# next to the web server. Targets are (kind, tag) pairs found in the database:
+# every stored clan, the members of its newest snapshot, its current war, its CWL
+# league group and the war tags of the current season. Each is due a cadence
+# after its last stored fetch, and a heap ordered by due time hands the earliest
+# one to a bounded pool of workers, paced below the CoC API rate limit.
+
+DEFAULT_CADENCE = {
+    'clan': 82800,
+    'player': 82800,
+    'currentwar': 82800,
+    'currentwar_inwar': 900,
+    'cwl': 82800,
+    'cwl_active': 3600, # a current season group that has not ended
+    'wartag': 300, # never again once warEnded
+}
+
+# the same states _resolve_war_data serves from the database forever
+FINAL_WAR_STATES = ('warEnded', 'notInWar')
+
+_REFRESHERS = {
+    'clan': refresh_clan,
+    'player': refresh_player,
+    'currentwar': refresh_current_war,
+    'cwl': refresh_cwl_group,
+    'wartag': lambda conn, season_war_tag: refresh_war_tag(conn, season_war_tag[7:], season_war_tag[:7]),
+}
+
+
+def _epoch(data_time: str):
+    # dataTime is local time, see the column defaults in utils/schema.py
+    return datetime.strptime(data_time[:19], '%Y-%m-%d %H:%M:%S').timestamp()
+
+
+def _api_epoch(api_time: str):
+    # CoC API times look like 20250101T120000.000Z
+    return datetime.strptime(api_time[:15], '%Y%m%dT%H%M%S').replace(tzinfo=timezone.utc).timestamp()
+
+
+def _current_season():
+    return datetime.now().strftime('%Y-%m')
+
+
+def _snapshot_due(conn, table: str, tag: str, cadence: int):
+    data_time, last_seen = latest_seen(conn, table, tag)
+    if data_time is None:
+        return 0
+    return _epoch(last_seen or data_time) + cadence
+
+
+def _current_war_due(conn, clan_tag: str, cadence: dict):
+    row = conn.execute(latest_row_sql('warlog', 'cocdata, dataTime'), (clan_tag,)).fetchone()
+    if row is None:
+        return 0
+    try:
+        war_data = load_json(row['cocdata'])
+    except json.JSONDecodeError:
+        return 0
+    state = war_data.get('state')
+    if state == 'inWar':
+        return _epoch(row['dataTime']) + cadence['currentwar_inwar']
+    due = _epoch(row['dataTime']) + cadence['currentwar']
+    if state == 'preparation' and 'startTime' in war_data:
+        # pick the war up as soon as it starts
+        due = min(due, _api_epoch(war_data['startTime']))
+    return due
+
+
+def _cwl_group(conn, clan_tag: str):
+    # (group, dataTime) of the newest stored league group, (None, None) without one
+    row = conn.execute(latest_cwl_sql('cocdata, dataTime'), (clan_tag,)).fetchone()
+    if row is None:
+        return None, None
+    try:
+        return load_json(row['cocdata']), row['dataTime']
+    except json.JSONDecodeError:
+        return None, row['dataTime']
+
+
+def _cwl_due(conn, clan_tag: str, cadence: dict):
+    group, data_time = _cwl_group(conn, clan_tag)
+    if data_time is None:
+        return 0
+    if group and group.get('season') == _current_season() and group.get('state') != 'ended':
+        return _epoch(data_time) + cadence['cwl_active']
+    return _epoch(data_time) + cadence['cwl']
+
+
+def _war_tag_due(conn, season_war_tag: str, cadence: dict):
+    # None once the war is final, it never changes again
+    row = conn.execute(cwl_war_sql('cocdata, dataTime'), (season_war_tag,)).fetchone()
+    if row is None:
+        return 0
+    try:
+        state = load_json(row['cocdata']).get('state')
+    except json.JSONDecodeError:
+        return 0
+    if state in FINAL_WAR_STATES:
+        return None
+    return _epoch(row['dataTime']) + cadence['wartag']
+
+
+def target_due(conn, kind: str, tag: str, cadence: dict):
+    """Epoch seconds at which (kind, tag) is next due, 0 if it was never fetched, None if it never is again."""
+    if kind in ('clan', 'player'):
+        return _snapshot_due(conn, kind, tag, cadence[kind])
+    if kind == 'currentwar':
+        return _current_war_due(conn, tag, cadence)
+    if kind == 'cwl':
+        return _cwl_due(conn, tag, cadence)
+    return _war_tag_due(conn, tag, cadence)
+
+
+def scan_targets(conn, cadence: dict):
+    """Return {(kind, tag): due} for everything the database knows about and still needs refreshing."""
+    targets = {}
+    clan_tags = [row[0] for row in conn.execute('SELECT DISTINCT tag FROM clan')]
+    player_tags = [row[0] for row in conn.execute('SELECT DISTINCT player_tag FROM clan_member')]
+    keys = [('clan', tag) for tag in clan_tags] + [('player', tag) for tag in player_tags] + \
+           [('cwl', tag) for tag in clan_tags]
+
+    for clan_tag, clan_data in load_latest_snapshots(conn, 'clan', clan_tags).items():
+        if clan_data.get('isWarLogPublic'):
+            keys.append(('currentwar', clan_tag))
+
+    season = _current_season()
+    for clan_tag in clan_tags:
+        group, _ = _cwl_group(conn, clan_tag)
+        if not group or group.get('season') != season:
+            continue
+        for round_detail in group.get('rounds', []):
+            for war_tag in round_detail.get('warTags', []):
+                if war_tag != '#0':
+                    keys.append(('wartag', season + war_tag[1:]))
+
+    for kind, tag in keys:
+        due = target_due(conn, kind, tag, cadence)
+        if due is not None:
+            targets[(kind, tag)] = due
+    return targets
+
+
+class RefreshScheduler:
+    """
+    Keeps every target of scan_targets() refreshed. At most `concurrency`
+    refreshes run at once and at most `rate` start per second; a 429 from the
+    CoC API pauses all of them for `rate_limit_pause` seconds. The database is
+    rescanned every `rescan` seconds and after each clan or CWL group refresh,
+    which is how new members and war tags are picked up.
+    """
+
+    def __init__(self, app, concurrency: int = None, rate: float = None):
+        config = app.config
+        self.app = app
+        self.cadence = dict(DEFAULT_CADENCE, **config.get('REFRESH_CADENCE', {}))
+        self.concurrency = max(1, int(concurrency or config.get('REFRESH_CONCURRENCY', 4)))
+        self.rate = float(rate or config.get('REFRESH_RATE', 10))
+        self.retry = config.get('REFRESH_RETRY', 300)
+        self.rescan = config.get('REFRESH_RESCAN', 600)
+        self.rate_limit_pause = config.get('REFRESH_RATE_LIMIT_PAUSE', 60)
+
+        self._lock = threading.Lock()
+        self._heap = []
+        self._due = {} # key -> due of its live heap entry, older entries are skipped
+        self._running = set()
+        self._targets = set()
+        self._not_before = {} # key -> due set by its last refresh, a rescan cannot move it earlier
+        self._seq = itertools.count()
+        self._rescan_now = threading.Event()
+        self._next_start = 0.0
+        self._paused_until = 0.0
+        self.stats = {'refreshes': 0, 'failures': 0, 'rate_limited': 0}
+        register_source('scheduler', lambda: dict(self.stats, queued = self.queued()), gauges = ('queued',),
+                        reset = lambda: self.stats.update(dict.fromkeys(self.stats, 0)))
+
+    def _push(self, key, due):
+        if key in self._running:
+            return
+        if key not in self._due or due < self._due[key]:
+            self._due[key] = due
+            heapq.heappush(self._heap, (due, next(self._seq), key))
+
+    def schedule(self, targets: dict):
+        """Merge {(kind, tag): due} into the queue, a key already queued keeps the earlier due."""
+        with self._lock:
+            self._targets = set(targets)
+            for key, due in targets.items():
+                self._push(key, max(due, self._not_before.get(key, 0)))
+
+    def queued(self):
+        with self._lock:
+            return len(self._due)
+
+    def _pop_due(self, now: float):
+        # (key, None) for the earliest due target, or (None, its due time) if nothing is due yet
+        with self._lock:
+            while self._heap:
+                due, _, key = self._heap[0]
+                if self._due.get(key) != due:
+                    heapq.heappop(self._heap)
+                    continue
+                if due > now:
+                    return None, due
+                heapq.heappop(self._heap)
+                del self._due[key]
+                self._running.add(key)
+                return key, None
+            return None, None
+
+    def _refresh(self, key, slots):
+        kind, tag = key
+        status_code = 500
+        due = time.time() + self.retry
+        try:
+            with self.app.app_context():
+                conn = get_db()
+                try:
+                    _, status_code = _REFRESHERS[kind](conn, tag)
+                except Exception as e:
+                    conn.rollback()
+                    self.app.logger.error(f"refresh scheduler: {kind} {tag} failed: {e}")
+
+                now = time.time()
+                if status_code in (200, 404):
+                    due = target_due(conn, kind, tag, self.cadence)
+                    if due is not None and due <= now:
+                        # nothing stored, e.g. a 404 for a clan not in CWL
+                        due = now + self.cadence.get(kind, self.retry)
+                else:
+                    due = now + self.retry
+                if status_code == 429:
+                    self._paused_until = now + self.rate_limit_pause
+                    self.app.logger.warning(f"refresh scheduler: rate limited, pausing {self.rate_limit_pause}s")
+                # the scheduler runs in a process of its own, /metrics reads its counters from process_metric
+                maybe_flush()
+        finally:
+            with self._lock:
+                self._running.discard(key)
+                self.stats['refreshes'] += 1
+                self.stats['failures'] += status_code not in (200, 404)
+                self.stats['rate_limited'] += status_code == 429
+                if due is None:
+                    self._not_before.pop(key, None)
+                else:
+                    self._not_before[key] = due
+                    if key in self._targets:
+                        self._push(key, due)
+            slots.release()
+        if status_code == 200 and kind in ('clan', 'cwl'):
+            self._rescan_now.set()
+
+    def run(self, stop: threading.Event = None, until_idle: bool = False):
+        """
+        Refresh due targets until `stop` is set. With `until_idle`, return once
+        nothing is due and no refresh is running, e.g. for a cron job.
+        """
+        stop = stop or threading.Event()
+        slots = threading.Semaphore(self.concurrency)
+        next_scan = 0.0
+        with ThreadPoolExecutor(max_workers = self.concurrency) as executor:
+            while not stop.is_set():
+                now = time.time()
+                if now >= next_scan or self._rescan_now.is_set():
+                    self._rescan_now.clear()
+                    with self.app.app_context():
+                        self.schedule(scan_targets(get_db(), self.cadence))
+                    next_scan = now + self.rescan
+                if self._paused_until > now:
+                    stop.wait(self._paused_until - now)
+                    continue
+                if not slots.acquire(timeout = 1.0):
+                    continue
+                key, next_due = self._pop_due(now)
+                if key is None:
+                    slots.release()
+                    with self._lock:
+                        idle = not self._running
+                    if until_idle and idle and not self._rescan_now.is_set():
+                        break
+                    stop.wait(min(1.0, max(0.0, (next_due or now + 1.0) - now)))
+                    continue
+                # pace the starts, the CoC API limits calls per second per key
+                if self._next_start > now:
+                    stop.wait(self._next_start - now)
+                self._next_start = max(now, self._next_start) + 1.0 / self.rate
+                executor.submit(self._refresh, key, slots)
+        with self.app.app_context():
+            flush()
+        return dict(self.stats)
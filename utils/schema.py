@@ -0,0 +1,319 @@
+# app/utils/schema.py
+import json
+import re
+
+# Versioned schema, tracked in PRAGMA user_version. Every step is idempotent so
+# databases created before the app owned its schema migrate in place.
+
+BASE_TABLES = """
+CREATE TABLE IF NOT EXISTS player (
+    tag TEXT NOT NULL,
+    dataTime TEXT NOT NULL DEFAULT (datetime('now', 'localtime')),
+    cocdata BLOB,
+    PRIMARY KEY (tag, dataTime)
+);
+CREATE TABLE IF NOT EXISTS clan (
+    tag TEXT NOT NULL,
+    dataTime TEXT NOT NULL DEFAULT (datetime('now', 'localtime')),
+    cocdata BLOB,
+    PRIMARY KEY (tag, dataTime)
+);
+CREATE TABLE IF NOT EXISTS warlog (
+    endTime TEXT PRIMARY KEY,
+    tag TEXT,
+    cocdata BLOB,
+    dataTime TEXT NOT NULL DEFAULT (datetime('now', 'localtime'))
+);
+CREATE TABLE IF NOT EXISTS clanwarlog (
+    tag TEXT NOT NULL,
+    cocdata BLOB,
+    dataTime TEXT NOT NULL DEFAULT (datetime('now', 'localtime'))
+);
+CREATE TABLE IF NOT EXISTS clanwarleague (
+    clanSeason TEXT PRIMARY KEY,
+    tag TEXT,
+    cocdata BLOB,
+    season TEXT,
+    dataTime TEXT NOT NULL DEFAULT (datetime('now', 'localtime'))
+);
+CREATE TABLE IF NOT EXISTS cwlwarlog (
+    seasonWarTag TEXT PRIMARY KEY,
+    warTag TEXT,
+    cocdata BLOB,
+    dataTime TEXT NOT NULL DEFAULT (datetime('now', 'localtime'))
+);
+"""
+
+METRIC_TABLES = """
+CREATE TABLE IF NOT EXISTS player_metric (
+    tag TEXT NOT NULL,
+    dataTime TEXT NOT NULL,
+    name TEXT NOT NULL,
+    value INTEGER,
+    PRIMARY KEY (tag, name, dataTime)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS player_unit_level (
+    tag TEXT NOT NULL,
+    dataTime TEXT NOT NULL,
+    village TEXT NOT NULL,
+    name TEXT NOT NULL,
+    level INTEGER,
+    PRIMARY KEY (tag, dataTime, village, name)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS player_upgrade (
+    tag TEXT NOT NULL,
+    dataTime TEXT NOT NULL,
+    village TEXT NOT NULL,
+    name TEXT NOT NULL,
+    level INTEGER,
+    PRIMARY KEY (tag, dataTime, village, name)
+) WITHOUT ROWID;
+"""
+
+# single-flight leases of CoC API refreshes shared by all processes (utils/singleflight.py)
+LEASE_TABLES = """
+CREATE TABLE IF NOT EXISTS refresh_lease (
+    key TEXT PRIMARY KEY,
+    owner TEXT NOT NULL,
+    expires REAL NOT NULL
+);
+"""
+
+# token buckets of the CoC API keys shared by all processes (utils/ratelimit.py)
+RATE_LIMIT_TABLES = """
+CREATE TABLE IF NOT EXISTS api_rate_bucket (
+    key TEXT PRIMARY KEY,
+    tokens REAL NOT NULL,
+    updated REAL NOT NULL,
+    blocked_until REAL NOT NULL DEFAULT 0
+);
+"""
+
+# the metric series of every process, summed up by /metrics (utils/metrics.py)
+PROCESS_METRIC_TABLES = """
+CREATE TABLE IF NOT EXISTS process_metric (
+    process TEXT NOT NULL,
+    name TEXT NOT NULL,
+    labels TEXT NOT NULL,
+    kind TEXT NOT NULL,
+    value REAL NOT NULL,
+    updated REAL NOT NULL,
+    PRIMARY KEY (process, name, labels)
+) WITHOUT ROWID;
+"""
+
+# member tags of the newest snapshot of every clan, kept by store_clan_snapshot()
+CLAN_MEMBER_TABLES = """
+CREATE TABLE IF NOT EXISTS clan_member (
+    clan_tag TEXT NOT NULL,
+    player_tag TEXT NOT NULL,
+    PRIMARY KEY (clan_tag, player_tag)
+) WITHOUT ROWID;
+"""
+
+# dictionaries for compressed cocdata, referenced by id from the blob header (utils/blobs.py)
+BLOB_DICTIONARY_TABLES = """
+CREATE TABLE IF NOT EXISTS blob_dictionary (
+    id INTEGER PRIMARY KEY,
+    tablename TEXT NOT NULL,
+    codec TEXT NOT NULL,
+    data BLOB NOT NULL,
+    created TEXT NOT NULL DEFAULT (datetime('now', 'localtime'))
+);
+"""
+
+# (index name, table, columns) matched to the lookups in api/*/routes.py and utils/
+HOT_INDEXES = [
+    # newest snapshot / history per tag: every "tag = ? ORDER BY dataTime DESC"
+    ('player_tag_time', 'player', ('tag', 'dataTime')),
+    ('clan_tag_time', 'clan', ('tag', 'dataTime')),
+    # get_clan_war_history / get_wardetail: "endTime = ? ORDER BY dataTime DESC"
+    ('warlog_endtime_time', 'warlog', ('endTime', 'dataTime')),
+    # get_current_war_detail: "tag = ? ORDER BY dataTime DESC limit 1"
+    ('warlog_tag_time', 'warlog', ('tag', 'dataTime')),
+    ('clanwarlog_tag_time', 'clanwarlog', ('tag', 'dataTime')),
+    # _get_cwl_data_from_db latest season / get_cwl_list last six entries
+    ('clanwarleague_tag_season', 'clanwarleague', ('tag', 'clanSeason')),
+    ('clanwarleague_tag_time', 'clanwarleague', ('tag', 'dataTime')),
+    ('cwlwarlog_seasonwartag', 'cwlwarlog', ('seasonWarTag',)),
+    # get_player_info: every metric of one player over a dataTime range
+    ('player_metric_tag_time', 'player_metric', ('tag', 'dataTime')),
+]
+
+
+def _index_columns(conn, index_name: str):
+    return tuple(row[2] for row in conn.execute(f"PRAGMA index_info('{index_name}')"))
+
+
+def ensure_index(conn, name: str, table: str, columns):
+    """
+    Create an index on `columns` unless an existing one already serves the same
+    lookups: an index led by the same columns, or a unique index on a prefix of
+    them (the primary keys of most of the tables above).
+    """
+    columns = tuple(col.lower() for col in columns)
+    for row in conn.execute(f"PRAGMA index_list('{table}')"):
+        # index_list rows are (seq, name, unique, origin, partial)
+        existing = tuple(col.lower() for col in _index_columns(conn, row[1]))
+        unique = row[2]
+        if existing[:len(columns)] == columns:
+            return False
+        if unique and existing and columns[:len(existing)] == existing:
+            return False
+    conn.execute(f"CREATE INDEX IF NOT EXISTS {name} ON {table} ({', '.join(columns)})")
+    return True
+
+
+def _create_hot_indexes(conn):
+    for name, table, columns in HOT_INDEXES:
+        ensure_index(conn, name, table, columns)
+
+
+def _create_clan_members(conn):
+    from .blobs import load_json
+    from .ingest import store_clan_members
+
+    conn.execute(CLAN_MEMBER_TABLES)
+    sql = """
+        SELECT c.tag, c.cocdata FROM clan c
+        WHERE c.dataTime = (SELECT MAX(dataTime) FROM clan WHERE tag = c.tag)
+    """
+    for row in conn.execute(sql).fetchall():
+        try:
+            store_clan_members(conn, row[0], load_json(row[1]))
+        except json.JSONDecodeError:
+            continue
+
+
+# snapshot tables whose unchanged fetches only move lastSeen of the newest row (utils/ingest.py)
+SEEN_TABLES = ('player', 'clan')
+
+
+def _add_seen_columns(conn):
+    for table in SEEN_TABLES:
+        columns = {row[1] for row in conn.execute(f"PRAGMA table_info('{table}')")}
+        if 'contentHash' not in columns:
+            conn.execute(f'ALTER TABLE {table} ADD COLUMN contentHash TEXT')
+        if 'lastSeen' not in columns:
+            conn.execute(f'ALTER TABLE {table} ADD COLUMN lastSeen TEXT')
+
+
+MIGRATIONS = [
+    (1, 'base snapshot tables', BASE_TABLES),
+    (2, 'player metric, unit level and upgrade tables', METRIC_TABLES),
+    (3, 'indexes for hot lookups', _create_hot_indexes),
+    (4, 'refresh lease table', LEASE_TABLES),
+    (5, 'clan member table', _create_clan_members),
+    (6, 'compressed cocdata dictionary table', BLOB_DICTIONARY_TABLES),
+    (7, 'snapshot content hash and last seen columns', _add_seen_columns),
+    (8, 'api key rate limit buckets', RATE_LIMIT_TABLES),
+    (9, 'per process metric series', PROCESS_METRIC_TABLES),
+]
+
+SCHEMA_VERSION = MIGRATIONS[-1][0]
+
+
+def migrate(conn, log=None):
+    """Bring the database up to SCHEMA_VERSION. Returns the versions applied."""
+    applied = []
+    version = conn.execute('PRAGMA user_version').fetchone()[0]
+    for step_version, description, step in MIGRATIONS:
+        if step_version <= version:
+            continue
+        if callable(step):
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                step(conn)
+                conn.execute(f'PRAGMA user_version = {step_version}')
+                conn.commit()
+            except Exception:
+                conn.rollback()
+                raise
+        else:
+            # executescript commits first and runs the whole script in one call
+            conn.executescript(f'BEGIN IMMEDIATE;\n{step}\nPRAGMA user_version = {step_version};\nCOMMIT;')
+        applied.append(step_version)
+        if log:
+            log(f"schema migrated to version {step_version}: {description}")
+    return applied
+
+
+def hot_queries():
+    """(route, sql, params, allow_sort) for the statements behind every read route."""
+    from .archive import HOT_START_SQL, SPAN_SQL, player_rows_sql
+    from .conditional import CLAN_DATA_TIMES_SQL, CWL_SUMMARY_DATA_TIMES_SQL
+    from .history import SNAPSHOT_METRICS_SQL, UPGRADE_EVENTS_SQL, metric_history_sql
+    from .snapshots import CHAIN_STEP_SQL, SNAPSHOT_AT_SQL, fields_sql, latest_row_sql, latest_seen_sql, latest_snapshots_sql
+    from .wars import (CWL_LIST_SQL, CWL_SEASON_DATA_TIME_SQL, WAR_DATA_TIME_SQL, cwl_season_sql, cwl_war_sql,
+                       cwl_wars_sql, latest_cwl_sql, war_sql)
+
+    tags = ['TAG1', 'TAG2', 'TAG3']
+    fields, field_params = fields_sql('player', len(tags), ['$.name', '$.troops'])
+    return [
+        ('clan latest', latest_row_sql('clan', 'cocdata'), ('TAG',), False),
+        ('clan members latest', latest_snapshots_sql('player', len(tags)), tags, False),
+        ('clan members fields', fields, (*tags, *field_params), False),
+        ('fetch_members last seen', latest_seen_sql('player', len(tags)), tags, False),
+        # the window sorts at most limit x members rows, which is the point of the query
+        ('clan progress history', metric_history_sql(len(tags)), (*tags, 'attackWins', 61), True),
+        ('player info snapshots', player_rows_sql('player', 'dataTime, lastSeen', until = True, limit = True), ('TAG', '2025-01-01', 90), False),
+        ('player progress snapshots', player_rows_sql('player', 'dataTime, lastSeen', limit = True), ('TAG', 361), False),
+        ('player info snapshot', player_rows_sql('player', 'dataTime, cocdata', until = True, limit = True), ('TAG', '2025-01-01', 1), False),
+        ('player snapshot chain', CHAIN_STEP_SQL.format('player'), ('TAG', '2025-01-01'), False),
+        ('player progress snapshot', SNAPSHOT_AT_SQL.format('player'), ('TAG', '2025-01-01'), False),
+        # reads past the hot store, see utils/archive.py
+        ('player archive span', SPAN_SQL, ('TAG',), False),
+        ('player hot store start', HOT_START_SQL, ('TAG',), False),
+        ('player info metrics', SNAPSHOT_METRICS_SQL, ('TAG', '2025-01-01', '2025-04-01'), False),
+        ('player progress events', UPGRADE_EVENTS_SQL, ('TAG', '2025-01-01', '2026-01-01'), False),
+        ('player fetch latest', latest_row_sql('player', 'cocdata, dataTime, lastSeen'), ('TAG',), False),
+        ('clan fetch latest', latest_row_sql('clan', 'cocdata, dataTime, lastSeen'), ('TAG',), False),
+        ('snapshot dedup check', latest_row_sql('player', 'dataTime, contentHash'), ('TAG',), False),
+        ('currentwar latest', latest_row_sql('warlog', 'cocdata, dataTime'), ('TAG',), False),
+        ('warlog latest', latest_row_sql('clanwarlog', 'cocdata, dataTime'), ('TAG',), False),
+        ('warlog war detail', war_sql('cocdata'), ('TAG20250101',), False),
+        ('cwl list', CWL_LIST_SQL, ('TAG',), False),
+        ('cwl season', cwl_season_sql('cocdata'), ('TAG2025-01',), False),
+        ('cwl latest season', latest_cwl_sql('cocdata'), ('TAG',), False),
+        ('cwl war tag', cwl_war_sql('cocdata'), ('2025-01TAG',), False),
+        ('cwl summary wars', cwl_wars_sql(len(tags)), [f"2025-01{tag}" for tag in tags], False),
+        # conditional GET probes, see utils/conditional.py
+        ('clan etag probe', CLAN_DATA_TIMES_SQL, ('TAG', 'TAG', 'TAG'), False),
+        ('cwl summary cache probe', CWL_SUMMARY_DATA_TIMES_SQL, ('TAG2025-01',), False),
+        ('player etag probe', latest_row_sql('player', 'dataTime, lastSeen'), ('TAG',), False),
+        ('player etag probe from date', player_rows_sql('player', 'dataTime, lastSeen', until = True, limit = True), ('TAG', '2025-01-01', 1), False),
+        ('wardetail etag probe', WAR_DATA_TIME_SQL, ('TAG20250101',), False),
+        ('cwl season etag probe', latest_cwl_sql('dataTime'), ('TAG',), False),
+        ('cwl season etag probe by season', CWL_SEASON_DATA_TIME_SQL, ('TAG2025-01',), False),
+    ]
+
+
+def _derived_names(sql: str):
+    # CTE names and subquery aliases show up as SCAN targets without being tables
+    names = set(re.findall(r'(\w+)\s*(?:\([^)]*\))?\s+AS\s*(?:(?:NOT\s+)?MATERIALIZED\s*)?\(', sql, re.IGNORECASE))
+    names.update(re.findall(r'\)\s*AS\s+(\w+)', sql, re.IGNORECASE))
+    for source, alias in re.findall(r'\b(?:FROM|JOIN)\s+(\w+)\s+(?:AS\s+)?(\w+)', sql, re.IGNORECASE):
+        if source in names:
+            names.add(alias)
+    return names
+
+
+def check_query_plans(conn, queries=None):
+    """
+    Run EXPLAIN QUERY PLAN over `queries` (default hot_queries()) and return
+    [(route, plan lines, problems)] flagging full table scans and temp B-tree sorts.
+    """
+    results = []
+    for route, sql, params, allow_sort in queries or hot_queries():
+        plan = [row[3] for row in conn.execute('EXPLAIN QUERY PLAN ' + sql, params)]
+        derived = _derived_names(sql)
+        problems = []
+        for detail in plan:
+            if detail.startswith('SCAN ') and 'USING' not in detail:
+                target = detail.split()[1]
+                if 'CONSTANT ROW' not in detail and not target.startswith('(') and target not in derived:
+                    problems.append(f"full scan: {detail}")
+            if 'USE TEMP B-TREE' in detail and not allow_sort:
+                problems.append(f"sort: {detail}")
+        results.append((route, plan, problems))
+    return results
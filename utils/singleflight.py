@@ -0,0 +1,269 @@
+# app/utils/singleflight.py
+import asyncio
+import contextlib
+import contextvars
+import threading
+import time
+import uuid
+from flask import current_app
+
+# Refreshes of the same (endpoint, tag) are coalesced: one caller runs the
+# upstream fetch and the others share its result. Threads of this process meet
+# in _flights, tasks of asgi.py's event loop in _async_flights, other processes
+# meet in the refresh_lease table. A lease is released once its refresh has
+# returned, or for a refresh that only fetches, once the caller's batch holding
+# the result committed (hold_leases()): another process waiting on the lease
+# then reads what was stored.
+_lock = threading.Lock()
+_flights = {}
+_async_flights = {}
+# (lease key, owner) of the leases the enclosing hold_leases() block releases
+_held = contextvars.ContextVar('single_flight_held', default=None)
+
+_stats_lock = threading.Lock()
+_stats = {}
+
+
+class _Flight:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+def _count(endpoint: str, **increments):
+    with _stats_lock:
+        counters = _stats.setdefault(endpoint, {'calls': 0, 'refreshes': 0, 'coalesced': 0, 'stale': 0, 'lease_waits': 0})
+        for name, value in increments.items():
+            counters[name] += value
+
+
+def single_flight_stats():
+    """
+    Per-endpoint counters of this process: calls, refreshes that went upstream,
+    callers that shared another thread's refresh (coalesced), callers served
+    from the database while another process held the lease (stale, lease_waits),
+    and coalescing_ratio, the share of calls that did not go upstream.
+    """
+    with _stats_lock:
+        stats = {endpoint: dict(counters) for endpoint, counters in _stats.items()}
+    for counters in stats.values():
+        calls = counters['calls']
+        counters['coalescing_ratio'] = round((calls - counters['refreshes']) / calls, 4) if calls else 0.0
+    return stats
+
+
+def reset_single_flight_stats():
+    # a forked child starts counting again, see utils/metrics.py
+    global _stats_lock
+    _stats_lock = threading.Lock()
+    _stats.clear()
+
+
+def _acquire_lease(conn, lease_key: str, owner: str, ttl: float):
+    now = time.time()
+    cur = conn.execute(
+            'INSERT INTO refresh_lease (key, owner, expires) VALUES (?, ?, ?) '
+            'ON CONFLICT(key) DO UPDATE SET owner = excluded.owner, expires = excluded.expires '
+            'WHERE refresh_lease.expires < ?', (lease_key, owner, now + ttl, now))
+    conn.commit()
+    return cur.rowcount == 1
+
+
+def _release_lease(conn, lease_key: str, owner: str):
+    conn.execute('DELETE FROM refresh_lease WHERE key = ? AND owner = ?', (lease_key, owner))
+    conn.commit()
+
+
+def _release_leases(conn, held):
+    # writes left uncommitted at the end of a hold_leases() block are not part of a stored batch
+    if conn.in_transaction:
+        conn.rollback()
+    for lease_key, owner in held:
+        conn.execute('DELETE FROM refresh_lease WHERE key = ? AND owner = ?', (lease_key, owner))
+    conn.commit()
+
+
+def _release_later(lease_key: str, owner: str):
+    # True when an enclosing hold_leases() block releases the lease
+    held = _held.get()
+    if held is None:
+        return False
+    held.append((lease_key, owner))
+    return True
+
+
+@contextlib.contextmanager
+def hold_leases(conn):
+    """
+    Keep the leases of the refreshes run inside the block until it ends, for
+    callers whose `refresh` only fetches and who store the results in one
+    transaction afterwards; commit it inside the block. Worker threads join the
+    block when they run in a contextvars.copy_context() of the caller.
+    """
+    held = []
+    token = _held.set(held)
+    try:
+        yield
+    finally:
+        _held.reset(token)
+        if held:
+            _release_leases(conn, held)
+
+
+@contextlib.asynccontextmanager
+async def hold_leases_async(db):
+    """hold_leases() for the tasks of one event loop, the leases are released on `db`, a SQLiteExecutor."""
+    held = []
+    token = _held.set(held)
+    try:
+        yield
+    finally:
+        _held.reset(token)
+        if held:
+            await db.run(_release_leases, held)
+
+
+def _lease_free(conn, lease_key: str):
+    row = conn.execute('SELECT expires FROM refresh_lease WHERE key = ?', (lease_key,)).fetchone()
+    return row is None or row[0] < time.time()
+
+
+def _wait_for_lease(conn, lease_key: str, timeout: float):
+    # True once the lease is released or expired, False if `timeout` runs out first
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if _lease_free(conn, lease_key):
+            return True
+        time.sleep(0.05)
+    return False
+
+
+def _lead(conn, endpoint: str, tag: str, refresh, stale, serve_stale: bool):
+    config = current_app.config
+    ttl = config.get('SINGLE_FLIGHT_LEASE', 30)
+    lease_key = f"{endpoint}:{tag}"
+    owner = uuid.uuid4().hex
+    leased = _acquire_lease(conn, lease_key, owner, ttl)
+    if not leased and stale is not None:
+        # another process is refreshing, its write lands in the same database
+        if serve_stale:
+            result = stale()
+            if result is not None:
+                _count(endpoint, stale=1)
+                return result, False
+        if _wait_for_lease(conn, lease_key, ttl):
+            result = stale()
+            if result is not None:
+                _count(endpoint, lease_waits=1)
+                return result, False
+        current_app.logger.info(f"single flight: no stored result for {lease_key} after lease wait, refreshing")
+    try:
+        _count(endpoint, refreshes=1)
+        return refresh(), True
+    finally:
+        if leased and not _release_later(lease_key, owner):
+            _release_lease(conn, lease_key, owner)
+
+
+def single_flight(conn, endpoint: str, tag: str, refresh, stale=None, serve_stale: bool = True):
+    """
+    Run `refresh()` for (endpoint, tag) unless another caller already is, and
+    return (result, refreshed). Threads arriving during a refresh wait for it and
+    share its result. When another process holds the lease, `stale()` (the copy
+    currently stored, or None) is returned right away if `serve_stale`, otherwise
+    after that process finishes. `refreshed` is True only for the caller that ran
+    `refresh()`. `conn` must not have uncommitted writes, the lease commits on it.
+    Inside hold_leases() the lease is kept until the block ends.
+    """
+    _count(endpoint, calls=1)
+    key = (endpoint, tag)
+    with _lock:
+        flight = _flights.get(key)
+        leader = flight is None
+        if leader:
+            flight = _flights[key] = _Flight()
+
+    if not leader:
+        _count(endpoint, coalesced=1)
+        flight.done.wait()
+        if flight.error is not None:
+            raise flight.error
+        return flight.result[0], False
+
+    try:
+        flight.result = _lead(conn, endpoint, tag, refresh, stale, serve_stale)
+        return flight.result
+    except BaseException as e:
+        flight.error = e
+        raise
+    finally:
+        with _lock:
+            del _flights[key]
+        flight.done.set()
+
+
+async def _wait_for_lease_async(db, lease_key: str, timeout: float):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if await db.run(_lease_free, lease_key):
+            return True
+        await asyncio.sleep(0.05)
+    return False
+
+
+async def _lead_async(db, endpoint: str, tag: str, refresh, stale, serve_stale: bool):
+    # _lead() with the lease queries on db, a SQLiteExecutor
+    ttl = current_app.config.get('SINGLE_FLIGHT_LEASE', 30)
+    lease_key = f"{endpoint}:{tag}"
+    owner = uuid.uuid4().hex
+    leased = await db.run(_acquire_lease, lease_key, owner, ttl)
+    if not leased and stale is not None:
+        if serve_stale:
+            result = await db.run(stale)
+            if result is not None:
+                _count(endpoint, stale=1)
+                return result, False
+        if await _wait_for_lease_async(db, lease_key, ttl):
+            result = await db.run(stale)
+            if result is not None:
+                _count(endpoint, lease_waits=1)
+                return result, False
+        current_app.logger.info(f"single flight: no stored result for {lease_key} after lease wait, refreshing")
+    try:
+        _count(endpoint, refreshes=1)
+        return await refresh(), True
+    finally:
+        if leased and not _release_later(lease_key, owner):
+            await db.run(_release_lease, lease_key, owner)
+
+
+async def single_flight_async(db, endpoint: str, tag: str, refresh, stale=None, serve_stale: bool = True):
+    """
+    single_flight() for the tasks of one event loop: `refresh` is a coroutine
+    function, `stale(conn)` and the lease run on `db`, a SQLiteExecutor. Tasks
+    arriving during a refresh await it instead of blocking a thread.
+    """
+    _count(endpoint, calls=1)
+    key = (endpoint, tag)
+    flight = _async_flights.get(key)
+    if flight is not None:
+        _count(endpoint, coalesced=1)
+        result, _ = await asyncio.shield(flight)
+        return result, False
+
+    flight = _async_flights[key] = asyncio.get_running_loop().create_future()
+    try:
+        result = await _lead_async(db, endpoint, tag, refresh, stale, serve_stale)
+        flight.set_result(result)
+        return result
+    except asyncio.CancelledError:
+        flight.cancel()
+        raise
+    except BaseException as e:
+        flight.set_exception(e)
+        # marks the error retrieved when no other task was waiting for it
+        flight.exception()
+        raise
+    finally:
+        del _async_flights[key]
@@ -0,0 +1,206 @@
+# app/utils/snapshots.py
+import json
+from flask import current_app
+
+from .archive import archive_range, player_row_at
+from .blobs import decode_delta, is_delta, load_json
+from .delta import apply
+from .jsoncodec import loads
+
+# tables that keep one cocdata snapshot per (tag, dataTime)
+SNAPSHOT_TABLES = ('player', 'clan')
+
+# stay well below SQLite's host parameter limit for large IN lists
+_MAX_TAGS_PER_QUERY = 500
+
+# the snapshot of a tag stored at a dataTime
+SNAPSHOT_AT_SQL = 'SELECT cocdata FROM {} WHERE tag = ? AND dataTime = ?'
+
+# one step back along a delta chain of the player table or an archive partition, a primary key seek
+CHAIN_STEP_SQL = 'SELECT dataTime, cocdata FROM {} WHERE tag = ? AND dataTime < ? ORDER BY dataTime DESC LIMIT 1'
+
+
+def latest_row_sql(table: str, columns: str):
+    # newest row of a tag in a table keyed on (tag, dataTime): player, clan, warlog and clanwarlog
+    return f'SELECT {columns} FROM {table} WHERE tag = ? ORDER BY dataTime DESC LIMIT 1'
+
+
+def latest_snapshots_sql(table: str, tag_count: int):
+    # one MAX(dataTime) index seek per tag, instead of grouping every row of each tag's history
+    values = ', '.join(['(?)'] * tag_count)
+    return f"""
+        WITH wanted(tag) AS (VALUES {values})
+        SELECT s.cocdata, s.tag
+        FROM wanted w
+        JOIN {table} s ON s.tag = w.tag
+            AND s.dataTime = (SELECT MAX(dataTime) FROM {table} WHERE tag = w.tag)
+    """
+
+
+def load_latest_snapshots(conn, table: str, tags):
+    """
+    Fetch the newest snapshot of every tag in `tags` with one statement per chunk
+    and return a {tag: parsed cocdata} map. Tags without data, or whose cocdata
+    cannot be decoded, are left out of the map.
+    """
+    if table not in SNAPSHOT_TABLES:
+        raise ValueError(f"{table} is not a snapshot table")
+
+    tags = list(dict.fromkeys(tags))
+    snapshot_map = {}
+    for start in range(0, len(tags), _MAX_TAGS_PER_QUERY):
+        chunk = tags[start:start + _MAX_TAGS_PER_QUERY]
+        sql = latest_snapshots_sql(table, len(chunk))
+        for row in conn.execute(sql, chunk):
+            try:
+                snapshot_map[row['tag']] = load_json(row['cocdata'])
+            except json.JSONDecodeError as e:
+                current_app.logger.warning(f"Skipping malformed {table} data for tag {row['tag']}: {e}")
+                continue
+    return snapshot_map
+
+
+def latest_seen_sql(table: str, tag_count: int):
+    # dataTime and lastSeen of the newest snapshot of each tag, one index seek per tag
+    values = ', '.join(['(?)'] * tag_count)
+    return f"""
+        WITH wanted(tag) AS (VALUES {values})
+        SELECT s.tag, s.dataTime, s.lastSeen
+        FROM wanted w
+        JOIN {table} s ON s.tag = w.tag
+            AND s.dataTime = (SELECT MAX(dataTime) FROM {table} WHERE tag = w.tag)
+    """
+
+
+def load_latest_seen(conn, table: str, tags):
+    """
+    {tag: (dataTime, lastSeen)} of the newest snapshot of every tag in `tags`,
+    like utils/conditional.py latest_seen() with one statement per chunk. Tags
+    without data are left out of the map.
+    """
+    if table not in SNAPSHOT_TABLES:
+        raise ValueError(f"{table} is not a snapshot table")
+
+    tags = list(dict.fromkeys(tags))
+    seen_map = {}
+    for start in range(0, len(tags), _MAX_TAGS_PER_QUERY):
+        chunk = tags[start:start + _MAX_TAGS_PER_QUERY]
+        for tag, data_time, last_seen in conn.execute(latest_seen_sql(table, len(chunk)), chunk):
+            seen_map[tag] = (data_time, last_seen)
+    return seen_map
+
+
+def fields_sql(table: str, tag_count: int, paths):
+    """
+    The newest snapshot of each of `tag_count` tags projected onto the JSON
+    `paths` by SQLite. Raw JSON rows are read as they are, compressed ones go
+    through cocdata_json(). Returns (sql, path parameters to bind after the tags).
+    """
+    values = ', '.join(['(?)'] * tag_count)
+    sql = f"""
+        WITH wanted(tag) AS (VALUES {values}),
+        docs AS MATERIALIZED (
+            SELECT s.tag,
+                CASE WHEN substr(s.cocdata, 1, 1) IN (x'7B', '{{') THEN CAST(s.cocdata AS TEXT)
+                    ELSE cocdata_json(s.cocdata) END AS doc
+            FROM wanted w
+            JOIN {table} s ON s.tag = w.tag
+                AND s.dataTime = (SELECT MAX(dataTime) FROM {table} WHERE tag = w.tag)
+        )
+        SELECT tag, {', '.join(['doc -> ?'] * len(paths))}
+        FROM docs
+        WHERE json_valid(doc)
+    """
+    return sql, list(paths)
+
+
+def load_fields(conn, table: str, tags, paths: dict):
+    """
+    Read a few values from the newest snapshot of every tag in `tags` without
+    parsing the whole snapshot in Python. `paths` maps names to SQLite JSON
+    paths ('$.townHallLevel', '$.troops'), only the selected values are parsed.
+    Returns {tag: {name: value}}, a value is None when the snapshot has no such
+    path. Tags without data, or whose latest cocdata cannot be decoded, are
+    left out of the map. `conn` must come from utils/db.py connect().
+    """
+    if table not in SNAPSHOT_TABLES:
+        raise ValueError(f"{table} is not a snapshot table")
+
+    names = list(paths)
+    tags = list(dict.fromkeys(tags))
+    field_map = {}
+    for start in range(0, len(tags), _MAX_TAGS_PER_QUERY):
+        chunk = tags[start:start + _MAX_TAGS_PER_QUERY]
+        sql, params = fields_sql(table, len(chunk), [paths[name] for name in names])
+        for row in conn.execute(sql, [*chunk, *params]):
+            field_map[row[0]] = {name: None if value is None else loads(value) for name, value in zip(names, row[1:])}
+    return field_map
+
+
+def snapshot_chain(conn, player_tag: str, data_time: str, max_rows: int = None):
+    """
+    Player rows (dataTime, cocdata) from the nearest full snapshot at or before
+    `data_time` up to `data_time`, oldest first, from the hot store or the
+    archive partition holding it. Stops early after `max_rows` rows, in which
+    case the first row is still a delta.
+    """
+    table, row = player_row_at(conn, player_tag, data_time, 'dataTime, cocdata')
+    # each step is one primary key seek, deltas are small
+    sql = CHAIN_STEP_SQL.format(table)
+    chain = []
+    while row is not None and (max_rows is None or len(chain) < max_rows):
+        chain.append((row[0], row[1]))
+        if not is_delta(row[1]):
+            break
+        row = conn.execute(sql, (player_tag, row[0])).fetchone()
+    chain.reverse()
+    return chain
+
+
+def replay_chain(chain):
+    """Parse the first row of a chain and apply the deltas of the rest to it."""
+    player_data = load_json(chain[0][1])
+    for _, blob in chain[1:]:
+        player_data = apply(player_data, decode_delta(blob))
+    return player_data
+
+
+def load_player_snapshot(conn, player_tag: str, data_time: str):
+    """
+    Return the parsed player snapshot stored at `data_time`, rebuilt from its
+    keyframe when it is delta encoded. None if there is no such snapshot; a
+    corrupt value or a broken chain raises json.JSONDecodeError.
+    """
+    chain = snapshot_chain(conn, player_tag, data_time)
+    if not chain or chain[-1][0] != data_time:
+        return None
+    return replay_chain(chain)
+
+
+def parse_player_row(conn, player_tag: str, data_time: str, blob, previous: dict = None):
+    """
+    Parse one stored player row. `previous` is the parsed snapshot right before
+    it, when a forward walk already has it a delta costs one apply(); without it
+    the row is rebuilt from its keyframe.
+    """
+    if not is_delta(blob):
+        return load_json(blob)
+    if previous is not None:
+        return apply(previous, decode_delta(blob))
+    return load_player_snapshot(conn, player_tag, data_time)
+
+
+def iter_player_snapshots(conn, player_tag: str, since: str = '', until: str = '9999'):
+    """
+    Yield (dataTime, parsed snapshot) for the player rows in [since, until],
+    oldest first, the archived ones before those of the hot store. Only the
+    first row is rebuilt from a keyframe, every later one applies its delta to
+    the row before.
+    """
+    previous = None
+    tables, before = archive_range(conn, player_tag, since, until)
+    sql = 'SELECT dataTime, cocdata FROM {} WHERE tag = ? AND dataTime >= ? AND dataTime <= ? AND dataTime < ? ORDER BY dataTime'
+    for table, bound in [*((table, before) for table in reversed(tables)), ('player', '9999')]:
+        for data_time, blob in conn.execute(sql.format(table), (player_tag, since, until, bound)):
+            previous = parse_player_row(conn, player_tag, data_time, blob, previous)
+            yield data_time, previous
@@ -0,0 +1,89 @@
+# app/utils/streaming.py
+from flask import current_app, stream_with_context
+
+# Chunked JSON for the views whose payload grows with clan size and history. A
+# view returns stream_json(document), where the heavy values of `document` are
+# JsonObject / JsonArray wrappers around generators, typically reading a DB
+# cursor. Every item is encoded as soon as it is produced and sent in chunks of
+# about STREAM_CHUNK_BYTES, so the document never exists as a whole, neither
+# as Python objects nor as one string. The output is the same as jsonify's
+# (sorted keys, compact separators) as long as the generators yield their
+# keys in sorted order.
+
+
+class JsonObject:
+    """A JSON object produced lazily from an iterable of (key, value) pairs."""
+    __slots__ = ('items',)
+
+    def __init__(self, items):
+        self.items = items
+
+
+class JsonArray:
+    """A JSON array produced lazily from an iterable of values."""
+    __slots__ = ('values',)
+
+    def __init__(self, values):
+        self.values = values
+
+
+def _is_lazy(value):
+    return isinstance(value, (JsonObject, JsonArray))
+
+
+def _object_pieces(items, dumps):
+    yield '{'
+    for index, (key, value) in enumerate(items):
+        yield (',' if index else '') + dumps(str(key)) + ':'
+        yield from _pieces(value, dumps)
+    yield '}'
+
+
+def _pieces(value, dumps):
+    if isinstance(value, JsonObject):
+        yield from _object_pieces(value.items, dumps)
+    elif isinstance(value, JsonArray):
+        yield '['
+        for index, item in enumerate(value.values):
+            if index:
+                yield ','
+            yield from _pieces(item, dumps)
+        yield ']'
+    elif isinstance(value, dict) and any(_is_lazy(item) for item in value.values()):
+        # only dicts holding a lazy value directly are walked key by key, the rest are encoded whole
+        items = sorted(value.items()) if current_app.json.sort_keys else value.items()
+        yield from _object_pieces(items, dumps)
+    else:
+        yield dumps(value)
+
+
+def iter_json(document):
+    """Yield the JSON text of `document` in chunks of about STREAM_CHUNK_BYTES characters."""
+    json_provider = current_app.json
+    chunk_size = current_app.config.get('STREAM_CHUNK_BYTES', 16384)
+    dumps = lambda value: json_provider.dumps(value, separators=(',', ':'))
+    buffer = []
+    size = 0
+    top_level = document if isinstance(document, (JsonObject, JsonArray)) else JsonObject(
+            sorted(document.items()) if json_provider.sort_keys else document.items())
+    for piece in _pieces(top_level, dumps):
+        buffer.append(piece)
+        size += len(piece)
+        if size >= chunk_size:
+            yield ''.join(buffer)
+            buffer = []
+            size = 0
+    buffer.append('\n')
+    yield ''.join(buffer)
+
+
+def stream_json(document, status: int = 200):
+    """
+    Response with the JSON of the dict `document`, sent with chunked transfer
+    while it is encoded. With STREAM_JSON_RESPONSES off the same text is built
+    in full first and sent with a Content-Length.
+    """
+    mimetype = current_app.json.mimetype
+    if not current_app.config.get('STREAM_JSON_RESPONSES', True):
+        return current_app.response_class(''.join(iter_json(document)), status=status, mimetype=mimetype)
+    return current_app.response_class(stream_with_context(iter_json(document)), status=status, mimetype=mimetype)
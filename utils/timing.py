@@ -0,0 +1,237 @@
+# app/utils/timing.py
+import contextvars
+import sqlite3
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from flask import current_app, request
+
+# Where the time of a request went: SQLite (queries, rows fetched, ms), JSON
+# decoding (bytes, ms) and CoC API calls (calls, ms). The counters of a request
+# hang off a context variable, so the hot paths reach them without the Flask
+# context machinery, in a WSGI thread as in an asyncio task of asgi.py; worker
+# threads of a request share them through collecting(). They go out as a
+# Server-Timing header and one log line per request. Requests slower than
+# SLOW_REQUEST_MS also log their slowest queries and upstream calls, and the
+# last SLOW_REQUEST_SAMPLES of them are kept for slow_requests().
+_timings = contextvars.ContextVar('request_timings', default=None)
+_local = threading.local()
+
+_slow_lock = threading.Lock()
+_slow = deque()
+
+# per query / call details kept for the slow request log
+_MAX_DETAILS = 200
+
+
+class RequestTimings:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.start = time.perf_counter()
+        self.status = None
+        self.streamed = False
+        self.queries = 0
+        self.rows = 0
+        self.sql_ms = 0.0
+        self.decoded_bytes = 0
+        self.decode_ms = 0.0
+        self.upstream_calls = 0
+        self.upstream_ms = 0.0
+        self.details = [] # [kind, what, ms, count]
+
+    def detail(self, kind: str, what: str):
+        entry = [kind, what, 0.0, 0]
+        with self.lock:
+            if len(self.details) < _MAX_DETAILS:
+                self.details.append(entry)
+        return entry
+
+    def add_sql(self, entry, ms: float, rows: int = 0, query: bool = False):
+        with self.lock:
+            self.queries += query
+            self.rows += rows
+            self.sql_ms += ms
+            entry[2] += ms
+            entry[3] += rows
+
+    def add_decode(self, size: int, ms: float):
+        with self.lock:
+            self.decoded_bytes += size
+            self.decode_ms += ms
+
+    def add_upstream(self, endpoint: str, status: int, ms: float):
+        with self.lock:
+            self.upstream_calls += 1
+            self.upstream_ms += ms
+            if len(self.details) < _MAX_DETAILS:
+                self.details.append(['upstream', endpoint, ms, status])
+
+    def total_ms(self):
+        return (time.perf_counter() - self.start) * 1000
+
+    def summary(self):
+        with self.lock:
+            return {
+                'total_ms': round(self.total_ms(), 2),
+                'queries': self.queries,
+                'rows': self.rows,
+                'sql_ms': round(self.sql_ms, 2),
+                'decoded_bytes': self.decoded_bytes,
+                'decode_ms': round(self.decode_ms, 2),
+                'upstream_calls': self.upstream_calls,
+                'upstream_ms': round(self.upstream_ms, 2),
+            }
+
+    def server_timing(self):
+        s = self.summary()
+        return ', '.join([
+            f'sql;dur={s["sql_ms"]};desc="{s["queries"]} queries, {s["rows"]} rows"',
+            f'decode;dur={s["decode_ms"]};desc="{s["decoded_bytes"]} bytes"',
+            f'upstream;dur={s["upstream_ms"]};desc="{s["upstream_calls"]} calls"',
+            f'total;dur={s["total_ms"]}',
+        ])
+
+
+def current_timings():
+    """The RequestTimings of the request this thread or task works for, None outside one."""
+    return _timings.get()
+
+
+@contextmanager
+def collecting(timings):
+    """Count this thread's work into `timings`, e.g. in a worker thread of a request."""
+    previous = current_timings()
+    _timings.set(timings)
+    try:
+        yield timings
+    finally:
+        _timings.set(previous)
+
+
+class _TimedCursor(sqlite3.Cursor):
+    # the execute and every fetch count into the request's timings
+    def _timed(self, method, *args):
+        start = time.perf_counter()
+        result = method(*args)
+        self.timings.add_sql(self.entry, (time.perf_counter() - start) * 1000,
+                             rows=len(result) if isinstance(result, list) else result is not None)
+        return result
+
+    def execute(self, sql, parameters=()):
+        self.entry = self.timings.detail('sql', ' '.join(sql.split())[:120])
+        start = time.perf_counter()
+        super().execute(sql, parameters)
+        self.timings.add_sql(self.entry, (time.perf_counter() - start) * 1000, query=True)
+        return self
+
+    def executemany(self, sql, seq_of_parameters):
+        self.entry = self.timings.detail('sql', ' '.join(sql.split())[:120])
+        start = time.perf_counter()
+        super().executemany(sql, seq_of_parameters)
+        self.timings.add_sql(self.entry, (time.perf_counter() - start) * 1000, query=True)
+        return self
+
+    def fetchone(self):
+        return self._timed(super().fetchone)
+
+    def fetchmany(self, size=None):
+        return self._timed(super().fetchmany, size if size is not None else self.arraysize)
+
+    def fetchall(self):
+        return self._timed(super().fetchall)
+
+    def __next__(self):
+        start = time.perf_counter()
+        try:
+            row = super().__next__()
+        except StopIteration:
+            self.timings.add_sql(self.entry, (time.perf_counter() - start) * 1000)
+            raise
+        self.timings.add_sql(self.entry, (time.perf_counter() - start) * 1000, rows=1)
+        return row
+
+
+class InstrumentedConnection(sqlite3.Connection):
+    """A sqlite3 connection whose execute() counts into the current request's timings, if any."""
+
+    def execute(self, sql, parameters=()):
+        timings = current_timings()
+        if timings is None:
+            return super().execute(sql, parameters)
+        cursor = self.cursor(_TimedCursor)
+        cursor.timings = timings
+        return cursor.execute(sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        timings = current_timings()
+        if timings is None:
+            return super().executemany(sql, seq_of_parameters)
+        cursor = self.cursor(_TimedCursor)
+        cursor.timings = timings
+        return cursor.executemany(sql, seq_of_parameters)
+
+
+def slow_requests():
+    """The newest slow requests of this process, oldest first, with their breakdown."""
+    with _slow_lock:
+        return list(_slow)
+
+
+def last_request_timings():
+    """summary() of the last request this thread finished, e.g. for benchmarks/routes.py."""
+    return getattr(_local, 'last', None)
+
+
+def _start_request():
+    if current_app.config.get('REQUEST_TIMING', True):
+        _timings.set(RequestTimings())
+
+
+def _add_header(response):
+    timings = current_timings()
+    if timings is not None:
+        timings.status = response.status_code
+        # a streamed body is still to come, its work only shows in the log line
+        response.headers['Server-Timing'] = timings.server_timing()
+        if response.is_streamed:
+            # teardown runs before the body is generated, the request is finished once it is sent
+            timings.streamed = True
+            app, method, path = current_app._get_current_object(), request.method, request.path
+            response.call_on_close(lambda: _finish(timings, app, method, path))
+    return response
+
+
+def _finish_request(exc=None):
+    timings = current_timings()
+    if timings is None or timings.streamed:
+        return
+    _finish(timings, current_app, request.method, request.path)
+
+
+def _finish(timings, app, method, path):
+    if current_timings() is timings:
+        _timings.set(None)
+    summary = _local.last = timings.summary()
+    summary_line = ' '.join(f"{name}={value}" for name, value in summary.items())
+    app.logger.info(f"timing {method} {path} status={timings.status} {summary_line}")
+
+    threshold = app.config.get('SLOW_REQUEST_MS', 1000)
+    if not threshold or summary['total_ms'] < threshold:
+        return
+    with timings.lock:
+        slowest = sorted(timings.details, key=lambda detail: detail[2], reverse=True)[:10]
+    sample = dict(summary, method=method, path=path, status=timings.status,
+                  slowest=[{'kind': kind, 'what': what, 'ms': round(ms, 2), 'count': count} for kind, what, ms, count in slowest])
+    with _slow_lock:
+        _slow.append(sample)
+        while len(_slow) > app.config.get('SLOW_REQUEST_SAMPLES', 20):
+            _slow.popleft()
+    breakdown = '\n'.join(f"  {kind} {ms:.2f}ms count={count} {what}" for kind, what, ms, count in slowest)
+    app.logger.warning(f"slow request {method} {path} {summary_line}\n{breakdown}")
+
+
+def init_timing(app):
+    app.before_request(_start_request)
+    app.after_request(_add_header)
+    app.teardown_request(_finish_request)
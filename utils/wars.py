@@ -0,0 +1,36 @@
+# app/utils/wars.py
+# Reads of the stored wars and CWL data (warlog, clanwarleague, cwlwarlog),
+# shared by the clan and cwl routes, utils/scheduler.py and hot_queries()
+# (utils/schema.py), so the plans it checks are those of the statements served.
+# The newest warlog / clanwarlog row of a clan is utils/snapshots.py
+# latest_row_sql().
+
+# the war of a clan that ended on a day, keyed clan tag + YYYYMMDD
+WAR_DATA_TIME_SQL = 'SELECT MAX(dataTime) FROM warlog WHERE endTime = ?'
+
+# the CWL league groups of a clan, keyed tag or clan tag + season
+CWL_LIST_SQL = 'SELECT cocdata FROM clanwarleague WHERE tag = ? ORDER BY dataTime DESC LIMIT 6'
+CWL_SEASON_DATA_TIME_SQL = 'SELECT MAX(dataTime) FROM clanwarleague WHERE clanSeason = ?'
+
+
+def war_sql(columns: str):
+    # newest stored copy of the war ended on a day
+    return f'SELECT {columns} FROM warlog WHERE endTime = ? ORDER BY dataTime DESC LIMIT 1'
+
+
+def cwl_season_sql(columns: str):
+    return f'SELECT {columns} FROM clanwarleague WHERE clanSeason = ? LIMIT 1'
+
+
+def latest_cwl_sql(columns: str):
+    # league group of the newest season of a clan
+    return f'SELECT {columns} FROM clanwarleague WHERE tag = ? ORDER BY clanSeason DESC LIMIT 1'
+
+
+def cwl_wars_sql(war_count: int):
+    # stored CWL wars by season + war tag, each a primary key seek
+    return f"SELECT seasonWarTag, cocdata, dataTime FROM cwlwarlog WHERE seasonWarTag IN ({', '.join(['?'] * war_count)})"
+
+
+def cwl_war_sql(columns: str):
+    return f'SELECT {columns} FROM cwlwarlog WHERE seasonWarTag = ?'